@@ -0,0 +1,257 @@
+## Instrumentation of the jack process callback
+# `process` runs in jack's realtime thread, so it must not allocate, print,
+# or take locks. CallbackStats keeps plain counters plus two preallocated
+# histories, and does all of the expensive work (percentiles, formatting)
+# in `snapshot`, which is called from the main loop instead.
+
+import collections
+import time
+import numpy as np
+
+
+class CallbackStats:
+    """Counters for the jack process callback.
+
+    The callback calls `record` once per block. The main loop calls
+    `snapshot` every so often and sends the result to the GUI.
+
+    Counters are only written by the callback and only read by the main
+    loop, so no lock is needed. A snapshot may mix values from two
+    neighbouring calls, which is fine for monitoring.
+    """
+    def __init__(self, n_history=1024):
+        """Create counters with room for `n_history` recent calls
+
+        Args:
+            n_history (int): number of calls that min/mean/max/p99 of the
+                recent callback durations and queue depths are taken over
+        """
+        self.n_history = int(n_history)
+
+        # Recent durations (ns) and queue depths, overwritten in a circle
+        self.durations = np.zeros(self.n_history, dtype=np.int64)
+        self.depths = np.zeros(self.n_history, dtype=np.int64)
+
+        self.reset()
+
+    def reset(self):
+        """Zero all of the counters"""
+        # Number of calls since the last reset
+        self.n_calls = 0
+
+        # Number of calls that had to play silence while sound was expected
+        self.n_underruns = 0
+
+        # Running totals over all calls
+        self.total_ns = 0
+        self.min_ns = -1
+        self.max_ns = 0
+
+        # Depth of the queue the last time the callback was entered
+        self.last_depth = 0
+
+        self.durations[:] = 0
+        self.depths[:] = 0
+
+    def record(self, start_ns, depth, underrun):
+        """Record one call to the callback (realtime thread only)
+
+        Args:
+            start_ns (int): time.perf_counter_ns() at entry to the callback
+            depth (int): queue depth at entry to the callback
+            underrun (bool): whether the callback had to play silence
+        """
+        duration = time.perf_counter_ns() - start_ns
+
+        idx = self.n_calls % self.n_history
+        self.durations[idx] = duration
+        self.depths[idx] = depth
+        self.last_depth = depth
+
+        self.total_ns += duration
+        if duration > self.max_ns:
+            self.max_ns = duration
+        if self.min_ns < 0 or duration < self.min_ns:
+            self.min_ns = duration
+        if underrun:
+            self.n_underruns += 1
+
+        # Increment last, so `snapshot` never reads an unwritten slot
+        self.n_calls += 1
+
+    def snapshot(self):
+        """Return a dict summarizing the counters (not in the realtime thread)
+
+        Durations are in microseconds. `min_us`, `mean_us` and `max_us` are
+        over every call since the last reset, and `p99_us` and the depths
+        are over the last `n_history` calls.
+        """
+        n_calls = self.n_calls
+        n_recent = min(n_calls, self.n_history)
+        if n_recent == 0:
+            return {
+                'calls': 0, 'underruns': 0,
+                'min_us': 0., 'mean_us': 0., 'max_us': 0., 'p99_us': 0.,
+                'depth_last': 0, 'depth_min': 0, 'depth_mean': 0.,
+                }
+
+        durations = self.durations[:n_recent]
+        depths = self.depths[:n_recent]
+        return {
+            'calls': n_calls,
+            'underruns': self.n_underruns,
+            'min_us': self.min_ns / 1e3,
+            'mean_us': self.total_ns / n_calls / 1e3,
+            'max_us': self.max_ns / 1e3,
+            'p99_us': float(np.percentile(durations, 99)) / 1e3,
+            'depth_last': self.last_depth,
+            'depth_min': int(depths.min()),
+            'depth_mean': float(depths.mean()),
+            }
+
+    def format_snapshot(self, snapshot=None):
+        """Return a snapshot as the string that is sent to the GUI"""
+        if snapshot is None:
+            snapshot = self.snapshot()
+        return (
+            f"Audio Stats - Calls: {snapshot['calls']}, "
+            f"Underruns: {snapshot['underruns']}, "
+            f"Callback us min/mean/max/p99: "
+            f"{snapshot['min_us']:.0f}/{snapshot['mean_us']:.0f}/"
+            f"{snapshot['max_us']:.0f}/{snapshot['p99_us']:.0f}, "
+            f"Depth last/min/mean: {snapshot['depth_last']}/"
+            f"{snapshot['depth_min']}/{snapshot['depth_mean']:.1f}"
+            )
+
+
+class DepthController:
+    """Chooses how many frames SoundQueue keeps in the ring.
+
+    A deep queue survives long stalls of the main loop, but every frame in
+    it is audio that has to be flushed when the sound changes. This keeps
+    the queue only as deep as the main loop actually needs.
+
+    Each main-loop iteration, `observe` is called with the queue depth
+    before refilling it. That is the low-water mark since the last refill,
+    because only the callback removes frames in between. The difference
+    from the depth after the last refill is how much was drained.
+
+    The target grows right away when the drain comes within `margin` of
+    emptying the queue, and doubles after an underrun. It shrinks slowly,
+    once per `window` iterations, toward `safety` times the largest drain
+    seen in that window plus `margin`.
+    """
+    def __init__(self, target=200, min_target=40, max_target=400,
+        margin=10, safety=1.5, window=100, shrink_step=0.1, n_history=256):
+        """Create a controller starting at `target` frames
+
+        Args:
+            target (int): initial target depth
+            min_target, max_target (int): bounds on the target depth
+                `max_target` must be at most half the slots in the ring,
+                so that it can be refilled right after a flush
+            margin (int): frames to keep in the queue beyond the largest drain
+            safety (float): multiplier on the largest drain
+            window (int): iterations between attempts to shrink
+            shrink_step (float): largest fraction to shrink by at a time
+            n_history (int): number of recent changes of target to remember
+        """
+        self.min_target = int(min_target)
+        self.max_target = int(max_target)
+        self.margin = int(margin)
+        self.safety = float(safety)
+        self.window = int(window)
+        self.shrink_step = float(shrink_step)
+        self.target = self.clip(target)
+
+        # Depth after the last refill, or None if the next observation
+        # should be ignored (after a flush or while stopped)
+        self.last_refill = None
+
+        # Largest drain and lowest low-water mark in the current window
+        self.n_observed = 0
+        self.window_drain = 0
+        self.low_water = None
+
+        # Underrun count at the last observation
+        self.last_underruns = 0
+
+        # History of (time, target, underruns) the last `n_history` times
+        # the target changed
+        self.history = collections.deque(
+            [(time.time(), self.target, 0)], maxlen=n_history)
+
+    def clip(self, target):
+        return int(min(max(target, self.min_target), self.max_target))
+
+    def skip(self):
+        """Ignore the next observation, eg because the queue was flushed"""
+        self.last_refill = None
+
+    def refilled(self, depth):
+        """Record the depth of the queue right after refilling it"""
+        self.last_refill = depth
+
+    def observe(self, depth, n_underruns):
+        """Record the depth before refilling, and update the target
+
+        Args:
+            depth (int): queue depth before refilling
+            n_underruns (int): total underruns so far, from CallbackStats
+
+        Returns: the new target depth
+        """
+        # Underruns since the last observation
+        new_underruns = n_underruns - self.last_underruns
+        self.last_underruns = n_underruns
+        if new_underruns > 0:
+            self.set_target(2 * self.target, n_underruns)
+            self.start_window()
+            return self.target
+
+        # Nothing to compare against
+        if self.last_refill is None:
+            return self.target
+
+        drain = max(self.last_refill - depth, 0)
+        self.window_drain = max(self.window_drain, drain)
+        if self.low_water is None or depth < self.low_water:
+            self.low_water = depth
+        self.n_observed += 1
+
+        # Grow right away if the queue came close to running out
+        needed = self.safety * drain + self.margin
+        if needed > self.target:
+            self.set_target(needed, n_underruns)
+            self.start_window()
+
+        # Shrink slowly if the queue never came close to running out
+        elif self.n_observed >= self.window:
+            needed = self.safety * self.window_drain + self.margin
+            if needed < self.target:
+                self.set_target(
+                    max(needed, (1 - self.shrink_step) * self.target),
+                    n_underruns)
+            self.start_window()
+
+        return self.target
+
+    def format_status(self):
+        """Return the target depth and low-water mark as a string"""
+        return (
+            f"Target depth: {self.target}, "
+            f"Low water: {self.low_water}")
+
+    def start_window(self):
+        self.n_observed = 0
+        self.window_drain = 0
+        self.low_water = None
+
+    def set_target(self, target, n_underruns):
+        target = self.clip(target)
+        if target != self.target:
+            self.target = target
+            self.history.append((time.time(), target, n_underruns))
+            print(
+                f"Target queue depth: {target} frames, "
+                f"underruns so far: {n_underruns}")
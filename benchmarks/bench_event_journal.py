@@ -0,0 +1,96 @@
+## Benchmark of what the event journal adds to sending an event
+# pi.py sends every event from send_event, which is called from the pigpio
+# callbacks. This times encoding an event on its own, which is what
+# send_event did before the journal, against EventJournal.append, while
+# the journal thread writes and fsyncs batches in the background. It also
+# reports how long each batch took to write and fsync, which is the time
+# the poke callbacks no longer wait for.
+#
+# Run from the root of the repository, on the Pi's SD card:
+#   python -m benchmarks.bench_event_journal --directory /tmp --rate 1000
+
+import argparse
+import os
+import tempfile
+import time
+import numpy as np
+import event_protocol
+from event_journal import EventJournal
+
+
+def run(directory, rate, duration):
+    """Append events at `rate` per second for `duration` s
+
+    Returns: dict of timing statistics
+    """
+    # Time the journal thread's batches by wrapping its flush
+    flush_s = []
+    path = os.path.join(
+        tempfile.mkdtemp(dir=directory), 'bench.events')
+    journal = EventJournal(path)
+    flush = journal.flush
+    def timed_flush():
+        start = time.perf_counter()
+        flush()
+        flush_s.append(time.perf_counter() - start)
+    journal.flush = timed_flush
+
+    n_events = int(rate * duration)
+    encode_ns = np.zeros(n_events, dtype=np.int64)
+    append_ns = np.zeros(n_events, dtype=np.int64)
+    deadline = time.perf_counter()
+    for n_event in range(n_events):
+        deadline += 1 / rate
+        delay = deadline - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+
+        start = time.perf_counter_ns()
+        event_protocol.encode(
+            event_protocol.POKE, (time.time(),), 5, n_event, n_event)
+        encode_ns[n_event] = time.perf_counter_ns() - start
+
+        start = time.perf_counter_ns()
+        journal.append(event_protocol.POKE, (time.time(),), 5, n_event)
+        append_ns[n_event] = time.perf_counter_ns() - start
+
+    journal.close()
+    os.remove(path)
+    os.rmdir(os.path.dirname(path))
+
+    flush_s = np.array(flush_s)
+    return {
+        'events': n_events,
+        'encode_mean_us': encode_ns.mean() / 1e3,
+        'encode_p99_us': np.percentile(encode_ns, 99) / 1e3,
+        'append_mean_us': append_ns.mean() / 1e3,
+        'append_p99_us': np.percentile(append_ns, 99) / 1e3,
+        'append_max_us': append_ns.max() / 1e3,
+        'batches': len(flush_s),
+        'flush_mean_ms': flush_s.mean() * 1e3,
+        'flush_max_ms': flush_s.max() * 1e3,
+        }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Time appending events to the journal")
+    parser.add_argument('--directory', default='.',
+        help="where to write the journal, on the disk to test")
+    parser.add_argument('--rate', type=float, default=1000.0,
+        help="events per second")
+    parser.add_argument('--duration', type=float, default=5.0)
+    args = parser.parse_args()
+
+    res = run(args.directory, args.rate, args.duration)
+    print(f"{res['events']} events, {res['batches']} batches")
+    print(
+        f"encode only:    mean {res['encode_mean_us']:.1f} us, "
+        f"p99 {res['encode_p99_us']:.1f} us")
+    print(
+        f"journal append: mean {res['append_mean_us']:.1f} us, "
+        f"p99 {res['append_p99_us']:.1f} us, "
+        f"max {res['append_max_us']:.1f} us")
+    print(
+        f"write + fsync:  mean {res['flush_mean_ms']:.2f} ms, "
+        f"max {res['flush_max_ms']:.2f} ms per batch")
@@ -0,0 +1,99 @@
+## Benchmark of encoding and decoding a poke: text vs event_protocol.py
+# Before event_protocol.py, a poke was sent as a string like
+# "Poke - Port: 5, Tick: 123, Time: 1700000000.123456", and the GUI split it
+# into fields. This times formatting and parsing that string against
+# packing and unpacking the two binary frames, and reports how many bytes
+# each puts on the wire. msgpack is timed too, if it is installed.
+#
+# Run from the root of the repository:
+#   python -m benchmarks.bench_event_protocol --number 200000
+
+import argparse
+import timeit
+import event_protocol
+
+
+PORT = 5
+TICK = 3141592653
+GUI_TIME = 1700000000.123456
+SEQ = 12345
+
+
+def text_encode():
+    return f"Poke - Port: {PORT}, Tick: {TICK}, Time: {GUI_TIME:.6f}".encode(
+        'utf-8')
+
+
+def text_decode(message):
+    # Same parsing as the GUI did
+    fields = {}
+    for field in message.decode('utf-8').split("-", 1)[1].split(","):
+        key, value = field.split(":", 1)
+        fields[key.strip()] = value.strip()
+    return int(fields["Port"]), int(fields["Tick"]), float(fields["Time"])
+
+
+def binary_encode():
+    return event_protocol.encode(
+        event_protocol.POKE, (GUI_TIME,), port=PORT, tick=TICK, seq=SEQ)
+
+
+def binary_decode(frames):
+    return event_protocol.decode(frames)
+
+
+def codecs():
+    """Return a list of (name, encode, decode, bytes on the wire)
+
+    Bytes on the wire count the payload of each zmq frame, and not the
+    1-byte length that zmq adds to each frame.
+    """
+    res = [
+        ('text', text_encode, text_decode, len(text_encode())),
+        ('struct', binary_encode, binary_decode,
+            sum(len(frame) for frame in binary_encode())),
+        ]
+
+    try:
+        import msgpack
+    except ImportError:
+        return res
+
+    def msgpack_encode():
+        return msgpack.packb((
+            event_protocol.PROTOCOL_VERSION, event_protocol.POKE,
+            PORT, TICK, SEQ, GUI_TIME))
+
+    res.append(('msgpack', msgpack_encode, msgpack.unpackb,
+        len(msgpack_encode())))
+    return res
+
+
+def run(number):
+    """Time each codec and return a list of dicts of results"""
+    results = []
+    for name, encode, decode, n_bytes in codecs():
+        encoded = encode()
+        encode_s = min(timeit.repeat(encode, number=number, repeat=5))
+        decode_s = min(timeit.repeat(
+            lambda: decode(encoded), number=number, repeat=5))
+        results.append({
+            'codec': name,
+            'bytes': n_bytes,
+            'encode_us': encode_s / number * 1e6,
+            'decode_us': decode_s / number * 1e6,
+            })
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Compare text and binary encodings of a poke")
+    parser.add_argument('--number', type=int, default=200000)
+    args = parser.parse_args()
+
+    print(f"{'codec':>8} {'bytes':>6} {'encode':>8} {'decode':>8}  (us)")
+    for res in run(args.number):
+        print(
+            f"{res['codec']:>8} {res['bytes']:>6} "
+            f"{res['encode_us']:>8.2f} {res['decode_us']:>8.2f}")
@@ -0,0 +1,93 @@
+## Benchmark of building noise bursts: one at a time vs make_noise_batch
+# SoundQueue used to build each burst as its own Noise, with Butterworth
+# filters and filtfilt ('butter') or one irfft ('fft'). This times both,
+# one burst at a time, against make_noise_batch, which synthesizes every
+# burst with a single irfft. NoiseCache.get_channels uses it to build the
+# left and right bursts of a trial together.
+#
+# To approximate a Raspberry Pi, pass --cpu to pin this process to a single
+# core.
+#
+# Run from the root of the repository:
+#   python -m benchmarks.bench_noise_batch --cpu 0 --bursts 2 64
+
+import argparse
+import os
+import time
+import numpy as np
+from noise import Noise, make_noise_batch
+
+
+FS = 192000
+BLOCKSIZE = 1024
+DURATION = 0.01
+HIGHPASS = 8500.0
+LOWPASS = 11500.0
+
+
+def build_one_by_one(n_bursts, backend):
+    return [
+        Noise(BLOCKSIZE, FS, duration=DURATION, channel=n_burst % 2,
+            highpass=HIGHPASS, lowpass=LOWPASS, backend=backend)
+        for n_burst in range(n_bursts)]
+
+
+def build_batch(n_bursts, backend):
+    return make_noise_batch(n_bursts, BLOCKSIZE, FS, duration=DURATION,
+        channels=[n_burst % 2 for n_burst in range(n_bursts)],
+        highpass=HIGHPASS, lowpass=LOWPASS)
+
+
+def time_per_burst(build, n_bursts, backend, repeat):
+    """Return the median time per burst of `build`, in ms"""
+    # Once first, so that eg scipy is imported before timing
+    build(n_bursts, backend)
+
+    times = []
+    for n_repeat in range(repeat):
+        start = time.perf_counter()
+        build(n_bursts, backend)
+        times.append(time.perf_counter() - start)
+    return np.median(times) / n_bursts * 1e3
+
+
+def run(bursts, repeat):
+    """Time each way of building each number of bursts
+
+    Returns: list of dicts of results
+    """
+    methods = [
+        ('butter', build_one_by_one, 'butter'),
+        ('fft', build_one_by_one, 'fft'),
+        ('fft batch', build_batch, 'fft'),
+        ]
+
+    results = []
+    for n_bursts in bursts:
+        for name, build, backend in methods:
+            results.append({
+                'method': name,
+                'bursts': n_bursts,
+                'ms_per_burst': time_per_burst(build, n_bursts, backend, repeat),
+                })
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Time building noise bursts one at a time and in a batch")
+    parser.add_argument('--bursts', type=int, nargs='+', default=[2, 64],
+        help="numbers of bursts to build at once")
+    parser.add_argument('--repeat', type=int, default=50)
+    parser.add_argument('--cpu', type=int, default=None,
+        help="pin to this core")
+    args = parser.parse_args()
+
+    if args.cpu is not None:
+        os.sched_setaffinity(0, {args.cpu})
+
+    print(f"{'method':>10} {'bursts':>6} {'ms/burst':>9}")
+    for res in run(args.bursts, args.repeat):
+        print(
+            f"{res['method']:>10} {res['bursts']:>6} "
+            f"{res['ms_per_burst']:>9.3f}")
@@ -0,0 +1,122 @@
+## Benchmark of trial-start latency in SoundQueue.set_sound_cycle
+# Compares the pandas implementation that set_sound_cycle used to have with
+# the numpy scheduler in sound_cycle.py. Both are fed the same intervals and
+# their outputs are checked against each other before timing.
+#
+# To approximate a Raspberry Pi, pass --cpu to pin this process to a single
+# core, which also keeps other processes from sharing the cache.
+#
+# Run from the root of the repository:
+#   python -m benchmarks.bench_scheduler --cpu 0
+
+import argparse
+import os
+import time
+import numpy as np
+import pandas as pd
+from sound_cycle import draw_intervals, schedule_intervals, SIDE_NAMES
+
+
+def schedule_intervals_pandas(left_target_intervals, right_target_intervals,
+    fs, blocksize):
+    """The pandas code that used to be in set_sound_cycle, for reference"""
+    # Turn into series
+    left_target_df = pd.DataFrame.from_dict({
+        'time': np.cumsum(left_target_intervals),
+        'side': ['left'] * len(left_target_intervals),
+        'sound': ['target'] * len(left_target_intervals),
+        })
+    right_target_df = pd.DataFrame.from_dict({
+        'time': np.cumsum(right_target_intervals),
+        'side': ['right'] * len(right_target_intervals),
+        'sound': ['target'] * len(right_target_intervals),
+        })
+
+    # Concatenate them all together and resort by time
+    both_df = pd.concat([
+        left_target_df, right_target_df], axis=0).sort_values('time')
+
+    # Calculate the gap between sounds
+    both_df['gap'] = both_df['time'].diff().shift(-1)
+
+    # Drop the last row which has a null gap
+    both_df = both_df.loc[~both_df['gap'].isnull()].copy()
+
+    # Keep only those below the sound cycle length
+    both_df = both_df.loc[both_df['time'] < 10].copy()
+
+    # Nothing should be null
+    assert not both_df.isnull().any().any()
+
+    # Calculate gap size in chunks
+    both_df['gap_chunks'] = (both_df['gap'] * (fs / blocksize))
+    both_df['gap_chunks'] = both_df['gap_chunks'].round().astype(int)
+
+    # Floor gap_chunks at 1 chunk, the minimal gap size
+    both_df.loc[both_df['gap_chunks'] < 1, 'gap_chunks'] = 1
+
+    return both_df
+
+
+def time_it(func, args_list):
+    """Call func on each set of args and return the durations in us"""
+    durations = np.zeros(len(args_list))
+    for n, args in enumerate(args_list):
+        start = time.perf_counter()
+        func(*args)
+        durations[n] = time.perf_counter() - start
+    return durations * 1e6
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Compare the pandas and numpy burst schedulers")
+    parser.add_argument('--repeats', type=int, default=1000)
+    parser.add_argument('--rate', type=float, default=4.0)
+    parser.add_argument('--irregularity', type=float, default=-1.5)
+    parser.add_argument('--cpu', type=int, default=None,
+        help="pin to this core to approximate a Pi-class CPU budget")
+    args = parser.parse_args()
+
+    if args.cpu is not None:
+        os.sched_setaffinity(0, {args.cpu})
+
+    fs = 192000
+    blocksize = 1024
+
+    # The same intervals are used for both, with one side on at a time
+    # like during a trial, and with both sides on
+    rng = np.random.default_rng(0)
+    cases = {}
+    for name, (left_on, right_on) in {
+            'one side': (True, False), 'both sides': (True, True)}.items():
+        args_list = []
+        for n in range(args.repeats):
+            left = draw_intervals(
+                args.rate if left_on else 0, args.irregularity, rng=rng)
+            right = draw_intervals(
+                args.rate if right_on else 0, args.irregularity, rng=rng)
+            args_list.append((left, right, fs, blocksize))
+        cases[name] = args_list
+
+    ## Check that they agree
+    for args_list in cases.values():
+        for call_args in args_list[:50]:
+            expected = schedule_intervals_pandas(*call_args)
+            got = schedule_intervals(*call_args)
+            assert np.allclose(expected['time'].values, got['time'])
+            assert np.allclose(expected['gap'].values, got['gap'])
+            assert (expected['gap_chunks'].values == got['gap_chunks']).all()
+            assert list(expected['side']) == [
+                SIDE_NAMES[side] for side in got['side']]
+
+    ## Time them
+    print(f"{'case':>10} {'scheduler':>9} {'median':>8} {'p99':>8} {'max':>8}  (us)")
+    for name, args_list in cases.items():
+        for label, func in [
+                ('pandas', schedule_intervals_pandas),
+                ('numpy', schedule_intervals)]:
+            durations = time_it(func, args_list)
+            print(
+                f"{name:>10} {label:>9} {np.median(durations):>8.1f} "
+                f"{np.percentile(durations, 99):>8.1f} {durations.max():>8.1f}")
@@ -0,0 +1,157 @@
+## Benchmark of the audio callback: mp.Queue vs shared-memory FrameRing
+# Simulates the way pi.py moves frames from SoundQueue to SoundPlayer.
+# A consumer thread calls a fake `process` callback once per jack period
+# (1024 samples at 192 kHz) and writes into two preallocated "outport"
+# arrays. The main thread tops up the queue every 100 ms, like the
+# poller.poll(100) in the main loop of pi.py.
+#
+# Run from the root of the repository:
+#   python -m benchmarks.bench_sound_ring --duration 10
+
+import argparse
+import multiprocessing as mp
+import queue
+import threading
+import time
+import numpy as np
+from sound_ring import FrameRing
+
+
+def run(path, duration, blocksize, fs, target_qsize, n_unique_frames=64):
+    """Run one path and return a dict of timing statistics
+
+    Args:
+        path (str): 'queue' for mp.Queue, 'ring' for FrameRing
+        duration (float): how long to run, in seconds
+        blocksize (int): samples per frame
+        fs (int): sampling rate
+        target_qsize (int): depth the producer fills to
+        n_unique_frames (int): number of random frames to cycle through
+    """
+    # Frames to send, generated up front so the producer cost is only the
+    # cost of the transport itself
+    rng = np.random.default_rng(0)
+    frames = rng.uniform(-.01, .01, (n_unique_frames, blocksize, 2)).astype(
+        np.float32)
+
+    # Fake outports
+    outports = [np.zeros(blocksize, dtype=np.float32) for n in range(2)]
+
+    if path == 'queue':
+        transport = mp.Queue()
+
+        def callback():
+            # Same logic as SoundPlayer.process before FrameRing
+            if transport.empty():
+                for buff in outports:
+                    buff[:] = np.zeros(blocksize, dtype='float32')
+                return False
+            data = transport.get()
+            for n_outport, buff in enumerate(outports):
+                buff[:] = data[:, n_outport]
+            return True
+
+    elif path == 'ring':
+        transport = FrameRing(
+            n_slots=2 * target_qsize, blocksize=blocksize, n_channels=2)
+
+        silence = np.zeros(blocksize, dtype='float32')
+
+        def callback():
+            # Same logic as SoundPlayer.process, with nothing allocated
+            slot = transport.peek_slot()
+            if slot < 0:
+                for buff in outports:
+                    np.copyto(buff, silence)
+                return False
+            columns = transport.columns[slot]
+            for n_outport in range(2):
+                np.copyto(outports[n_outport], columns[n_outport])
+            transport.advance()
+            return True
+
+    else:
+        raise ValueError("unknown path: {}".format(path))
+
+    ## Consumer thread
+    period = blocksize / fs
+    n_calls = int(duration / period)
+    wall_ns = np.zeros(n_calls, dtype=np.int64)
+    cpu_ns = np.zeros(n_calls, dtype=np.int64)
+    played = np.zeros(n_calls, dtype=bool)
+    started = threading.Event()
+
+    def consumer():
+        # Don't start counting underruns until the producer has filled up
+        started.wait()
+        deadline = time.perf_counter()
+        for n_call in range(n_calls):
+            # Sleep until the next period, like the jack server would
+            deadline += period
+            delay = deadline - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+
+            wall_start = time.perf_counter_ns()
+            cpu_start = time.thread_time_ns()
+            played[n_call] = callback()
+            cpu_ns[n_call] = time.thread_time_ns() - cpu_start
+            wall_ns[n_call] = time.perf_counter_ns() - wall_start
+
+    consumer_thread = threading.Thread(target=consumer)
+    consumer_thread.start()
+
+    ## Producer loop
+    n_frame = 0
+    stop_at = time.perf_counter() + duration + 0.5
+    while consumer_thread.is_alive() and time.perf_counter() < stop_at:
+        while transport.qsize() < target_qsize:
+            try:
+                transport.put_nowait(frames[n_frame % n_unique_frames])
+            except queue.Full:
+                break
+            n_frame += 1
+        started.set()
+        time.sleep(0.1)
+    consumer_thread.join()
+
+    ## Clean up
+    if path == 'ring':
+        transport.close()
+        transport.unlink()
+    else:
+        transport.cancel_join_thread()
+
+    return {
+        'path': path,
+        'calls': n_calls,
+        'underruns': int((~played).sum()),
+        'wall_mean_us': wall_ns.mean() / 1e3,
+        'wall_p99_us': np.percentile(wall_ns, 99) / 1e3,
+        'wall_max_us': wall_ns.max() / 1e3,
+        'cpu_mean_us': cpu_ns.mean() / 1e3,
+        'cpu_p99_us': np.percentile(cpu_ns, 99) / 1e3,
+        }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Compare mp.Queue and FrameRing as the audio transport")
+    parser.add_argument('--duration', type=float, default=10.0)
+    parser.add_argument('--blocksize', type=int, default=1024)
+    parser.add_argument('--fs', type=int, default=192000)
+    parser.add_argument('--target-qsize', type=int, default=200)
+    args = parser.parse_args()
+
+    print(
+        f"{'path':>6} {'calls':>7} {'underruns':>9} "
+        f"{'wall mean':>10} {'wall p99':>9} {'wall max':>9} "
+        f"{'cpu mean':>9} {'cpu p99':>8}  (us)")
+    for path in ['queue', 'ring']:
+        res = run(
+            path, args.duration, args.blocksize, args.fs, args.target_qsize)
+        print(
+            f"{res['path']:>6} {res['calls']:>7} {res['underruns']:>9} "
+            f"{res['wall_mean_us']:>10.1f} {res['wall_p99_us']:>9.1f} "
+            f"{res['wall_max_us']:>9.1f} "
+            f"{res['cpu_mean_us']:>9.1f} {res['cpu_p99_us']:>8.1f}")
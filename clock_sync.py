@@ -0,0 +1,127 @@
+## Timestamps of pokes on the GUI's clock
+# pigpio stamps each GPIO edge with a microsecond tick, in the callback's
+# `tick` argument. That is the time the beam was broken, without the delay
+# of sending the poke to the GUI and the GUI polling for it. TickClock
+# turns these 32-bit ticks, which wrap every 72 minutes, into seconds.
+#
+# ClockSync then maps those seconds onto the GUI's time.time(), the way NTP
+# does: the Pi sends a ping stamped t0, the GUI stamps it t1 on receipt and
+# t2 on reply, and the Pi stamps the reply t3. The pings whose round trip
+# was shortest were least delayed by either side's polling, so the offset
+# and drift of the clocks are fit to those.
+
+import collections
+import numpy as np
+
+
+class TickClock:
+    """Converts pigpio ticks to seconds that don't wrap.
+
+    `update` must be called with a current tick at least every half hour
+    (the main loop does it on every clock ping). `seconds` can then convert
+    any tick within half an hour of the last update, from any thread.
+    """
+    def __init__(self, tick):
+        """Start counting from `tick`, eg pi.get_current_tick()"""
+        # (raw tick, unwrapped microseconds) of the last update
+        # Replaced as a whole, so other threads never see half of it
+        self.anchor = (tick, 0)
+
+    def unwrap(self, tick):
+        """Return `tick` as microseconds since the first tick"""
+        anchor_tick, anchor_us = self.anchor
+
+        # Difference as a signed 32-bit number, so ticks from shortly
+        # before the anchor come out negative
+        diff = (tick - anchor_tick) & 0xFFFFFFFF
+        if diff >= 2 ** 31:
+            diff -= 2 ** 32
+        return anchor_us + diff
+
+    def update(self, tick):
+        """Move the anchor to `tick`, which must be current"""
+        self.anchor = (tick, self.unwrap(tick))
+
+    def seconds(self, tick):
+        """Return `tick` in seconds since the first tick"""
+        return self.unwrap(tick) / 1e6
+
+
+class ClockSync:
+    """Estimates the offset and drift from a local clock to a remote one.
+
+    Each sample is one ping: t0 and t3 are local times of sending it and
+    of receiving the reply, and t1 and t2 are remote times of receiving
+    it and of replying. The remote time of a local time t is estimated as
+    t + offset + drift * (t - reference), fit by least squares to the
+    `n_best` samples with the shortest round trip out of the last `window`.
+
+    Samples are added from one thread, but `to_remote` can be called from
+    any thread, eg the pigpio callbacks.
+    """
+    def __init__(self, window=64, n_best=16, min_samples=4):
+        """Create an estimator with no samples yet
+
+        Args:
+            window (int): number of recent pings to consider
+            n_best (int): number of them with the shortest round trip to
+                fit. Only the offset is fit if they span less than 10 s.
+            min_samples (int): pings needed before `synchronized` is True
+        """
+        self.n_best = int(n_best)
+        self.min_samples = int(min_samples)
+
+        # (local midpoint, offset, round trip) of each recent ping
+        self.samples = collections.deque(maxlen=window)
+
+        # Current estimate of (reference, offset, drift)
+        # Replaced as a whole, so other threads never see half of it
+        self.estimate = (0., 0., 0.)
+
+        # Shortest round trip of the samples that were fit
+        self.delay = None
+
+    @property
+    def synchronized(self):
+        return len(self.samples) >= self.min_samples
+
+    def add_sample(self, t0, t1, t2, t3):
+        """Add a ping and update the estimate"""
+        # How far ahead the remote clock is, and how long the ping spent
+        # on the network and in queues, not counting the remote's reply
+        offset = ((t1 - t0) + (t2 - t3)) / 2
+        delay = (t3 - t0) - (t2 - t1)
+        self.samples.append(((t0 + t3) / 2, offset, delay))
+        self.fit()
+
+    def fit(self):
+        samples = np.array(self.samples)
+        best = samples[np.argsort(samples[:, 2])[:self.n_best]]
+        times, offsets = best[:, 0], best[:, 1]
+
+        reference = times.mean()
+        if times.max() - times.min() < 10:
+            # Too short a time to tell drift from jitter
+            offset = np.median(offsets)
+            drift = 0.
+        else:
+            drift, offset = np.polyfit(times - reference, offsets, 1)
+        
+        self.estimate = (float(reference), float(offset), float(drift))
+        self.delay = float(best[0, 2])
+
+    def to_remote(self, t):
+        """Return local time `t` on the remote clock"""
+        reference, offset, drift = self.estimate
+        return t + offset + drift * (t - reference)
+
+    def format_status(self):
+        """Return the estimate as a string, for logging"""
+        if self.delay is None:
+            return "Clock sync: no samples"
+        reference, offset, drift = self.estimate
+        return (
+            f"Clock sync: offset {offset:.6f} s, "
+            f"drift {drift * 1e6:.1f} ppm, "
+            f"best round trip {self.delay * 1e3:.3f} ms, "
+            f"{len(self.samples)} samples")
@@ -0,0 +1,224 @@
+## Supervisor for the pigpiod and jackd background processes
+# pi.py used to `killall` both daemons and restart them with os.system,
+# with a hard time.sleep(1) after each step. That cost over 3 s on every
+# launch and cut off audio that was running fine. Here a daemon that is
+# already running with the right parameters and answering is reused, and
+# otherwise it is (re)started with subprocess and polled until it is ready.
+
+import os
+import socket
+import subprocess
+import time
+
+
+## The command lines that pi.py needs
+# pigpiod: -t 0 selects the PWM clock, -l only listens on localhost, and
+# -x is the mask of GPIOs that can be updated
+PIGPIOD_COMMAND = [
+    'sudo', 'pigpiod', '-t', '0', '-l', '-x', '1111110000111111111111110000']
+PIGPIOD_PORT = 8888
+
+# jackd: realtime priority 75, at most 16 ports, 2 s client timeout, on the
+# HiFiBerry in playback only (-P), at 192 kHz with 3 periods, softmode (-s)
+JACKD_COMMAND = [
+    'jackd', '-P75', '-p16', '-t2000',
+    '-dalsa', '-dhw:sndrpihifiberry', '-P', '-r192000', '-n3', '-s']
+
+
+def find_processes(process_name):
+    """Return [(pid, argv)] of every running process named `process_name`
+    
+    Zombies (processes that exited but haven't been reaped) are skipped.
+    """
+    found = []
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f'/proc/{entry}/comm') as fi:
+                comm = fi.read().strip()
+            if comm != process_name:
+                continue
+            with open(f'/proc/{entry}/stat') as fi:
+                state = fi.read().rsplit(')', 1)[1].split()[0]
+            if state == 'Z':
+                continue
+            with open(f'/proc/{entry}/cmdline', 'rb') as fi:
+                argv = fi.read().split(b'\0')
+        except OSError:
+            # It exited while we were looking
+            continue
+        found.append((int(entry), [arg.decode() for arg in argv if arg]))
+    return found
+
+
+def port_is_open(port, host='localhost', timeout=0.1):
+    """Return True if something accepts TCP connections on `port`"""
+    try:
+        with socket.create_connection((host, port), timeout=timeout):
+            return True
+    except OSError:
+        return False
+
+
+def jack_server_is_ready():
+    """Return True if a client can be opened on the jack server"""
+    import jack
+    try:
+        client = jack.Client('daemon_probe', no_start_server=True)
+    except jack.JackError:
+        return False
+    client.close()
+    return True
+
+
+class Daemon:
+    """A background process that should be running with a given command.
+
+    `ensure` reuses an instance that has the same arguments and passes
+    `is_ready`, and otherwise stops any other instance and starts a new
+    one. It returns how long each phase took.
+    """
+    def __init__(self, name, command, is_ready, timeout=10.0,
+        poll_interval=0.02, use_sudo_to_stop=False):
+        """Describe a daemon
+
+        Args:
+            name (str): process name, as in /proc/<pid>/comm
+            command (list of str): command line to start it with
+                A leading 'sudo' is ignored when comparing arguments
+            is_ready (callable): returns True once it can be used
+            timeout (float): how long to wait for it to start or stop
+            poll_interval (float): how often to check on it, in seconds
+            use_sudo_to_stop (bool): whether it runs as root
+        """
+        self.name = name
+        self.command = command
+        self.is_ready = is_ready
+        self.timeout = timeout
+        self.poll_interval = poll_interval
+        self.use_sudo_to_stop = use_sudo_to_stop
+
+        # The process we started, if any
+        self.proc = None
+
+    @property
+    def expected_argv(self):
+        """The argv the daemon itself should have, without sudo"""
+        if self.command[0] == 'sudo':
+            return self.command[1:]
+        return self.command
+
+    def matches(self, argv):
+        """Return True if `argv` was started with the same arguments"""
+        return argv[1:] == self.expected_argv[1:]
+
+    def wait_for(self, condition):
+        """Poll `condition` until it is True. Returns False on timeout."""
+        deadline = time.perf_counter() + self.timeout
+        while not condition():
+            if time.perf_counter() > deadline:
+                return False
+            time.sleep(self.poll_interval)
+        return True
+
+    def stop(self, pids):
+        """Stop the processes in `pids` and wait for them to exit"""
+        if self.use_sudo_to_stop:
+            subprocess.run(
+                ['sudo', 'kill'] + [str(pid) for pid in pids], check=False)
+        else:
+            for pid in pids:
+                try:
+                    os.kill(pid, 15)
+                except ProcessLookupError:
+                    pass
+
+        def all_exited():
+            # Reap it if we started it
+            if self.proc is not None:
+                self.proc.poll()
+            running = [pid for pid, argv in find_processes(self.name)]
+            return not any(pid in running for pid in pids)
+
+        if not self.wait_for(all_exited):
+            raise RuntimeError(
+                "{} did not exit within {} s".format(self.name, self.timeout))
+
+    def start(self):
+        """Start the daemon in its own session, so it outlives pi.py"""
+        self.proc = subprocess.Popen(
+            self.command, stdin=subprocess.DEVNULL, start_new_session=True)
+
+    def ensure(self):
+        """Make sure the daemon is running with `command` and ready
+
+        Returns: dict of the time in seconds taken by each phase, and
+        whether a running instance was reused
+        """
+        timings = {'reused': False}
+
+        # Look for running instances
+        start = time.perf_counter()
+        running = find_processes(self.name)
+        healthy = (
+            len(running) == 1 and self.matches(running[0][1]) and
+            self.is_ready())
+        timings['detect'] = time.perf_counter() - start
+
+        if healthy:
+            timings['reused'] = True
+            return timings
+
+        # Stop instances that are unhealthy or have other arguments
+        start = time.perf_counter()
+        if len(running) > 0:
+            self.stop([pid for pid, argv in running])
+        timings['stop'] = time.perf_counter() - start
+
+        # Start a new one and wait until it can be used
+        start = time.perf_counter()
+        self.start()
+        if not self.wait_for(self.is_ready):
+            raise RuntimeError(
+                "{} was not ready within {} s".format(self.name, self.timeout))
+        timings['start'] = time.perf_counter() - start
+
+        return timings
+
+
+def pigpiod_daemon(command=PIGPIOD_COMMAND, port=PIGPIOD_PORT):
+    """Return a Daemon for pigpiod, which is ready when its port is open"""
+    return Daemon('pigpiod', command, lambda: port_is_open(port),
+        use_sudo_to_stop=True)
+
+
+def jackd_daemon(command=JACKD_COMMAND):
+    """Return a Daemon for jackd, which is ready when a client can connect"""
+    return Daemon('jackd', command, jack_server_is_ready)
+
+
+def ensure_daemons(daemons=None, verbose=True):
+    """Ensure that each daemon is running, in order
+
+    Args:
+        daemons (list of Daemon or None): defaults to pigpiod and jackd
+        verbose (bool): whether to print the timings
+
+    Returns: dict of the timings returned by `Daemon.ensure`, by name
+    """
+    if daemons is None:
+        daemons = [pigpiod_daemon(), jackd_daemon()]
+
+    all_timings = {}
+    for daemon in daemons:
+        timings = daemon.ensure()
+        all_timings[daemon.name] = timings
+        if verbose:
+            phases = ", ".join(
+                f"{phase} {duration * 1e3:.0f} ms"
+                for phase, duration in timings.items() if phase != 'reused')
+            action = "reused" if timings['reused'] else "started"
+            print(f"{daemon.name} {action} ({phases})")
+
+    return all_timings
@@ -0,0 +1,210 @@
+## Journal of every event a Pi sends to the GUI
+# If the GUI crashed or the WiFi dropped, the pokes and rewards sent in the
+# meantime were lost, and the GUI's lists were the only record of them.
+# Each Pi now appends every event to a file of fixed-size records before
+# sending it. A record is the time it was sent, the two frames of the event
+# (see event_protocol.py), and a CRC, so a record torn by a crash or power
+# cut is detected and dropped when the file is read.
+#
+# Sequence numbers are assigned here and count records, so the record of
+# event `seq` is at byte seq * RECORD.size. The GUI asks for the events it
+# missed by sequence number, and they are read back with one pread.
+#
+# Appending only packs the record into memory. A background thread writes
+# and fsyncs them in batches, so the poke callbacks never wait for the SD
+# card. A crash loses at most `flush_interval` seconds of the journal.
+#
+# To print a journal:
+#   python -m event_journal journals/rpi27_2024-01-01_12-00-00.events
+
+import argparse
+import os
+import struct
+import threading
+import time
+import zlib
+import event_protocol
+
+
+# Largest payload of any type of event. Shorter ones are padded with zeros.
+PAYLOAD_SIZE = max(payload.size for payload in event_protocol.PAYLOADS.values())
+
+# Time sent (time.time()), header frame, padded payload frame
+BODY = struct.Struct('<d{}s{}s'.format(event_protocol.HEADER.size, PAYLOAD_SIZE))
+
+# CRC32 of the body
+CRC = struct.Struct('<I')
+
+RECORD_SIZE = BODY.size + CRC.size
+
+
+def pack_record(wall_time, frames):
+    """Return the record of an event sent at `wall_time` as `frames`"""
+    body = BODY.pack(wall_time, frames[0], frames[1])
+    return body + CRC.pack(zlib.crc32(body))
+
+
+def parse_records(data):
+    """Return a list of (time sent, Event) of the records in `data`
+
+    Stops at the first record that is torn or corrupt, because nothing
+    after it can be trusted to be at the right offset.
+    """
+    res = []
+    for start in range(0, len(data) - RECORD_SIZE + 1, RECORD_SIZE):
+        body = data[start:start + BODY.size]
+        crc, = CRC.unpack_from(data, start + BODY.size)
+        if zlib.crc32(body) != crc:
+            break
+
+        wall_time, header, payload = BODY.unpack(body)
+        event_type = header[1]
+        payload_size = event_protocol.PAYLOADS[event_type].size
+        res.append((
+            wall_time, event_protocol.decode([header, payload[:payload_size]])))
+    return res
+
+
+def load(path):
+    """Return a list of (time sent, Event) of every intact record in `path`"""
+    with open(path, 'rb') as fi:
+        return parse_records(fi.read())
+
+
+class EventJournal:
+    """Append-only file of the events sent to the GUI.
+
+    `append` can be called from any thread, eg the pigpio callbacks. It
+    numbers the event, and the caller then sends the frames it returns.
+    `read` is called from the main loop to replay events.
+    """
+    def __init__(self, path, flush_interval=0.2, batch_size=256):
+        """Open `path`, creating it and its directory if needed
+
+        If it already exists, events are numbered on from its last intact
+        record, and anything after that record is cut off.
+
+        Args:
+            path (str): file to append to
+            flush_interval (float): longest a record waits to be written
+                and fsynced, in seconds
+            batch_size (int): number of waiting records that triggers a
+                write before `flush_interval` is up
+        """
+        self.path = path
+        self.flush_interval = flush_interval
+        self.batch_size = int(batch_size)
+
+        directory = os.path.dirname(path)
+        if directory != '':
+            os.makedirs(directory, exist_ok=True)
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_APPEND, 0o644)
+
+        # Drop a record that was torn by a crash
+        n_records = len(load(path))
+        os.ftruncate(self.fd, n_records * RECORD_SIZE)
+
+        # Guards `pending`, `n_appended` and `stopped`, and wakes the thread
+        self.cv = threading.Condition()
+
+        # Records not yet written, in order of sequence number
+        self.pending = []
+
+        # Number of records appended, which is the next sequence number,
+        # and number written and fsynced
+        self.n_appended = n_records
+        self.n_written = n_records
+
+        # Held while writing, so that batches are written in order
+        self.write_lock = threading.Lock()
+
+        self.stopped = False
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def append(self, event_type, values, port=0, tick=0):
+        """Number an event and add it to the journal
+
+        The arguments are those of event_protocol.encode, except `seq`.
+        This doesn't touch the disk.
+
+        Returns: (seq, frames), the frames to send
+        """
+        wall_time = time.time()
+        with self.cv:
+            seq = self.n_appended
+            frames = event_protocol.encode(event_type, values, port, tick, seq)
+            self.pending.append(pack_record(wall_time, frames))
+            self.n_appended += 1
+            if len(self.pending) >= self.batch_size:
+                self.cv.notify()
+        return seq, frames
+
+    def next_seq(self):
+        """Return the sequence number the next event will get"""
+        with self.cv:
+            return self.n_appended
+
+    def run(self):
+        """Write and fsync batches of records (journal thread)"""
+        while True:
+            with self.cv:
+                if not self.stopped:
+                    self.cv.wait(self.flush_interval)
+                stopped = self.stopped
+            self.flush()
+            if stopped:
+                return
+
+    def flush(self):
+        """Write every pending record and fsync the file"""
+        with self.write_lock:
+            with self.cv:
+                records, self.pending = self.pending, []
+            if len(records) == 0:
+                return
+
+            data = memoryview(b''.join(records))
+            while len(data) > 0:
+                data = data[os.write(self.fd, data):]
+            os.fsync(self.fd)
+            self.n_written += len(records)
+
+    def read(self, first, last):
+        """Return the Events numbered `first` to `last`, inclusive
+
+        Events not yet written are flushed first. The range is clipped to
+        the events in the journal.
+        """
+        self.flush()
+        first = max(first, 0)
+        last = min(last, self.n_written - 1)
+        if last < first:
+            return []
+
+        data = os.pread(
+            self.fd, (last - first + 1) * RECORD_SIZE, first * RECORD_SIZE)
+        return [event for wall_time, event in parse_records(data)]
+
+    def close(self):
+        """Write what is pending, stop the thread, and close the file"""
+        if self.stopped:
+            return
+        with self.cv:
+            self.stopped = True
+            self.cv.notify()
+        self.thread.join()
+        os.close(self.fd)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Print an event journal")
+    parser.add_argument('path')
+    args = parser.parse_args()
+
+    print(f"{'seq':>8} {'time sent':>17} {'type':>11} {'port':>4} {'tick':>10}  values")
+    for wall_time, event in load(args.path):
+        print(
+            f"{event.seq:>8} {wall_time:>17.6f} "
+            f"{event_protocol.NAMES[event.type]:>11} {event.port:>4} "
+            f"{event.tick:>10}  {event.values}")
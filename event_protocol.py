@@ -0,0 +1,133 @@
+## Binary messages for pokes and other events between the Pis and the GUI
+# Text messages like "Poke - Port: 5, Tick: 123, Time: 1700000000.123456"
+# cost 50 or more bytes and a string split per field to parse, and anything
+# that didn't parse fell through to "Unknown message". Here each event is
+# two zmq frames: a fixed 12-byte header, and a payload whose layout
+# depends on the type of event. The GUI dispatches on the type.
+#
+# Messages that are not events (the identity, parameters, audio stats,
+# sound onsets, and the commands from the GUI) are still single strings.
+# They are told apart by their number of frames.
+
+import collections
+import struct
+
+
+# Bump this whenever HEADER or any payload changes
+PROTOCOL_VERSION = 3
+
+## Types of event
+# The beam was broken. Payload: time on the GUI's clock, or NaN if the
+# Pi's clock isn't synchronized yet
+POKE = 1
+
+# Ping to estimate the offset between the clocks (see clock_sync.py)
+# Payload: t0, when the Pi sent it, in its own seconds
+# Pings are not journaled, and their `seq` is instead the number of events
+# the Pi has journaled so far, so that the GUI notices any it missed
+CLOCK_PING = 2
+
+# Reply to a CLOCK_PING, with the same seq. Payload: t0, and t1 and t2,
+# when the GUI received the ping and replied, on its clock
+CLOCK_REPLY = 3
+
+# A trial was rewarded. Payload: who decided (an index into DECIDED_BY),
+# and the time from the poke to the valve opening in milliseconds
+REWARD = 4
+
+DECIDED_BY = ['pi', 'gui']
+
+# A sound started playing. Payload: time on the GUI's clock, the side (an
+# index into SIDES), and the jack frame time it was played at
+SOUND_ONSET = 5
+
+SIDES = ['left', 'right']
+
+# A valve was opened, whether for a reward or not. Payload: time on the
+# GUI's clock (or NaN, like POKE), and how long it is open in milliseconds
+VALVE = 6
+
+# The LEDs were flashed. Payload: like VALVE
+LED_FLASH = 7
+
+# Names of the types, for logs
+NAMES = {
+    POKE: 'poke',
+    CLOCK_PING: 'clock ping',
+    CLOCK_REPLY: 'clock reply',
+    REWARD: 'reward',
+    SOUND_ONSET: 'sound onset',
+    VALVE: 'valve',
+    LED_FLASH: 'led flash',
+    }
+
+## Flags
+# The event is being sent again from the Pi's journal, because the GUI
+# asked for it after missing it (see event_journal.py)
+REPLAYED = 1
+
+## Layout of the frames
+# First frame: version, type, port, flags, pigpio tick, sequence number
+# `port` is 0 for events that don't have one, and `tick` is the pigpio
+# tick of the event, or 0. `seq` counts every event sent by a Pi.
+HEADER = struct.Struct('<BBBBII')
+
+# Second frame, by type
+PAYLOADS = {
+    POKE: struct.Struct('<d'),
+    CLOCK_PING: struct.Struct('<d'),
+    CLOCK_REPLY: struct.Struct('<ddd'),
+    REWARD: struct.Struct('<Bf'),
+    SOUND_ONSET: struct.Struct('<dBq'),
+    VALVE: struct.Struct('<df'),
+    LED_FLASH: struct.Struct('<df'),
+    }
+
+Event = collections.namedtuple(
+    'Event', ['type', 'port', 'tick', 'seq', 'values', 'flags'], defaults=[0])
+
+
+class ProtocolError(ValueError):
+    """Raised when frames are not an event this version understands"""
+
+
+def encode(event_type, values, port=0, tick=0, seq=0, flags=0):
+    """Return the frames of an event, to be sent with send_multipart
+
+    Args:
+        event_type (int): one of the types above
+        values (tuple): the fields of its payload
+        port (int): port number, 0-255
+        tick (int): pigpio tick, which is 32 bits and wraps
+        seq (int): sequence number, which wraps at 32 bits
+        flags (int): any of the flags above, or'ed together
+    """
+    return [
+        HEADER.pack(PROTOCOL_VERSION, event_type, port, flags,
+            tick & 0xFFFFFFFF, seq & 0xFFFFFFFF),
+        PAYLOADS[event_type].pack(*values),
+        ]
+
+
+def decode(frames):
+    """Return the Event in `frames`, as returned by `encode`
+
+    Raises ProtocolError if they aren't one.
+    """
+    if len(frames) != 2 or len(frames[0]) != HEADER.size:
+        raise ProtocolError("not an event: {} frames".format(len(frames)))
+
+    version, event_type, port, flags, tick, seq = HEADER.unpack(frames[0])
+    if version != PROTOCOL_VERSION:
+        raise ProtocolError(
+            "event is version {}, expected {}".format(version, PROTOCOL_VERSION))
+
+    payload = PAYLOADS.get(event_type)
+    if payload is None:
+        raise ProtocolError("unknown event type {}".format(event_type))
+    if len(frames[1]) != payload.size:
+        raise ProtocolError(
+            "payload of event type {} is {} bytes, expected {}".format(
+            event_type, len(frames[1]), payload.size))
+
+    return Event(event_type, port, tick, seq, payload.unpack(frames[1]), flags)
@@ -5,6 +5,10 @@
 # Put the ones that run the GUI in another script and import them here
 
 
+# Start timing before the slow imports, see --profile-startup
+from startup_profile import StartupProfiler
+startup_profiler = StartupProfiler()
+
 # Importing necessary libraries
 import sys
 import zmq
@@ -23,23 +27,38 @@ from PyQt5.QtWidgets import QMenu, QAction, QComboBox, QGroupBox, QMessageBox, Q
 from PyQt5.QtCore import QPointF, QTimer, QTime, pyqtSignal, QObject, QThread, pyqtSlot,  QMetaObject, Qt
 from PyQt5.QtGui import QFont, QColor
 from pyqttoast import Toast, ToastPreset
-
-# Set up argument parsing to select box
-parser = argparse.ArgumentParser(description="Load parameters for a specific box.")
-parser.add_argument('json_filename', type=str, help="The name of the JSON file (without 'configs/' and '.json')")
-
-# Parse arguments
-args = parser.parse_args()
-
-# Constructing the full path to the config file
-param_directory = f"gui/configs/{args.json_filename}.json"
-
-# Load the parameters from the specified JSON file
-with open(param_directory, "r") as p:
-    params = json.load(p)
-
-# Fetching all the ports to use for the trials    
-active_nosepokes = [int(i) for i in params['active_nosepokes']]
+import event_protocol
+startup_profiler.mark('imports')
+
+# Command line arguments and the parameters of the box, set by `load_params`
+# They are loaded when the GUI is run rather than on import, so that this
+# module can be imported (eg to profile it) without a box config
+args = None
+params = None
+active_nosepokes = None
+
+def load_params(argv=None):
+    """Parse the command line and load the config of the selected box"""
+    global args, params, active_nosepokes
+    
+    # Set up argument parsing to select box
+    parser = argparse.ArgumentParser(description="Load parameters for a specific box.")
+    parser.add_argument('json_filename', type=str, help="The name of the JSON file (without 'configs/' and '.json')")
+    parser.add_argument('--profile-startup', action='store_true',
+        help="print how long each phase of starting up took")
+    
+    # Parse arguments
+    args = parser.parse_args(argv)
+    
+    # Constructing the full path to the config file
+    param_directory = f"gui/configs/{args.json_filename}.json"
+    
+    # Load the parameters from the specified JSON file
+    with open(param_directory, "r") as p:
+        params = json.load(p)
+    
+    # Fetching all the ports to use for the trials    
+    active_nosepokes = [int(i) for i in params['active_nosepokes']]
 
 # Variable to keep track of the current task
 current_task = None
@@ -146,6 +165,24 @@ class Worker(QObject):
         self.index = None
         self.poked_port_numbers = self.pi_widget.poked_port_numbers 
         self.identities = set()
+        self.audio_stats = {}  # Latest audio callback stats from each Pi
+        self.sound_onsets = []  # (pi, time on our clock, side, frame time) of every sound played
+        self.actuations = []  # (pi, time, type, port, duration ms) of every valve opening and LED flash
+        self.reward_latencies = []  # (pi, time, port, decided by, poke-to-valve ms) of every reward
+        
+        # Handlers of each type of binary event from the Pis
+        # See event_protocol.py
+        self.event_handlers = {
+            event_protocol.POKE: self.handle_poke_event,
+            event_protocol.CLOCK_PING: self.handle_clock_ping,
+            event_protocol.REWARD: self.handle_reward_event,
+            event_protocol.SOUND_ONSET: self.handle_sound_onset_event,
+            event_protocol.VALVE: self.handle_actuation_event,
+            event_protocol.LED_FLASH: self.handle_actuation_event,
+        }
+        self.next_event_seqs = {}  # Sequence number expected next from each Pi
+        self.missing_event_seqs = {}  # Sequence numbers asked for again from each Pi, and not received yet
+        self.recovered_events = []  # (pi, seq, type, port, tick, values) of every event replayed from a journal
         self.last_poke_timestamp = None  # Attribute to store the timestamp of the last poke event
         self.reward_port = None
         self.last_rewarded_port = None
@@ -212,6 +249,12 @@ class Worker(QObject):
         self.target_temporal_log_stds.clear()
         self.center_freqs.clear()
         self.unique_ports_visited.clear()
+        self.sound_onsets.clear()
+        self.actuations.clear()
+        self.reward_latencies.clear()
+        self.next_event_seqs.clear()
+        self.missing_event_seqs.clear()
+        self.recovered_events.clear()
         self.identities.clear()
         self.last_poke_timestamp = None
         self.reward_port = None
@@ -250,19 +293,70 @@ class Worker(QObject):
 
         try:
             # Receive message from the socket
-            identity, message = self.socket.recv_multipart()
+            frames = self.socket.recv_multipart()
+            receive_time = time.time()
+            identity = frames[0]
+            is_new_identity = identity not in self.identities
             self.identities.add(identity)
-            message_str = message.decode('utf-8')
+            
+            # Binary events (pokes, clock pings, rewards, sound onsets,
+            # valves and LEDs) have two frames after the identity, and are
+            # dispatched by type
+            if len(frames) == 3:
+                try:
+                    event = event_protocol.decode(frames[1:])
+                except event_protocol.ProtocolError as e:
+                    print_out("Bad event from", identity.decode('utf-8'), e)
+                    return
+                
+                # Events we missed and asked for again are only recorded,
+                # because the task has moved on since
+                if event.flags & event_protocol.REPLAYED:
+                    self.record_replayed_event(identity, event)
+                    return
+                
+                # A clock ping isn't journaled, and carries the number of
+                # events journaled before it instead
+                if event.type == event_protocol.CLOCK_PING:
+                    self.request_events_before(identity, event.seq)
+                else:
+                    self.request_missed_events(identity, event.seq)
+                handler = self.event_handlers.get(event.type)
+                if handler is None:
+                    print_out("Unexpected event from", identity.decode('utf-8'), 
+                        event_protocol.NAMES.get(event.type, event.type))
+                    return
+                handler(identity, event, receive_time, elapsed_time)
+                return
+            
+            message_str = frames[1].decode('utf-8')
             
             # Message to signal if pis are connected
             if "rpi" in message_str:
                 print_out("Connected to Raspberry Pi:", message_str)
+                
+                # The Pi sends this when it starts, with a new journal whose
+                # numbers start over, or between its sessions, when it
+                # sends no events. Either way, start counting again.
+                self.forget_event_seqs(identity)
+                
+                # A Pi in agent mode announces itself repeatedly between
+                # sessions, and only the first one should start a trial
+                if not is_new_identity:
+                    return
             
             # Message to stop updates if the session is stopped
             if message_str.strip().lower() == "stop":
                 print_out("Received 'stop' message, aborting update.")
                 return
             
+            # Periodic report on the Pi's audio callback
+            # This is not a poke, so the reward port is not resent
+            if message_str.startswith("Audio Stats"):
+                self.audio_stats[identity] = message_str
+                print_out(identity.decode('utf-8'), message_str)
+                return
+            
             # Sending the initial message to start the loop
             self.socket.send_multipart([identity, bytes(f"Reward Port: {self.reward_port}", 'utf-8')])
 
@@ -292,74 +386,204 @@ class Worker(QObject):
                 self.current_bandwidth = float(params.get("Bandwidth", "0"))
 
             else:
-                poked_port = int(message_str)
-                # Check if the poked port is the same as the last rewarded port
-                if poked_port == self.last_rewarded_port:
-                     # If it is, do nothing and return
-                        return
-
-                if 1 <= poked_port <= self.total_ports:
-                    poked_port_index = self.label_to_index.get(message_str)
-                    poked_port_signal = self.Pi_signals[poked_port_index]
-
-                    if poked_port == self.reward_port:
-                        color = "green" if self.trials == 0 else "blue"
-                        if self.trials > 0:
-                            self.trials = 0
-                    else:
-                        color = "red"
-                        self.trials += 1
-                        self.current_poke += 1
-
-                    poked_port_signal.set_color(color)
-                    self.poked_port_numbers.append(poked_port)
-                    print_out("Sequence:", self.poked_port_numbers)
-                    self.last_pi_received = identity
-
-                    self.pokedportsignal.emit(poked_port, color)
-                    self.reward_ports.append(self.reward_port)
-                    self.update_unique_ports()
-                    
-
-                    if color == "green" or color == "blue":
-                        self.current_poke += 1
-                        self.current_completed_trials += 1
-                        for identity in self.identities:
-                            self.socket.send_multipart([identity, bytes(f"Reward Poke Completed: {self.reward_port}", 'utf-8]')])
-                        self.last_rewarded_port = self.reward_port   
-                        self.reward_port = self.choose()
-                        self.trials = 0
-                        print_out(f"Reward Port: {self.reward_port}")
-                        if color == "green":
-                            self.current_correct_trials += 1 
-                            self.current_fraction_correct = self.current_correct_trials / self.current_completed_trials
-
-                        index = self.index_to_label.get(poked_port_index)
-                        
-                        # Reset color of all non-reward ports to gray and reward port to green
-                        for index, Pi in enumerate(self.Pi_signals):
-                            if index + 1 == self.reward_port:
-                                Pi.set_color("green")
-                            else:
-                                Pi.set_color("gray")
-
-                        for identity in self.identities:
-                            self.socket.send_multipart([identity, bytes(f"Reward Port: {self.reward_port}", 'utf-8')])
-                            
-                    
-                    self.pokes.append(self.current_poke)
-                    self.timestamps.append(elapsed_time)
-                    self.amplitudes.append(self.current_amplitude)
-                    self.target_rates.append(self.current_target_rate)
-                    self.target_temporal_log_stds.append(self.current_target_temporal_log_std)
-                    self.center_freqs.append(self.current_center_freq)
-                    self.completed_trials.append(self.current_completed_trials)
-                    self.correct_trials.append(self.current_correct_trials)
-                    self.fc.append(self.current_fraction_correct)
+                # A bare port number, from Pis older than event_protocol.py
+                # These are stamped with the time they were received
+                self.handle_poke(identity, int(message_str), elapsed_time)
         
         except ValueError:
             pass
             #print_out("Unknown message:", message_str)
+
+    # Method to handle a POKE event
+    def handle_poke_event(self, identity, event, receive_time, elapsed_time):
+        # Sending the initial message to start the loop
+        self.socket.send_multipart([identity, bytes(f"Reward Port: {self.reward_port}", 'utf-8')])
+        
+        # Pokes are stamped with the time of the beam break, on our clock,
+        # once the Pi's clock is synchronized, and otherwise with the time
+        # they were received
+        gui_time, = event.values
+        self.handle_poke(
+            identity, event.port, self.event_elapsed(gui_time, elapsed_time))
+    
+    # Method to return the time since the start of an event stamped with
+    # `gui_time` on our clock, or `elapsed_time`, when it was received, if
+    # the Pi wasn't synchronized yet and sent NaN
+    def event_elapsed(self, gui_time, elapsed_time):
+        if math.isnan(gui_time):
+            return elapsed_time
+        return datetime.fromtimestamp(gui_time) - self.initial_time
+    
+    # Method to reply to a CLOCK_PING event
+    # The Pi uses these to estimate the offset between its clock and ours
+    # Reply right away with when it was received and replied to
+    def handle_clock_ping(self, identity, event, receive_time, elapsed_time):
+        t0, = event.values
+        reply = event_protocol.encode(event_protocol.CLOCK_REPLY, 
+            (t0, receive_time, time.time()), seq=event.seq)
+        self.socket.send_multipart([identity] + reply)
+    
+    # Method to log a REWARD event: how long after a rewarded poke the
+    # valve opened on the Pi
+    # The Pi already opened it, so the reward port is not resent
+    def handle_reward_event(self, identity, event, receive_time, elapsed_time):
+        decided_by, latency_ms = event.values
+        decided_by = event_protocol.DECIDED_BY[decided_by]
+        self.reward_latencies.append((
+            identity.decode('utf-8'), elapsed_time.total_seconds(), 
+            event.port, decided_by, latency_ms))
+        print_out(identity.decode('utf-8'), 
+            f"Reward at port {event.port} decided by {decided_by}, "
+            f"{latency_ms:.2f} ms after the poke")
+    
+    # Method to log a SOUND_ONSET event, for the onset log
+    # The Pi only sends these once it is synchronized, so the time is
+    # always on our clock
+    # This is not a poke, so the reward port is not resent
+    def handle_sound_onset_event(self, identity, event, receive_time, elapsed_time):
+        gui_time, side, frame_time = event.values
+        self.sound_onsets.append((
+            identity.decode('utf-8'), gui_time, event_protocol.SIDES[side], 
+            frame_time))
+    
+    # Method to log a VALVE or LED_FLASH event: when it started, and for
+    # how long
+    def handle_actuation_event(self, identity, event, receive_time, elapsed_time):
+        gui_time, duration_ms = event.values
+        self.actuations.append((
+            identity.decode('utf-8'), 
+            self.event_elapsed(gui_time, elapsed_time).total_seconds(), 
+            event_protocol.NAMES[event.type], event.port, duration_ms))
+    
+    # Method to ask a Pi to replay events that never arrived
+    # Each Pi numbers its events, so a jump in the numbers means that some
+    # were lost (eg the WiFi dropped), and the Pi still has them in its
+    # journal. Clock pings keep coming during a session, so a gap is noticed
+    # within a second or so even if no one pokes.
+    # Events can arrive a little out of order, because the Pi numbers the
+    # pokes on its callback thread and the rest on its main loop
+    def request_missed_events(self, identity, seq):
+        expected = self.next_event_seqs.get(identity)
+        missing = self.missing_event_seqs.setdefault(identity, set())
+        
+        if expected is None:
+            self.next_event_seqs[identity] = seq + 1
+            return
+        
+        # A late event, which may already have been asked for
+        if seq < expected:
+            missing.discard(seq)
+            return
+        
+        self.request_events_before(identity, seq)
+        self.next_event_seqs[identity] = seq + 1
+    
+    # Method to ask a Pi again for every event from the one expected next
+    # up to, but not including, `seq`
+    def request_events_before(self, identity, seq):
+        expected = self.next_event_seqs.get(identity)
+        if expected is None:
+            self.next_event_seqs[identity] = seq
+            return
+        if seq <= expected:
+            return
+        
+        self.missing_event_seqs.setdefault(identity, set()).update(
+            range(expected, seq))
+        print_out(identity.decode('utf-8'), 
+            f"Missed events {expected} to {seq - 1}, asking for them again")
+        self.socket.send_multipart([identity, 
+            bytes(f"Replay Events: {expected} {seq - 1}", 'utf-8')])
+        self.next_event_seqs[identity] = seq
+    
+    # Method to forget the sequence numbers of a Pi, eg after it restarted
+    def forget_event_seqs(self, identity):
+        self.next_event_seqs.pop(identity, None)
+        self.missing_event_seqs.pop(identity, None)
+    
+    # Method to record an event that a Pi replayed from its journal
+    # Pokes carry their time on our clock, or NaN if the Pi wasn't
+    # synchronized yet. Rewards carry their latency.
+    # Replays of events that arrived late, after all, are dropped
+    def record_replayed_event(self, identity, event):
+        missing = self.missing_event_seqs.get(identity, set())
+        if event.seq not in missing:
+            return
+        missing.discard(event.seq)
+        
+        pi_name = identity.decode('utf-8')
+        self.recovered_events.append((
+            pi_name, event.seq, event_protocol.NAMES[event.type], 
+            event.port, event.tick, event.values))
+        print_out(pi_name, 
+            f"Recovered {event_protocol.NAMES[event.type]} {event.seq} "
+            f"at port {event.port}")
+    
+    # Method to update the task after a poke on `poked_port`
+    def handle_poke(self, identity, poked_port, poke_elapsed):
+        # Check if the poked port is the same as the last rewarded port
+        if poked_port == self.last_rewarded_port:
+             # If it is, do nothing and return
+                return
+
+        if 1 <= poked_port <= self.total_ports:
+            poked_port_index = self.label_to_index.get(str(poked_port))
+            poked_port_signal = self.Pi_signals[poked_port_index]
+
+            if poked_port == self.reward_port:
+                color = "green" if self.trials == 0 else "blue"
+                if self.trials > 0:
+                    self.trials = 0
+            else:
+                color = "red"
+                self.trials += 1
+                self.current_poke += 1
+
+            poked_port_signal.set_color(color)
+            self.poked_port_numbers.append(poked_port)
+            print_out("Sequence:", self.poked_port_numbers)
+            self.last_pi_received = identity
+
+            self.pokedportsignal.emit(poked_port, color)
+            self.reward_ports.append(self.reward_port)
+            self.update_unique_ports()
+
+
+            if color == "green" or color == "blue":
+                self.current_poke += 1
+                self.current_completed_trials += 1
+                for identity in self.identities:
+                    self.socket.send_multipart([identity, bytes(f"Reward Poke Completed: {self.reward_port}", 'utf-8]')])
+                self.last_rewarded_port = self.reward_port   
+                self.reward_port = self.choose()
+                self.trials = 0
+                print_out(f"Reward Port: {self.reward_port}")
+                if color == "green":
+                    self.current_correct_trials += 1 
+                    self.current_fraction_correct = self.current_correct_trials / self.current_completed_trials
+
+                index = self.index_to_label.get(poked_port_index)
+
+                # Reset color of all non-reward ports to gray and reward port to green
+                for index, Pi in enumerate(self.Pi_signals):
+                    if index + 1 == self.reward_port:
+                        Pi.set_color("green")
+                    else:
+                        Pi.set_color("gray")
+
+                for identity in self.identities:
+                    self.socket.send_multipart([identity, bytes(f"Reward Port: {self.reward_port}", 'utf-8')])
+
+
+            self.pokes.append(self.current_poke)
+            self.timestamps.append(poke_elapsed)
+            self.amplitudes.append(self.current_amplitude)
+            self.target_rates.append(self.current_target_rate)
+            self.target_temporal_log_stds.append(self.current_target_temporal_log_std)
+            self.center_freqs.append(self.current_center_freq)
+            self.completed_trials.append(self.current_completed_trials)
+            self.correct_trials.append(self.current_correct_trials)
+            self.fc.append(self.current_fraction_correct)
             
     
    # Method to save results to a CSV file
@@ -380,6 +604,43 @@ class Worker(QObject):
                 self.pokes, self.timestamps, self.poked_port_numbers, self.reward_ports, self.completed_trials, self.correct_trials, self.fc, self.amplitudes, self.target_rates, self.target_temporal_log_stds, self.center_freqs):
                 writer.writerow([poke, timestamp, poked_port, reward_port, completed_trial, correct_trial, fc, amplitude, target_rate, target_temporal_log_std, center_freq])
 
+        # Save the time of every sound next to the pokes
+        # Each Pi sends them on our clock, like the pokes, so both are
+        # relative to the same start on the same clock
+        onsets_filename = f"{current_task}_{current_time}_sound_onsets.csv"
+        start_timestamp = self.initial_time.timestamp() if self.initial_time is not None else 0
+        with open(f"{save_directory}/{onsets_filename}", 'w', newline='') as csvfile:
+            writer = csv.writer(csvfile)
+            writer.writerow(["Pi", "Onset Timestamp (seconds)", "Onset Wall Clock (seconds)", "Side", "JACK Frame Time"])
+            for pi_name, wall_time, side, frame_time in self.sound_onsets:
+                writer.writerow([pi_name, wall_time - start_timestamp, wall_time, side, frame_time])
+
+        # Save when every valve opened and the LEDs flashed, and for how long
+        actuations_filename = f"{current_task}_{current_time}_actuations.csv"
+        with open(f"{save_directory}/{actuations_filename}", 'w', newline='') as csvfile:
+            writer = csv.writer(csvfile)
+            writer.writerow(["Pi", "Timestamp (seconds)", "Type", "Port", "Duration (ms)"])
+            for row in self.actuations:
+                writer.writerow(row)
+
+        # Save the poke-to-water latency of every reward
+        latency_filename = f"{current_task}_{current_time}_reward_latency.csv"
+        with open(f"{save_directory}/{latency_filename}", 'w', newline='') as csvfile:
+            writer = csv.writer(csvfile)
+            writer.writerow(["Pi", "Reward Timestamp (seconds)", "Port", "Decided By", "Poke to Valve (ms)"])
+            for row in self.reward_latencies:
+                writer.writerow(row)
+
+        # Save the events that were lost on the way and replayed from the
+        # Pis' journals, which are not in the files above
+        if len(self.recovered_events) > 0:
+            recovered_filename = f"{current_task}_{current_time}_recovered_events.csv"
+            with open(f"{save_directory}/{recovered_filename}", 'w', newline='') as csvfile:
+                writer = csv.writer(csvfile)
+                writer.writerow(["Pi", "Seq", "Type", "Port", "Tick", "Values"])
+                for pi_name, seq, event_name, port, tick, values in self.recovered_events:
+                    writer.writerow([pi_name, seq, event_name, port, tick, " ".join(str(value) for value in values)])
+
         print_out(f"Results saved to logs")
     
     # Method to send start message to the pi
@@ -980,6 +1241,11 @@ class ConfigurationDialog(QDialog):
             "bandwidth": bandwidth,
             "reward_value": reward_value
         }
+        
+        # Carry over the optional keys that can't be edited here
+        for key in ["sound_mode", "sound_mixing", "noise_backend", "noise_bank", "seed"]:
+            if key in self.config:
+                updated_config[key] = self.config[key]
 
         return updated_config
 
@@ -1286,8 +1552,32 @@ class MainWindow(QtWidgets.QMainWindow):
             self.Pi_widget.worker.socket.send_multipart([identity, b"exit"])
         event.accept()
 
+def report_ready():
+    """Print how long it took until the event loop started"""
+    startup_profiler.mark('first event')
+    print(f"Ready {startup_profiler.total():.2f} s after launch")
+    if args.profile_startup:
+        print(startup_profiler.report())
+
 # Running the GUI
-if __name__ == '__main__':
+def main(argv=None):
+    load_params(argv)
+    startup_profiler.mark('config')
+    
     app = QApplication(sys.argv)
+    startup_profiler.mark('qt app')
+    
+    # The window has no parent, so this reference is what keeps it from
+    # being garbage collected while the event loop runs
     main_window = MainWindow()
-    sys.exit(app.exec())
+    startup_profiler.mark('window')
+    
+    # Runs once the event loop has started and the window is shown
+    QTimer.singleShot(0, report_ready)
+    
+    exit_code = app.exec()
+    del main_window
+    return exit_code
+
+if __name__ == '__main__':
+    sys.exit(main())
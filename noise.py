@@ -0,0 +1,679 @@
+## Bandpass filtered white noise bursts
+# These are the stimuli played by SoundQueue in pi.py. Building a Noise
+# means drawing random samples, designing two Butterworth filters and
+# running filtfilt twice, so NoiseCache keeps recently built ones around.
+# scipy is slow to import, so it is only imported when a filter is needed.
+
+import collections
+import os
+import threading
+import numpy as np
+
+
+class CalibrationCurve:
+    """Attenuation in dB as a function of frequency, for a speaker.
+    
+    The attenuation is applied in the frequency domain, which needs its
+    value at every rFFT bin of the sound. Interpolating onto the bins only
+    depends on the sampling rate and the length of the sound, so the gain
+    on the bins is computed once per (fs, nsamples) and cached.
+    """
+    def __init__(self, freqs, atten):
+        """Initialize from arrays of frequencies (Hz) and attenuation (dB)"""
+        order = np.argsort(freqs)
+        self.freqs = np.asarray(freqs, dtype=float)[order]
+        self.atten = np.asarray(atten, dtype=float)[order]
+        
+        # Gain on the rFFT bins, keyed by (fs, nsamples)
+        self.gains = {}
+        self.lock = threading.Lock()
+    
+    def gain(self, fs, nsamples):
+        """Return the linear gain on each bin of np.fft.rfft(nsamples)"""
+        key = (int(fs), int(nsamples))
+        with self.lock:
+            gain = self.gains.get(key)
+            if gain is None:
+                bin_freqs = np.fft.rfftfreq(key[1], 1 / key[0])
+                atten = np.interp(bin_freqs, self.freqs, self.atten)
+                gain = 10 ** (-atten / 20)
+                gain.flags.writeable = False
+                self.gains[key] = gain
+        return gain
+
+
+def bandpass_noise(n_bursts, nsamples, fs, highpass=None, lowpass=None, 
+    rng=None):
+    """Synthesize bandpass noise directly in the frequency domain
+    
+    Every rFFT bin between `highpass` and `lowpass` gets magnitude 1 and a
+    random phase, every other bin is zero, and all of the bursts are made
+    by a single irfft. There is no filter to design or run, so the cost
+    does not depend on the band.
+    
+    Each burst is scaled to the rms that uniform white noise on [-1, 1]
+    would have after an ideal filter with the same band. The 'butter'
+    backend loses more power at its gentler band edges, so for a 3 kHz
+    band the same `amplitude` is about 3 dB louder with this backend.
+    
+    Args:
+        n_bursts (int): number of independent bursts
+        nsamples (int): length of each burst
+        fs (int): sampling rate
+        highpass, lowpass (float or None): edges of the band in Hz
+            If None, the band extends to DC or to Nyquist
+        rng (np.random.Generator or None): where to draw phases from
+    
+    Returns: array of shape (n_bursts, nsamples)
+    """
+    if rng is None:
+        rng = np.random.default_rng()
+    
+    # Bins in the band, never including DC or Nyquist
+    bin_freqs = np.fft.rfftfreq(nsamples, 1 / fs)
+    in_band = np.ones(len(bin_freqs), dtype=bool)
+    if highpass is not None:
+        in_band &= bin_freqs >= highpass
+    if lowpass is not None:
+        in_band &= bin_freqs <= lowpass
+    in_band[0] = False
+    if nsamples % 2 == 0:
+        in_band[-1] = False
+    n_bins = int(in_band.sum())
+    if n_bins == 0:
+        return np.zeros((n_bursts, nsamples))
+    
+    # Random phases in the band
+    spectrum = np.zeros((n_bursts, len(bin_freqs)), dtype=complex)
+    spectrum[:, in_band] = np.exp(2j * np.pi * rng.random((n_bursts, n_bins)))
+    data = np.fft.irfft(spectrum, n=nsamples, axis=1)
+    
+    # Each bin adds 2 / nsamples ** 2 to the mean square
+    # Uniform white noise has a mean square of 1 / 3, spread over every bin
+    rms = np.sqrt(2 * n_bins) / nsamples
+    target_rms = np.sqrt(n_bins / (3 * (len(bin_freqs) - 1)))
+    return data * (target_rms / rms)
+
+def butter_bandpass(data, fs, highpass=None, lowpass=None):
+    """Bandpass `data` with 2nd order Butterworth filters run by filtfilt
+    
+    scipy.signal takes over a second to import on a Pi, so it is only
+    imported the first time this is called.
+    """
+    import scipy.signal
+    
+    # Highpass filter it
+    if highpass is not None:
+        bhi, ahi = scipy.signal.butter(2, highpass / (fs / 2), 'high')
+        data = scipy.signal.filtfilt(bhi, ahi, data)
+    
+    # Lowpass filter it
+    if lowpass is not None:
+        blo, alo = scipy.signal.butter(2, lowpass / (fs / 2), 'low')
+        data = scipy.signal.filtfilt(blo, alo, data)
+    
+    return data
+
+def make_noise_batch(n_bursts, blocksize=1024, fs=192000, duration=0.01, 
+    rng=None, channels=None, **kwargs):
+    """Return `n_bursts` Noise objects, synthesized in one vectorized call
+    
+    This uses `bandpass_noise`, so eg every burst of a session can be
+    rendered up front. NoiseCache uses it to build the left and right
+    bursts of a trial together. If `channels` is given, it is the channel
+    of each burst. The other keyword arguments are passed to Noise.
+    """
+    if channels is None:
+        channels = [kwargs.pop('channel', None)] * n_bursts
+    nsamples = int(np.rint(duration * fs))
+    data = bandpass_noise(n_bursts, nsamples, fs, 
+        highpass=kwargs.get('highpass'), lowpass=kwargs.get('lowpass'), rng=rng)
+    return [
+        Noise(blocksize, fs, duration=duration, channel=channel, 
+            backend='fft', data=row, **kwargs)
+        for channel, row in zip(channels, data)]
+
+
+# Curves that have been loaded, keyed by path and modification time
+_calibration_curves = {}
+_calibration_lock = threading.Lock()
+
+def load_calibration(attenuation_file):
+    """Load a CalibrationCurve from a csv with 'freq' and 'atten' columns
+    
+    Each file is only read once, unless it is modified.
+    """
+    key = (attenuation_file, os.path.getmtime(attenuation_file))
+    with _calibration_lock:
+        curve = _calibration_curves.get(key)
+        if curve is None:
+            data = np.genfromtxt(attenuation_file, delimiter=',', names=True)
+            curve = CalibrationCurve(data['freq'], data['atten'])
+            _calibration_curves[key] = curve
+    return curve
+
+def apply_attenuation(sound, attenuation, fs):
+    """Attenuate each column of `sound` by `attenuation` (a CalibrationCurve)
+    
+    All columns go through a single rfft and irfft.
+    
+    Returns: the attenuated sound, with the same shape as `sound`
+    """
+    nsamples = sound.shape[0]
+    gain = attenuation.gain(fs, nsamples)
+    if sound.ndim == 2:
+        gain = gain[:, None]
+    spectrum = np.fft.rfft(sound, axis=0)
+    spectrum *= gain
+    return np.fft.irfft(spectrum, n=nsamples, axis=0)
+
+class Noise:
+    """Class to define bandpass filtered white noise."""
+    def __init__(self, blocksize=1024, fs=192000, duration = 0.01, amplitude=0.01, channel=None, 
+        highpass=None, lowpass=None, attenuation_file=None, backend='butter', 
+        data=None, **kwargs):
+        """Initialize a new white noise burst with specified parameters.
+        
+        The sound itself is stored as the attribute `self.table`. This can
+        be 1-dimensional or 2-dimensional, depending on `channel`. If it is
+        2-dimensional, then each channel is a column.
+        
+        Args:
+            duration (float): duration of the noise
+            amplitude (float): amplitude of the sound as a proportion of 1.
+            channel (int or None): which channel should be used
+                If 0, play noise from the first channel
+                If 1, play noise from the second channel
+                If None, send the same information to all channels ("mono")
+            highpass (float or None): highpass the Noise above this value
+                If None, no highpass is applied
+            lowpass (float or None): lowpass the Noise below this value
+                If None, no lowpass is applied       
+            attenuation_file (string or None)
+                Path to a csv of attenuation in dB ('atten') by frequency
+                ('freq'), see `load_calibration`
+            backend (string): how the noise is bandpassed
+                'butter': Butterworth filters run with filtfilt
+                'fft': synthesized in the frequency domain, see `bandpass_noise`
+            data (array or None): the noise before amplitude and attenuation
+                are applied, if it was already generated, eg by
+                `make_noise_batch`. If None, it is generated by `backend`.
+            **kwargs: extraneous parameters that might come along with instantiating us
+        """
+        # Set duraiton and amplitude as float
+        self.backend = backend
+        self.blocksize = blocksize
+        self.fs = fs
+        self.duration = float(duration)
+        self.amplitude = float(amplitude)
+        
+        # Save optional parameters - highpass, lowpass, channel
+        if highpass is None:
+            self.highpass = None
+        else:
+            self.highpass = float(highpass)
+        
+        if lowpass is None:
+            self.lowpass = None
+        else:
+            self.lowpass = float(lowpass)
+        
+        # Save attenuation
+        if attenuation_file is not None:
+            self.attenuation = load_calibration(attenuation_file)
+        else:
+            self.attenuation = None        
+        
+        # Save channel
+        # Currently only mono or stereo sound is supported
+        if channel is None:
+            self.channel = None
+        try:
+            self.channel = int(channel)
+        except TypeError:
+            self.channel = channel
+        
+        if self.channel not in [0, 1]:
+            raise ValueError(
+                "audio channel must be 0 or 1, not {}".format(
+                self.channel))
+        
+        if self.backend not in ['butter', 'fft']:
+            raise ValueError(
+                "noise backend must be 'butter' or 'fft', not {}".format(
+                self.backend))
+
+        # Initialize the sound itself
+        self.chunks = None
+        self.initialized = False
+        self.init_sound(data)
+
+    def init_sound(self, data=None):
+        """Defines `self.table`, the waveform that is played. 
+        
+        The way this is generated depends on `self.server_type`, because
+        parameters like the sampling rate cannot be known otherwise.
+        
+        The sound is generated and then it is "chunked" (zero-padded and
+        divided into chunks). Finally `self.initialized` is set True.
+        
+        If `data` is provided, it is used instead of generating new noise.
+        """
+        # Calculate the number of samples
+        self.nsamples = int(np.rint(self.duration * self.fs))
+        
+        if data is not None:
+            # Already generated
+            if len(data) != self.nsamples:
+                raise ValueError(
+                    "data has {} samples but duration needs {}".format(
+                    len(data), self.nsamples))
+        
+        elif self.backend == 'fft':
+            # Synthesize it directly in the band
+            data = bandpass_noise(
+                1, self.nsamples, self.fs, self.highpass, self.lowpass)[0]
+        
+        else:
+            # Generate the table by sampling from a uniform distribution
+            # and filter it
+            data = np.random.uniform(-1, 1, self.nsamples)
+            data = butter_bandpass(data, self.fs, self.highpass, self.lowpass)
+        
+        # The shape of the table depends on `self.channel`
+        # The table will be 2-dimensional for stereo sound
+        # Each channel is a column
+        # Only the specified channel contains data and the other is zero
+        
+        # Assign data into table
+        self.table = np.zeros((self.nsamples, 2))
+        assert self.channel in [0, 1]
+        self.table[:, self.channel] = data
+        
+        # Scale by the amplitude
+        self.table = self.table * self.amplitude
+        
+        # Convert to float32
+        self.table = self.table.astype(np.float32)
+        
+        # Apply attenuation
+        if self.attenuation is not None:
+            # To make the attenuated sounds roughly match the original
+            # sounds in loudness, multiply table by np.sqrt(10) (10 dB)
+            # Better solution is to encode this into attenuation profile,
+            # or a separate "gain" parameter
+            self.table = self.table * np.sqrt(10)
+            
+            # Apply the attenuation to both columns at once
+            self.table = apply_attenuation(
+                self.table, self.attenuation, self.fs).astype(np.float32)
+        
+        # Break the sound table into individual chunks of length blocksize
+        self.chunk()
+
+        # Flag as initialized
+        self.initialized = True
+
+    def chunk(self):
+        """Break the sound in self.table into chunks of length blocksize
+        
+        The sound in self.table is zero-padded to a length that is a multiple
+        of `self.blocksize`. Then it is broken into `self.chunks`, a list 
+        of chunks each of length `blocksize`.
+        
+        TODO: move this into a superclass, since the same code can be used
+        for other sounds.
+        """
+        # Zero-pad the self.table to a new length that is multiple of blocksize
+        oldlen = len(self.table)
+        
+        # Calculate how many blocks we need to contain the sound
+        n_blocks_needed = int(np.ceil(oldlen / self.blocksize))
+        
+        # Calculate the new length
+        newlen = n_blocks_needed * self.blocksize
+
+        # Pad with 2d array of zeros
+        to_concat = np.zeros(
+            (newlen - oldlen, self.table.shape[1]), 
+            np.float32)
+
+        # Zero pad
+        padded_sound = np.concatenate([self.table, to_concat])
+        
+        # Start of each chunk
+        start_samples = range(0, len(padded_sound), self.blocksize)
+        
+        # Break the table into chunks
+        self.chunks = [
+            padded_sound[start_sample:start_sample + self.blocksize, :] 
+            for start_sample in start_samples]
+
+    @classmethod
+    def from_chunks(cls, chunks, blocksize=1024, fs=192000, duration=0.01, 
+        amplitude=0.01, channel=None, highpass=None, lowpass=None, 
+        attenuation_file=None, backend='butter'):
+        """Recreate a Noise from the chunks of one that was built earlier
+        
+        Nothing is generated or filtered. `chunks` is an array of shape
+        (n_chunks, blocksize, n_channels), eg memory-mapped from a
+        StimulusStore, and the chunks and table are views into it. The
+        other arguments are the ones the original Noise was built with.
+        """
+        noise = cls.__new__(cls)
+        noise.backend = backend
+        noise.blocksize = blocksize
+        noise.fs = fs
+        noise.duration = float(duration)
+        noise.amplitude = float(amplitude)
+        noise.highpass = None if highpass is None else float(highpass)
+        noise.lowpass = None if lowpass is None else float(lowpass)
+        noise.attenuation = (
+            None if attenuation_file is None 
+            else load_calibration(attenuation_file))
+        noise.channel = channel
+        noise.nsamples = int(np.rint(noise.duration * noise.fs))
+        
+        noise.table = chunks.reshape(-1, chunks.shape[2])[:noise.nsamples]
+        noise.chunks = list(chunks)
+        noise.initialized = True
+        return noise
+
+
+class NoiseBank:
+    """A long buffer of bandpass noise that bursts are cut out of.
+    
+    Filtering one long buffer once and reading random windows out of it
+    keeps the bursts varied, but making a burst only costs a slice and a
+    multiply. The buffer is noise before amplitude is applied, in the same
+    units as the noise that Noise generates with the same backend.
+    
+    If a StimulusStore is given, the buffer is saved to it the first time
+    and memory-mapped from it from then on, eg from the Pi's SD card.
+    """
+    def __init__(self, fs, highpass=None, lowpass=None, duration=2.0, 
+        backend='fft', store=None, rng=None):
+        """Load or generate the buffer.
+        
+        Args:
+            fs (int): sampling rate
+            highpass, lowpass (float or None): edges of the band in Hz
+            duration (float): length of the buffer in seconds
+            backend (string): 'butter' or 'fft', as for Noise
+            store (StimulusStore or None): where to persist the buffer
+            rng (np.random.Generator or None): where to draw the noise and
+                the windows from
+        """
+        self.fs = int(fs)
+        self.highpass = highpass
+        self.lowpass = lowpass
+        self.backend = backend
+        self.nsamples = int(np.rint(duration * self.fs))
+        
+        if rng is None:
+            rng = np.random.default_rng()
+        self.rng = rng
+        
+        # Windows are drawn from the main loop and the prerendering thread
+        self.lock = threading.Lock()
+        
+        if store is None:
+            self.data = self.generate().astype(np.float32)
+            return
+        
+        store_key = store.key({
+            'noise_bank': [self.fs, highpass, lowpass, self.nsamples, backend],
+            })
+        self.data = store.load(store_key)
+        if self.data is None:
+            self.data = self.generate().astype(np.float32)
+            store.save(store_key, self.data)
+    
+    def generate(self):
+        """Return a new buffer of bandpass noise"""
+        if self.backend == 'fft':
+            return bandpass_noise(1, self.nsamples, self.fs, 
+                self.highpass, self.lowpass, rng=self.rng)[0]
+        
+        # The same filters as Noise, run once on the whole buffer
+        data = self.rng.uniform(-1, 1, self.nsamples)
+        return butter_bandpass(data, self.fs, self.highpass, self.lowpass)
+    
+    def window(self, nsamples):
+        """Return a copy of `nsamples` samples from a random place"""
+        if nsamples > self.nsamples:
+            raise ValueError(
+                "can't cut {} samples from a bank of {}".format(
+                nsamples, self.nsamples))
+        with self.lock:
+            start = int(self.rng.integers(0, self.nsamples - nsamples + 1))
+        return np.array(self.data[start:start + nsamples], dtype=float)
+
+
+class NoiseBanks:
+    """Least-recently-used set of NoiseBank objects, one per band.
+    
+    A new bank is generated for every band that hasn't been seen. When
+    every trial draws a new center frequency, that would be one bank per
+    trial, so the edges of the band are rounded to multiples of
+    `band_step` first. The banks then come from a small set, and each
+    burst is within `band_step / 2` of the band that was asked for.
+    
+    If a StimulusStore is given, banks are persisted to it, and it keeps
+    them under its size cap by deleting the least recently used.
+    """
+    def __init__(self, maxsize=8, duration=2.0, band_step=250.0, store=None):
+        """Initialize an empty set.
+        
+        Args:
+            maxsize (int): maximum number of banks to keep in memory
+            duration (float): length of each bank in seconds
+            band_step (float): the edges of the band are rounded to
+                multiples of this, in Hz
+            store (StimulusStore or None): where to keep the banks on disk
+                If None, they are only kept in memory
+        """
+        self.maxsize = int(maxsize)
+        self.duration = float(duration)
+        self.band_step = float(band_step)
+        self.store = store
+        self.banks = collections.OrderedDict()
+        self.lock = threading.Lock()
+    
+    def round_edge(self, freq):
+        """Round an edge of the band to a multiple of `band_step`"""
+        if freq is None:
+            return None
+        return float(np.rint(float(freq) / self.band_step) * self.band_step)
+    
+    def get(self, fs, highpass=None, lowpass=None, backend='fft'):
+        """Return the bank for this band, loading or generating it if needed
+        
+        The bank's band is this one rounded, see `round_edge`.
+        """
+        key = (
+            int(fs),
+            self.round_edge(highpass),
+            self.round_edge(lowpass),
+            backend,
+            )
+        
+        with self.lock:
+            if key in self.banks:
+                self.banks.move_to_end(key)
+                return self.banks[key]
+            
+            bank = NoiseBank(key[0], key[1], key[2], duration=self.duration, 
+                backend=backend, store=self.store)
+            self.banks[key] = bank
+            while len(self.banks) > self.maxsize:
+                self.banks.popitem(last=False)
+            
+            return bank
+
+
+class NoiseCache:
+    """Bounded least-recently-used cache of chunked Noise objects.
+    
+    Noise objects are keyed by every parameter that changes their table:
+    (amplitude, highpass, lowpass, channel, fs, blocksize, duration,
+    attenuation_file, backend). Asking for a parameter set that was built recently
+    returns the same object without doing any filtering. When the cache
+    holds more than `maxsize` objects, the least recently used is dropped.
+    
+    Because the same object is returned, a repeated parameter set plays the
+    same noise token every time, rather than a fresh random draw.
+    
+    If a StimulusStore is provided, Noise objects that aren't in memory are
+    loaded from it before building them, and newly built ones are saved to
+    it. Then the same token is played across restarts too.
+    """
+    def __init__(self, maxsize=64, store=None):
+        """Initialize an empty cache.
+        
+        Args:
+            maxsize (int): maximum number of Noise objects to keep
+            store (StimulusStore or None): where to persist Noise objects
+        """
+        self.maxsize = int(maxsize)
+        self.store = store
+        self.noises = collections.OrderedDict()
+        
+        # The cache is shared with the thread that prerenders the next trial
+        self.lock = threading.Lock()
+        
+        # Counters reported by `stats`
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+    
+    def get(self, blocksize=1024, fs=192000, duration=0.01, amplitude=0.01, 
+        channel=None, highpass=None, lowpass=None, attenuation_file=None, 
+        backend='butter'):
+        """Return a Noise with these parameters, building it if needed.
+        
+        Takes the same arguments as Noise. This is thread-safe.
+        """
+        return self.get_channels([channel], blocksize, fs, duration=duration, 
+            amplitude=amplitude, highpass=highpass, lowpass=lowpass, 
+            attenuation_file=attenuation_file, backend=backend)[0]
+    
+    def get_channels(self, channels, blocksize=1024, fs=192000, duration=0.01, 
+        amplitude=0.01, highpass=None, lowpass=None, attenuation_file=None, 
+        backend='butter'):
+        """Return a Noise on each of `channels`, like `get`
+        
+        With the 'fft' backend, the ones that have to be built are
+        synthesized together by `make_noise_batch`.
+        """
+        # Normalize the keys so that eg 5000 and 5000.0 match
+        keys = [(
+            float(amplitude),
+            None if highpass is None else float(highpass),
+            None if lowpass is None else float(lowpass),
+            channel,
+            int(fs),
+            int(blocksize),
+            float(duration),
+            attenuation_file,
+            backend,
+            ) for channel in channels]
+        
+        with self.lock:
+            # Mark the cached objects as recently used
+            missing = []
+            for key in keys:
+                if key in self.noises:
+                    self.hits += 1
+                    self.noises.move_to_end(key)
+                elif key not in missing:
+                    missing.append(key)
+            
+            # Load or build the others
+            self.misses += len(missing)
+            if len(missing) > 0:
+                noises = self.load_or_build(missing, blocksize=blocksize, 
+                    fs=fs, duration=duration, amplitude=amplitude, 
+                    highpass=highpass, lowpass=lowpass, 
+                    attenuation_file=attenuation_file, backend=backend)
+                self.noises.update(zip(missing, noises))
+            res = [self.noises[key] for key in keys]
+            
+            # Drop the least recently used objects until under the limit
+            while len(self.noises) > self.maxsize:
+                self.noises.popitem(last=False)
+                self.evictions += 1
+            
+            return res
+    
+    def load_or_build(self, keys, **kwargs):
+        """Load a Noise for each key from the store, or build and save it
+        
+        The keys only differ by channel, and `kwargs` are the rest of the
+        arguments of Noise.
+        
+        Returns: list of Noise, in the order of `keys`
+        """
+        # The calibration file can change under the same name
+        if self.store is None:
+            store_keys = [None] * len(keys)
+        else:
+            attenuation_mtime = (
+                None if kwargs['attenuation_file'] is None 
+                else os.path.getmtime(kwargs['attenuation_file']))
+            store_keys = [self.store.key({
+                'noise': list(key),
+                'attenuation_mtime': attenuation_mtime,
+                }) for key in keys]
+        
+        noises = [None] * len(keys)
+        if self.store is not None:
+            for n_key, (key, store_key) in enumerate(zip(keys, store_keys)):
+                chunks = self.store.load(store_key)
+                if chunks is not None:
+                    noises[n_key] = Noise.from_chunks(
+                        chunks, channel=key[3], **kwargs)
+        
+        # Build the rest, all at once if possible
+        to_build = [n_key for n_key, noise in enumerate(noises) if noise is None]
+        channels = [keys[n_key][3] for n_key in to_build]
+        if kwargs['backend'] == 'fft':
+            built = make_noise_batch(len(to_build), channels=channels, 
+                **{name: value for name, value in kwargs.items() 
+                if name != 'backend'})
+        else:
+            built = [Noise(channel=channel, **kwargs) for channel in channels]
+        
+        for n_key, noise in zip(to_build, built):
+            noises[n_key] = noise
+            if self.store is not None:
+                self.store.save(store_keys[n_key], np.stack(noise.chunks))
+        return noises
+    
+    def clear(self):
+        """Remove every cached Noise (the counters are kept)"""
+        with self.lock:
+            self.noises.clear()
+    
+    def nbytes(self):
+        """Approximate memory held by the cached tables and chunks"""
+        total = 0
+        with self.lock:
+            noises = list(self.noises.values())
+        for noise in noises:
+            total += noise.table.nbytes
+            total += sum(chunk.nbytes for chunk in noise.chunks)
+        return total
+    
+    def stats(self):
+        """Return a dict of hit/miss counts and memory use"""
+        n_requests = self.hits + self.misses
+        return {
+            'size': len(self.noises),
+            'maxsize': self.maxsize,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hit_rate': self.hits / n_requests if n_requests else 0.0,
+            'nbytes': self.nbytes(),
+            }
@@ -0,0 +1,125 @@
+## Sample-clock timestamps of every sound that is actually played
+# The schedules in sound_cycle.py report the sample offset of each onset in
+# the frame they yield, and SoundQueue records that against the index the
+# frame was given in the ring. The jack process callback records the
+# `last_frame_time` at which it played each ring index. Matching the two
+# gives the onset of each sound in jack's sample clock, which is then
+# converted to wall-clock time and sent to the GUI in batches.
+
+import collections
+import numpy as np
+
+
+class OnsetLog:
+    """Matches scheduled onsets to the jack frame time they were played at.
+
+    `clock` is called from the jack process callback, and only writes into
+    a preallocated array. `add` and `collect` are called from the main loop.
+
+    An onset whose frame was flushed from the ring is never played, and is
+    dropped once the callback has moved past it.
+    """
+    def __init__(self, fs, n_clock=4096, max_pending=4096):
+        """Create an empty log
+
+        Args:
+            fs (int): sampling rate of jack's sample clock
+            n_clock (int): how many played frames to remember
+                `collect` has to be called before this many frames are
+                played, ie within about 20 s at 1024 samples and 192 kHz
+            max_pending (int): most onsets to hold while waiting to be played
+        """
+        self.fs = fs
+        self.n_clock = int(n_clock)
+
+        # (ring index, last_frame_time) of each frame played, in a circle
+        self.frame_clock = np.zeros((self.n_clock, 2), dtype=np.int64)
+        self.n_clocked = 0
+
+        # (ring index, sample offset, stim_id) of each onset not yet played
+        self.pending = collections.deque(maxlen=max_pending)
+
+    def clock(self, ring_idx, last_frame_time):
+        """Record that ring frame `ring_idx` was played (realtime thread)"""
+        n_row = self.n_clocked % self.n_clock
+        self.frame_clock[n_row, 0] = ring_idx
+        self.frame_clock[n_row, 1] = last_frame_time
+        self.n_clocked += 1
+
+    def add(self, ring_idx, offset, stim_id):
+        """Record an onset `offset` samples into ring frame `ring_idx`"""
+        self.pending.append((ring_idx, offset, stim_id))
+
+    def clear(self):
+        """Forget onsets that haven't been played yet"""
+        self.pending.clear()
+
+    def collect(self, now_frames, now_wall):
+        """Return the onsets that have been played since the last call
+
+        Args:
+            now_frames (int): jack's current frame time, eg client.frame_time
+            now_wall (float): time.time() at the same moment
+                Together these convert frame times to wall-clock times
+
+        Returns: list of (wall-clock time, frame time, stim_id)
+        """
+        if len(self.pending) == 0:
+            return []
+
+        # The frames that are still remembered, oldest first
+        # Ring indices only increase, so these are sorted
+        n_clocked = self.n_clocked
+        start = max(0, n_clocked - self.n_clock)
+        rows = self.frame_clock[
+            np.arange(start, n_clocked) % self.n_clock]
+        if len(rows) == 0:
+            return []
+        ring_idxs = rows[:, 0]
+        last_played = ring_idxs[-1]
+
+        onsets = []
+        while len(self.pending) > 0:
+            ring_idx, offset, stim_id = self.pending[0]
+
+            # Not played yet, and neither is anything after it
+            if ring_idx > last_played:
+                break
+            self.pending.popleft()
+
+            # Skipped by a flush, or played too long ago to be remembered
+            n_row = np.searchsorted(ring_idxs, ring_idx)
+            if n_row >= len(ring_idxs) or ring_idxs[n_row] != ring_idx:
+                continue
+
+            frame_time = int(rows[n_row, 1]) + offset
+            wall_time = now_wall - (now_frames - frame_time) / self.fs
+            onsets.append((wall_time, frame_time, stim_id))
+
+        return onsets
+
+
+def format_onsets(onsets, side_names):
+    """Return onsets from `OnsetLog.collect` as the message sent to the GUI
+
+    Each onset is "wall-clock time,side,frame time", and onsets are
+    separated by semicolons.
+    """
+    return "Sound Onsets - " + ";".join([
+        f"{wall_time:.6f},{side_names[stim_id]},{frame_time}"
+        for wall_time, frame_time, stim_id in onsets])
+
+
+def parse_onsets(message):
+    """Inverse of `format_onsets`
+
+    Returns: list of (wall-clock time, side, frame time)
+    """
+    body = message.split("-", 1)[1].strip()
+    onsets = []
+    for item in body.split(";"):
+        if item == "":
+            continue
+        wall_time, side, frame_time = item.split(",")
+        onsets.append((float(wall_time), side, int(frame_time)))
+    return onsets
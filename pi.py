@@ -1,6 +1,11 @@
 ## Main script that runs on each Pi to run behavior
 
+# Start timing before the slow imports, see --profile-startup
+from startup_profile import StartupProfiler
+startup_profiler = StartupProfiler()
+
 import zmq
+from zmq.utils.monitor import recv_monitor_message
 import pigpio
 import numpy as np
 import os
@@ -9,34 +14,44 @@ import time
 import threading
 import random
 import json
+import argparse
 import socket as sc
-import itertools
 import queue
+import collections
 import multiprocessing as mp
-import pandas as pd
-import scipy.signal
 from datetime import datetime
+from daemons import ensure_daemons
+from sound_ring import FrameRing
+from audio_stats import CallbackStats, DepthController
+from onset_log import OnsetLog, format_onsets, parse_onsets
+from noise import Noise, NoiseCache, NoiseBanks
+from stimulus_store import StimulusStore
+from pin_scheduler import PinScheduler
+from clock_sync import TickClock, ClockSync
+import event_protocol
+from event_journal import EventJournal
+from realtime import split_cpus, pin_to_cpus, set_fifo_priority, drop_realtime, freeze_gc
+from sound_cycle import SoundCycle, SoundStream, SoundMixer, repeat_bursts, draw_intervals, schedule_intervals, SIDE_NAMES
+startup_profiler.mark('imports')
+
+
+## Command line arguments
+# With --agent, 'exit' only ends the session, and the jack client, pigpio
+# and the stimulus caches stay warm for the next one
+parser = argparse.ArgumentParser(description="Run behavior on this Pi.")
+parser.add_argument('--agent', action='store_true', 
+    help="keep running between sessions until 'shutdown' is received")
+parser.add_argument('--profile-startup', action='store_true',
+    help="print how long each phase of starting up took")
+args = parser.parse_args()
 
 
-## Killing previous pigpiod and jackd background processes
-os.system('sudo killall pigpiod')
-os.system('sudo killall jackd')
-
-# Wait long enough to make sure they are killed
-time.sleep(1)
-
 ## Starting pigpiod and jackd background processes
-# Start pigpiod
-# TODO: document these parameters
-os.system('sudo pigpiod -t 0 -l -x 1111110000111111111111110000')
-time.sleep(1)
-
-# Start jackd
-# TODO: document these parameters
-# TODO: Use subprocess to keep track of these background processes
-os.system(
-    'jackd -P75 -p16 -t2000 -dalsa -dhw:sndrpihifiberry -P -r192000 -n3 -s &')
-time.sleep(1)
+# Instances that are already running with the same parameters are reused,
+# and otherwise they are restarted and polled until ready
+# See daemons.py for what the parameters mean
+daemon_timings = ensure_daemons()
+startup_profiler.mark('daemons')
 
 
 ## Load parameters for this pi
@@ -49,170 +64,7 @@ pi_name = str(pi_hostname)
 param_directory = f"pi/configs/pis/{pi_name}.json"
 with open(param_directory, "r") as p:
     params = json.load(p)    
-
-class Noise:
-    """Class to define bandpass filtered white noise."""
-    def __init__(self, blocksize=1024, fs=192000, duration = 0.01, amplitude=0.01, channel=None, 
-        highpass=None, lowpass=None, attenuation_file=None, **kwargs):
-        """Initialize a new white noise burst with specified parameters.
-        
-        The sound itself is stored as the attribute `self.table`. This can
-        be 1-dimensional or 2-dimensional, depending on `channel`. If it is
-        2-dimensional, then each channel is a column.
-        
-        Args:
-            duration (float): duration of the noise
-            amplitude (float): amplitude of the sound as a proportion of 1.
-            channel (int or None): which channel should be used
-                If 0, play noise from the first channel
-                If 1, play noise from the second channel
-                If None, send the same information to all channels ("mono")
-            highpass (float or None): highpass the Noise above this value
-                If None, no highpass is applied
-            lowpass (float or None): lowpass the Noise below this value
-                If None, no lowpass is applied       
-            attenuation_file (string or None)
-                Path to where a pd.Series can be loaded containing attenuation
-            **kwargs: extraneous parameters that might come along with instantiating us
-        """
-        # Set duraiton and amplitude as float
-        self.blocksize = blocksize
-        self.fs = fs
-        self.duration = float(duration)
-        self.amplitude = float(amplitude)
-        
-        # Save optional parameters - highpass, lowpass, channel
-        if highpass is None:
-            self.highpass = None
-        else:
-            self.highpass = float(highpass)
-        
-        if lowpass is None:
-            self.lowpass = None
-        else:
-            self.lowpass = float(lowpass)
-        
-        # Save attenuation
-        if attenuation_file is not None:
-            self.attenuation = pd.read_table(
-                attenuation_file, sep=',').set_index('freq')['atten']
-        else:
-            self.attenuation = None        
-        
-        # Save channel
-        # Currently only mono or stereo sound is supported
-        if channel is None:
-            self.channel = None
-        try:
-            self.channel = int(channel)
-        except TypeError:
-            self.channel = channel
-        
-        if self.channel not in [0, 1]:
-            raise ValueError(
-                "audio channel must be 0 or 1, not {}".format(
-                self.channel))
-
-        # Initialize the sound itself
-        self.chunks = None
-        self.initialized = False
-        self.init_sound()
-
-    def init_sound(self):
-        """Defines `self.table`, the waveform that is played. 
-        
-        The way this is generated depends on `self.server_type`, because
-        parameters like the sampling rate cannot be known otherwise.
-        
-        The sound is generated and then it is "chunked" (zero-padded and
-        divided into chunks). Finally `self.initialized` is set True.
-        """
-        # Calculate the number of samples
-        self.nsamples = int(np.rint(self.duration * self.fs))
-        
-        # Generate the table by sampling from a uniform distribution
-        # The shape of the table depends on `self.channel`
-        # The table will be 2-dimensional for stereo sound
-        # Each channel is a column
-        # Only the specified channel contains data and the other is zero
-        data = np.random.uniform(-1, 1, self.nsamples)
-        
-        # Highpass filter it
-        if self.highpass is not None:
-            bhi, ahi = scipy.signal.butter(
-                2, self.highpass / (self.fs / 2), 'high')
-            data = scipy.signal.filtfilt(bhi, ahi, data)
-        
-        # Lowpass filter it
-        if self.lowpass is not None:
-            blo, alo = scipy.signal.butter(
-                2, self.lowpass / (self.fs / 2), 'low')
-            data = scipy.signal.filtfilt(blo, alo, data)
-        
-        # Assign data into table
-        self.table = np.zeros((self.nsamples, 2))
-        assert self.channel in [0, 1]
-        self.table[:, self.channel] = data
-        
-        # Scale by the amplitude
-        self.table = self.table * self.amplitude
-        
-        # Convert to float32
-        self.table = self.table.astype(np.float32)
-        
-        # Apply attenuation
-        if self.attenuation is not None:
-            # To make the attenuated sounds roughly match the original
-            # sounds in loudness, multiply table by np.sqrt(10) (10 dB)
-            # Better solution is to encode this into attenuation profile,
-            # or a separate "gain" parameter
-            self.table = self.table * np.sqrt(10)
-            
-            # Apply the attenuation to each column
-            for n_column in range(self.table.shape[1]):
-                self.table[:, n_column] = apply_attenuation(
-                    self.table[:, n_column], self.attenuation, self.fs)
-        
-        # Break the sound table into individual chunks of length blocksize
-        self.chunk()
-
-        # Flag as initialized
-        self.initialized = True
-
-    def chunk(self):
-        """Break the sound in self.table into chunks of length blocksize
-        
-        The sound in self.table is zero-padded to a length that is a multiple
-        of `self.blocksize`. Then it is broken into `self.chunks`, a list 
-        of chunks each of length `blocksize`.
-        
-        TODO: move this into a superclass, since the same code can be used
-        for other sounds.
-        """
-        # Zero-pad the self.table to a new length that is multiple of blocksize
-        oldlen = len(self.table)
-        
-        # Calculate how many blocks we need to contain the sound
-        n_blocks_needed = int(np.ceil(oldlen / self.blocksize))
-        
-        # Calculate the new length
-        newlen = n_blocks_needed * self.blocksize
-
-        # Pad with 2d array of zeros
-        to_concat = np.zeros(
-            (newlen - oldlen, self.table.shape[1]), 
-            np.float32)
-
-        # Zero pad
-        padded_sound = np.concatenate([self.table, to_concat])
-        
-        # Start of each chunk
-        start_samples = range(0, len(padded_sound), self.blocksize)
-        
-        # Break the table into chunks
-        self.chunks = [
-            padded_sound[start_sample:start_sample + self.blocksize, :] 
-            for start_sample in start_samples]
+startup_profiler.mark('config')
 
 class SoundQueue:
     """This is a class used to continuously generate frames of audio and add them to a queue. 
@@ -223,7 +75,19 @@ class SoundQueue:
         # Each block/frame is about 5 ms
         # Longer is more buffer against unexpected delays
         # Shorter is faster to empty and refill the queue
-        self.target_qsize = 200
+        # The depth is adjusted by `depth_controller` to be only as long as
+        # the main loop needs, starting from 200 frames (about 1 s), and
+        # never more than half the ring
+        self.depth_controller = DepthController(
+            target=200, max_target=max_queue_depth)
+        self.target_qsize = self.depth_controller.target
+        
+        # The ring has to hold a full queue of flushed frames, which
+        # `process` may not have skipped yet, plus the refill after a flush
+        if self.depth_controller.max_target > sound_ring.n_slots // 2:
+            raise ValueError(
+                "max_target {} is more than half of the {} slots in the ring".format(
+                self.depth_controller.max_target, sound_ring.n_slots))
 
         # Some counters to keep track of how many sounds we've played
         self.n_frames = 0
@@ -246,25 +110,98 @@ class SoundQueue:
         # State variable to stop appending frames 
         self.running = False
         
+        # Recently built noise bursts, so that repeated parameter sets
+        # don't have to be filtered again
+        # They are also kept on disk, so they don't have to be filtered
+        # again after a restart either
+        self.stimulus_store = StimulusStore(
+            params.get('stimulus_store_dir', 'stimulus_store'),
+            max_bytes=params.get('stimulus_store_max_mb', 256) * 2 ** 20)
+        self.noise_cache = NoiseCache(maxsize=64, store=self.stimulus_store)
+        
+        # How the sequence of sounds is generated
+        # 'cycle' repeats a 10 s sequence, 'stream' never repeats
+        self.sound_mode = 'cycle'
+        
+        # Whether to mix sounds at their exact times, so that they can
+        # overlap, instead of playing them one after another
+        self.sound_mixing = False
+        
+        # How noise bursts are bandpassed, 'butter' or 'fft'
+        # See noise.Noise
+        self.noise_backend = 'butter'
+        
+        # Whether to cut each burst out of a long pregenerated buffer of
+        # noise in its band, instead of filtering a new one
+        # The buffers are kept in 'noise_bank_dir' on the SD card if set,
+        # up to 'noise_bank_max_mb', which is about 1.5 MB per band
+        self.noise_bank = False
+        if params.get('noise_bank_dir') is None:
+            noise_bank_store = None
+        else:
+            noise_bank_store = StimulusStore(params['noise_bank_dir'], 
+                max_bytes=params.get('noise_bank_max_mb', 64) * 2 ** 20)
+        self.noise_banks = NoiseBanks(maxsize=8, store=noise_bank_store)
+        
+        # Random number generator for the intervals between sounds
+        # This is reseeded by `set_seed`
+        self.rng = np.random.default_rng()
+        
+        ## Prerendering of the next trial
+        # The next trial's parameters, stimuli and schedules, once built
+        self.next_trial = None
+        
+        # Schedules for the current trial that are ready to be swapped in
+        self.ready_schedules = {}
+        
+        # Background thread that builds `next_trial`
+        self.prerender_thread = None
+        
+        # Incremented to discard a trial that is being built
+        self.prerender_id = 0
+        
         # Fill the queue with empty frames
         # Sounds aren't initialized till the trial starts
         # Using False here should work even without sounds initialized yet
         self.initialize_sounds(self.blocksize, self.fs, self.amplitude, self.target_highpass,  self.target_lowpass)
         self.set_sound_cycle()
-
-        # Use this to keep track of generated sounds
-        self.current_audio_times_df = None
     
     """Object to choose the sounds and pauses for this trial"""
     def update_parameters(self, rate_min, rate_max, irregularity_min, irregularity_max, amplitude_min, amplitude_max, center_freq_min, center_freq_max, bandwidth):
         """Method to update sound parameters dynamically"""
-        self.target_rate = random.uniform(rate_min, rate_max)
-        self.target_temporal_log_std = random.uniform(irregularity_min, irregularity_max)
-        self.amplitude = random.uniform(amplitude_min, amplitude_max)
-        self.center_freq = random.uniform(center_freq_min, center_freq_max)
-        self.bandwidth = bandwidth
-        self.target_lowpass = self.center_freq + (self.bandwidth / 2)
-        self.target_highpass = self.center_freq - (self.bandwidth / 2)
+        parameters = self.draw_parameters(
+            rate_min, rate_max, irregularity_min, irregularity_max, 
+            amplitude_min, amplitude_max, center_freq_min, center_freq_max, bandwidth)
+        return self.apply_parameters(parameters)
+
+    def draw_parameters(self, rate_min, rate_max, irregularity_min, irregularity_max, amplitude_min, amplitude_max, center_freq_min, center_freq_max, bandwidth):
+        """Draw sound parameters for a trial, without applying them
+        
+        Returns: dict of parameters, to be passed to `apply_parameters`
+        """
+        center_freq = random.uniform(center_freq_min, center_freq_max)
+        return {
+            'target_rate': random.uniform(rate_min, rate_max),
+            'target_temporal_log_std': random.uniform(irregularity_min, irregularity_max),
+            'amplitude': random.uniform(amplitude_min, amplitude_max),
+            'center_freq': center_freq,
+            'bandwidth': bandwidth,
+            'target_lowpass': center_freq + (bandwidth / 2),
+            'target_highpass': center_freq - (bandwidth / 2),
+            }
+
+    def apply_parameters(self, parameters):
+        """Make `parameters` the current sound parameters
+        
+        Returns: the parameter message that is sent to the GUI
+        """
+        self.target_rate = parameters['target_rate']
+        self.target_temporal_log_std = parameters['target_temporal_log_std']
+        self.amplitude = parameters['amplitude']
+        self.center_freq = parameters['center_freq']
+        self.bandwidth = parameters['bandwidth']
+        self.target_lowpass = parameters['target_lowpass']
+        self.target_highpass = parameters['target_highpass']
 
         # Debug message
         parameter_message = (
@@ -283,166 +220,291 @@ class SoundQueue:
         """Defines sounds that will be played during the task"""
         ## Define sounds
         # Left and right target noise bursts
-        self.left_target_stim = Noise(blocksize, fs,
-            duration=0.01, amplitude= self.amplitude, channel=0, 
-            lowpass=self.target_lowpass, highpass=self.target_highpass
-            )       
+        self.left_target_stim, self.right_target_stim = self.make_stimuli({
+            'amplitude': self.amplitude,
+            'target_lowpass': self.target_lowpass,
+            'target_highpass': self.target_highpass,
+            }, blocksize, fs)
+
+    def make_stimuli(self, parameters, blocksize, fs):
+        """Return the left and right target noise bursts for `parameters`
         
-        self.right_target_stim = Noise(blocksize, fs,
-            duration=0.01, amplitude= self.amplitude, channel=1, 
-            lowpass=self.target_lowpass, highpass=self.target_highpass
-            )  
-
+        These come from the cache if the same parameters were used recently,
+        or are cut out of a noise bank if `noise_bank` is set.
+        """
+        if self.noise_bank:
+            # A fresh window for each side, so no need to cache them
+            bank = self.noise_banks.get(fs, 
+                highpass=parameters['target_highpass'], 
+                lowpass=parameters['target_lowpass'], 
+                backend=self.noise_backend)
+            nsamples = int(np.rint(0.01 * fs))
+            return tuple([
+                Noise(blocksize, fs, duration=0.01, 
+                    amplitude=parameters['amplitude'], channel=channel, 
+                    lowpass=parameters['target_lowpass'], 
+                    highpass=parameters['target_highpass'], 
+                    backend=self.noise_backend, data=bank.window(nsamples))
+                for channel in [0, 1]])
+        
+        # Both sides at once, so that with the 'fft' backend they are
+        # synthesized together
+        left_target_stim, right_target_stim = self.noise_cache.get_channels(
+            [0, 1], blocksize, fs,
+            duration=0.01, amplitude=parameters['amplitude'], 
+            lowpass=parameters['target_lowpass'], 
+            highpass=parameters['target_highpass'],
+            backend=self.noise_backend,
+            )
+        
+        return left_target_stim, right_target_stim
 
     def set_sound_cycle(self):
         """Define self.sound_cycle, to go through sounds
         
-        params : dict
-            This comes from a message on the net node.
-            Possible keys:
-                left_on
-                right_on
-                left_mean_interval
-                right_mean_interval
+        The sounds are the current target stimuli, on whichever channels
+        are on. See `make_schedule` for how they are arranged.
         """
-        # Array to attach chunked sounds
-        self.sound_block = []
-
-        # Helper function
-        def append_gap(gap_chunk_size=30):
-            """Append `gap_chunk_size` silent chunks to sound_block"""
-            for n_blank_chunks in range(gap_chunk_size):
-                self.sound_block.append(
-                    np.zeros((1024, 2), dtype='float32'))
-
-        # Extract params or use defaults
-        left_on = self.left_on
-        right_on = self.right_on
-        left_target_rate = self.target_rate 
-        right_target_rate = self.target_rate 
+        # Chunks of each sound, indexed by stimulus id
+        stimuli = [self.left_target_stim.chunks, self.right_target_stim.chunks]
         
-        #print(self.target_rate)
-        #print(left_on)
-        #print(right_on)
+        # Only the channels that are on get any sounds
+        left_target_rate = self.target_rate if self.left_on else 0
+        right_target_rate = self.target_rate if self.right_on else 0
         
-        # Global params
-        target_temporal_std = 10 ** self.target_temporal_log_std 
+        self.sound_schedule = self.make_schedule(
+            stimuli, left_target_rate, right_target_rate, 
+            self.target_temporal_log_std, self.rng)
+        self.sound_cycle = iter(self.sound_schedule)
+
+    def make_schedule(self, stimuli, left_target_rate, right_target_rate, 
+        target_temporal_log_std, rng):
+        """Return a schedule of sounds, which yields frames when iterated
+        
+        In 'cycle' mode, 10 s of sounds are scheduled and repeated. In 
+        'stream' mode, a SoundStream draws new intervals forever. If 
+        `sound_mixing` is set, a SoundMixer places each sound at its exact
+        sample, otherwise sounds are played one after another.
+        
+        This does not change any attributes, so it is safe to call from
+        the prerendering thread.
+        
+        stimuli : list
+            Chunks of each sound, indexed by stimulus id (LEFT, RIGHT)
+        left_target_rate, right_target_rate : float
+            Rate of the sounds on each side, 0 if that side is off
+        target_temporal_log_std : float
+            Irregularity of the intervals between sounds
+        rng : np.random.Generator
+            Where to draw the intervals from
+        """
+        ## In stream mode, intervals are drawn as the sounds are played
+        if self.sound_mode == 'stream':
+            return SoundStream(
+                stimuli, [left_target_rate, right_target_rate], 
+                target_temporal_log_std, self.fs, 
+                blocksize=self.blocksize, rng=rng, 
+                mixing=self.sound_mixing)
         
         ## Generate intervals 
-        # left target
-        if left_on and left_target_rate > 1e-3:
-            # Change of basis
-            mean_interval = 1 / left_target_rate
-            var_interval = target_temporal_std ** 2
-
-            # Change of basis
-            gamma_shape = (mean_interval ** 2) / var_interval
-            gamma_scale = var_interval / mean_interval
-
-            # Draw
-            left_target_intervals = np.random.gamma(
-                gamma_shape, gamma_scale, 100)
-        else:
-            left_target_intervals = np.array([])
-
-        # right target
-        if right_on and right_target_rate > 1e-3:
-            # Change of basis
-            mean_interval = 1 / right_target_rate
-            var_interval = target_temporal_std ** 2
-
-            # Change of basis
-            gamma_shape = (mean_interval ** 2) / var_interval
-            gamma_scale = var_interval / mean_interval
-
-            # Draw
-            right_target_intervals = np.random.gamma(
-                gamma_shape, gamma_scale, 100)
+        left_target_intervals = draw_intervals(
+            left_target_rate, target_temporal_log_std, rng=rng)
+        right_target_intervals = draw_intervals(
+            right_target_rate, target_temporal_log_std, rng=rng)
+        
+        ## Sort all the drawn intervals together
+        # This is all numpy, so that the first sound plays as soon as
+        # possible after a "Reward Port:" message
+        audio_times = schedule_intervals(
+            left_target_intervals, right_target_intervals, 
+            self.fs, self.blocksize)
+        
+        ## With mixing, each sound is placed at its exact sample
+        if self.sound_mixing:
+            times = audio_times['time']
+            if len(times) == 0:
+                onsets = []
+                period = 0
+            else:
+                # The first sound starts right away, and the cycle repeats
+                # when the sound after the last one would have started
+                onsets = np.rint((times - times[0]) * self.fs).astype(int)
+                period = int(np.rint(
+                    (times[-1] + audio_times['gap'][-1] - times[0]) * self.fs))
+            
+            return SoundMixer(
+                stimuli, repeat_bursts(onsets, audio_times['side'], period),
+                blocksize=self.blocksize, burst_times=audio_times)
+        
+        ## Depends on how many sounds there are
+        # If there are only a few, results will be weird,
+        # because it might just be one noise burst repeating every ten seconds
+        # This only happens with low rates ~0.1Hz
+        n_sounds = len(audio_times['time'])
+        if n_sounds == 0:
+            # If no sound, then just put gaps
+            onsets = []
+            stim_ids = []
+            n_frames = 100
         else:
-            right_target_intervals = np.array([])              
+            # Each sound is followed by its gap
+            # The gap is not shortened by the duration of the sound, and 
+            # sounds can't overlap. Use `sound_mixing` for that.
+            stim_ids = audio_times['side']
+            
+            # Each sound lasts as many frames as it has chunks
+            stim_len = np.array([len(chunks) for chunks in stimuli])
+            event_len = stim_len[stim_ids] + audio_times['gap_chunks']
+            
+            # The first sound starts at frame 0, and each one after that
+            # starts when the previous sound and gap are done
+            onsets = np.concatenate([[0], np.cumsum(event_len)[:-1]])
+            n_frames = event_len.sum()
         
-        #print(left_target_intervals)
-        #print(right_target_intervals)
-
         
-        ## Sort all the drawn intervals together
-        # Turn into series
-        left_target_df = pd.DataFrame.from_dict({
-            'time': np.cumsum(left_target_intervals),
-            'side': ['left'] * len(left_target_intervals),
-            'sound': ['target'] * len(left_target_intervals),
-            })
-        right_target_df = pd.DataFrame.from_dict({
-            'time': np.cumsum(right_target_intervals),
-            'side': ['right'] * len(right_target_intervals),
-            'sound': ['target'] * len(right_target_intervals),
-            })
-
-        # Concatenate them all together and resort by time
-        both_df = pd.concat([
-            left_target_df, right_target_df], axis=0).sort_values('time')
+        ## Cycle so it can repeat forever
+        # Only the schedule is stored, frames are generated when needed
+        return SoundCycle(
+            stimuli, onsets, stim_ids, n_frames, blocksize=self.blocksize,
+            burst_times=audio_times)
 
-        # Calculate the gap between sounds
-        both_df['gap'] = both_df['time'].diff().shift(-1)
+    def prerender_next_trial(self, *parameter_ranges):
+        """Start building the next trial in a background thread
         
-        # Drop the last row which has a null gap
-        both_df = both_df.loc[~both_df['gap'].isnull()].copy()
-
-        # Keep only those below the sound cycle length
-        both_df = both_df.loc[both_df['time'] < 10].copy()
+        The parameters of the next trial are drawn from `parameter_ranges`
+        (the arguments of `update_parameters`), and its stimuli and a
+        schedule for each side are built. `advance_trial` and `start_trial`
+        then only have to swap them in. Nothing happens if the next trial
+        has already been started or built.
+        """
+        if self.next_trial is not None:
+            return
+        if self.prerender_thread is not None and self.prerender_thread.is_alive():
+            return
         
-        # Nothing should be null
-        assert not both_df.isnull().any().any() 
-
-        # Calculate gap size in chunks
-        both_df['gap_chunks'] = (both_df['gap'] * (self.fs / self.blocksize))
-        both_df['gap_chunks'] = both_df['gap_chunks'].round().astype(int)
+        # A Generator can't be shared between threads, so the thread gets
+        # its own, seeded from ours so that seeded sessions stay repeatable
+        rng = np.random.default_rng(self.rng.integers(2 ** 63))
+        
+        self.prerender_thread = threading.Thread(
+            target=self.prerender, 
+            args=(self.prerender_id, parameter_ranges, rng), 
+            daemon=True)
+        self.prerender_thread.start()
+
+    def prerender(self, prerender_id, parameter_ranges, rng):
+        """Build the next trial (runs in the prerendering thread)"""
+        # Don't inherit the realtime priority of the thread that refills
+        # the ring, which runs on the same core
+        drop_realtime()
+        
+        parameters = self.draw_parameters(*parameter_ranges)
+        stimuli = self.make_stimuli(parameters, self.blocksize, self.fs)
+        chunks = [stim.chunks for stim in stimuli]
+        
+        # The GUI hasn't chosen the next port yet, so build both sides
+        schedules = {
+            'left': self.make_schedule(
+                chunks, parameters['target_rate'], 0, 
+                parameters['target_temporal_log_std'], rng),
+            'right': self.make_schedule(
+                chunks, 0, parameters['target_rate'], 
+                parameters['target_temporal_log_std'], rng),
+            }
         
-        # Floor gap_chunks at 1 chunk, the minimal gap size
-        # This is to avoid distortion
-        both_df.loc[both_df['gap_chunks'] < 1, 'gap_chunks'] = 1
+        # Drop it if it was cancelled in the meantime
+        if prerender_id == self.prerender_id:
+            self.next_trial = {
+                'parameters': parameters,
+                'stimuli': stimuli,
+                'schedules': schedules,
+                }
+
+    def cancel_prerender(self):
+        """Forget any prerendered trial, eg because the task changed"""
+        self.prerender_id = self.prerender_id + 1
+        self.next_trial = None
+        self.ready_schedules = {}
+
+    def advance_trial(self, *parameter_ranges):
+        """Switch to the sound parameters of the next trial
         
-        # Save
-        self.current_audio_times_df = both_df.copy()
-        self.current_audio_times_df = self.current_audio_times_df.rename(
-            columns={'time': 'relative_time'})
+        If the next trial has been prerendered, this only swaps it in.
+        Otherwise the parameters are drawn from `parameter_ranges` and the
+        sounds are built now.
+        
+        Returns: the parameter message that is sent to the GUI
+        """
+        next_trial = self.next_trial
+        if next_trial is None:
+            self.cancel_prerender()
+            parameter_message = self.update_parameters(*parameter_ranges)
+            self.initialize_sounds(self.blocksize, self.fs, 
+                self.amplitude, self.target_highpass, self.target_lowpass)
+            return parameter_message
+        
+        # Swap in the prerendered trial
+        self.next_trial = None
+        parameter_message = self.apply_parameters(next_trial['parameters'])
+        self.left_target_stim, self.right_target_stim = next_trial['stimuli']
+        self.ready_schedules = next_trial['schedules']
+        return parameter_message
 
+    def start_trial(self, mode):
+        """Start playing sounds from channel `mode` ('left' or 'right')
         
-        ## Depends on how long both_df is
-        # If both_df has a nonzero but short length, results will be weird,
-        # because it might just be one noise burst repeating every ten seconds
-        # This only happens with low rates ~0.1Hz
-        #print(both_df)
-        if len(both_df) == 0:
-            # If no sound, then just put gaps
-            append_gap(100)
+        This uses the prerendered schedule for that side if there is one,
+        and otherwise builds a new one with `set_sound_cycle`. Either way
+        the queue should be emptied first.
+        """
+        self.set_channel(mode)
+        
+        # Each prerendered schedule is only used once
+        schedule = self.ready_schedules.get(mode)
+        self.ready_schedules = {}
+        
+        if schedule is None:
+            self.set_sound_cycle()
         else:
-            # Iterate through the rows, adding the sound and the gap
-            # TODO: the gap should be shorter by the duration of the sound,
-            # and simultaneous sounds should be possible
-            for bdrow in both_df.itertuples():
-                # Append the sound
-                if bdrow.side == 'left' and bdrow.sound == 'target':
-                    for frame in self.left_target_stim.chunks:
-                        self.sound_block.append(frame)
-                        #print(frame.shape)
-                        assert frame.shape == (1024, 2)
-                elif bdrow.side == 'right' and bdrow.sound == 'target':
-                    for frame in self.right_target_stim.chunks:
-                        self.sound_block.append(frame)
-                        #print(frame.shape)
-                        assert frame.shape == (1024, 2)                        
-                else:
-                    raise ValueError(
-                        "unrecognized side and sound: {} {}".format(
-                        bdrow.side, bdrow.sound))
-                
-                # Append the gap
-                append_gap(bdrow.gap_chunks)
+            self.sound_schedule = schedule
+            self.sound_cycle = iter(self.sound_schedule)
+
+    def set_seed(self, seed=None):
+        """Reseed the intervals between sounds, eg for a new task config
+        
+        seed : int or None
+            If None, fresh entropy is used
+        """
+        self.rng = np.random.default_rng(seed)
+
+    @property
+    def current_audio_times(self):
+        """Timing of each sound, see sound_cycle.schedule_intervals
         
+        In 'stream' mode these are the most recently generated sounds,
+        timed from the start of the stream.
+        """
+        return self.sound_schedule.audio_times()
+
+    @property
+    def current_audio_times_df(self):
+        """The sounds in the current cycle as a DataFrame
         
-        ## Cycle so it can repeat forever
-        self.sound_cycle = itertools.cycle(self.sound_block)        
+        This is only built when asked for, so that pandas is not needed
+        to start a trial.
+        """
+        if self.current_audio_times is None:
+            return None
+        
+        import pandas as pd
+        df = pd.DataFrame.from_dict({
+            'relative_time': self.current_audio_times['time'],
+            'side': [SIDE_NAMES[side] for side in self.current_audio_times['side']],
+            'sound': ['target'] * len(self.current_audio_times['side']),
+            'gap': self.current_audio_times['gap'],
+            'gap_chunks': self.current_audio_times['gap_chunks'],
+            })
+        return df
 
     def play(self):
         """A single stage"""
@@ -472,46 +534,73 @@ class SoundQueue:
         This function should be called often enough that the queue is never
         empty.
         """        
-        # TODO: as a figure of merit, keep track of how empty the queue gets
-        # between calls. If it's getting too close to zero, then target_qsize
-        # needs to be increased.
         # Get the size of queue now
-        qsize = sound_queue.qsize()
+        qsize = sound_ring.qsize()
+        
+        # This is how empty the queue got since the last call, so use it
+        # to choose how full to keep the queue
+        if self.running:
+            self.target_qsize = self.depth_controller.observe(
+                qsize, sound_player.stats.n_underruns)
+        else:
+            self.depth_controller.skip()
 
         # Add frames until target size reached
-        while self.running ==True and qsize < self.target_qsize:
-            #with qlock:
+        if self.running:
+            qsize = self.fill_queue()
+            self.depth_controller.refilled(qsize)
+    
+    def fill_queue(self):
+        """Add frames from `self.sound_cycle` until `self.target_qsize`
+        
+        Unlike `append_sound_to_queue_as_needed`, this fills the queue
+        whether or not `self.running`, so that a trial can be queued up
+        before it starts.
+        
+        Returns: the depth of the queue afterward
+        """
+        qsize = sound_ring.qsize()
+        while qsize < self.target_qsize:
+            # Peek before taking a frame, so none is lost if the ring is full
+            # This only happens right after a flush, until `process` catches up
+            if not sound_ring.has_room():
+                break
+
             # Add a frame from the sound cycle
+            # This is copied into shared memory, no pickling involved
             frame = next(self.sound_cycle)
-            #frame = np.random.uniform(-.01, .01, (1024, 2)) 
-            sound_queue.put_nowait(frame)
+            onset_events = self.sound_schedule.onset_events
+            try:
+                ring_idx = sound_ring.put_nowait(frame)
+            except queue.Full:
+                onset_events.clear()
+                break
+            
+            # Remember where each sound in this frame starts, so that the
+            # time it is played can be sent to the GUI
+            while onset_events:
+                offset, stim_id = onset_events.popleft()
+                sound_player.onset_log.add(ring_idx, offset, stim_id)
             
             # Keep track of how many frames played
             self.n_frames = self.n_frames + 1
             
             # Update qsize
-            qsize = sound_queue.qsize()
+            qsize = sound_ring.qsize()
+        
+        return qsize
             
     def empty_queue(self, tosize=0):
-        """Empty queue"""
-        while True:
-            # I think it's important to keep the lock for a short period
-            # (ie not throughout the emptying)
-            # in case the `process` function needs it to play sounds
-            # (though if this does happen, there will be an artefact because
-            # we just skipped over a bunch of frames)
-            #with qlock:
-            try:
-                data = sound_queue.get_nowait()
-            except queue.Empty:
-                break
-            
-            # Stop if we're at or below the target size
-            qsize = sound_queue.qsize()
-            if qsize < tosize:
-                break
+        """Empty queue
         
-        qsize = sound_queue.qsize()
+        This only moves the ring's SKIP_TO index, so it takes the same time
+        no matter how many frames are queued. The `process` callback skips
+        over the flushed frames the next time it runs, within one period.
+        """
+        sound_ring.flush(tosize)
+        
+        # The drop in depth is not due to `process`
+        self.depth_controller.skip()
     
     def set_channel(self, mode):
         """Controlling which channel the sound is played from """
@@ -565,10 +654,29 @@ class SoundPlayer(object):
         # TODO: add control over verbosity of debug messages
         print("Received blocksize {} and fs {}".format(self.blocksize, self.fs))
 
+        # The frames in `sound_ring` have a fixed size, which has to match
+        if self.blocksize != sound_ring.blocksize:
+            raise ValueError(
+                "jackd blocksize is {} but sound_ring holds frames of {}".format(
+                self.blocksize, sound_ring.blocksize))
+
         ## Set up outchannels
         self.client.outports.register('out_0')
         self.client.outports.register('out_1')
         
+        ## Preallocate everything that `process` needs
+        # `process` runs in jack's realtime thread, where allocating memory
+        # or printing can cause an xrun
+        self.silence = np.zeros(self.blocksize, dtype='float32')
+        self.outports = list(self.client.outports)
+        self.n_outports = len(self.outports)
+        
+        # Underruns, callback durations, and queue depth at entry
+        self.stats = CallbackStats()
+        
+        # Frame time at which each frame was played, to timestamp sounds
+        self.onset_log = OnsetLog(self.fs)
+        
         ## Set up the process callback
         # This will be called on every block and must provide data
         self.client.set_process_callback(self.process)
@@ -589,43 +697,363 @@ class SoundPlayer(object):
     def process(self, frames):
         """Process callback function (used to play sound)
         
-        TODO: reimplement this to use a queue instead
-        The current implementation uses time.time(), but we need to be more
-        precise.
+        Frames are read directly out of `sound_ring`, which lives in shared
+        memory, so nothing has to be unpickled here. Nothing is allocated
+        here either: silence and the per-column views of every slot were
+        made ahead of time.
         """
-        # Check if the queue is empty
-        if sound_queue.empty():
+        start_ns = time.perf_counter_ns()
+        depth = sound_ring.qsize()
+        
+        # Find the slot of the next frame without making a view of it
+        slot = sound_ring.peek_slot()
+        
+        # Check if the ring is empty
+        if slot < 0:
             # No sound to play, so play silence 
-            # Although this shouldn't be happening
-
-            for n_outport, outport in enumerate(self.client.outports):
-                buff = outport.get_array()
-                buff[:] = np.zeros(self.blocksize, dtype='float32')
+            # This is an underrun if a trial is supposed to be playing
+            for n_outport in range(self.n_outports):
+                np.copyto(self.outports[n_outport].get_array(), self.silence)
+            self.stats.record(start_ns, depth, sound_chooser.running)
             
         else:
-            # Queue is not empty, so play data from it
-            data = sound_queue.get()
-            if data.shape != (self.blocksize, 2):
-                print(data.shape)
-            assert data.shape == (self.blocksize, 2)
-
+            # Ring is not empty, so play data from it
             # Write one column to each channel
-            for n_outport, outport in enumerate(self.client.outports):
-                buff = outport.get_array()
-                buff[:] = data[:, n_outport]
-
-# Defining a common queue to be used by both classes 
-# Initializing queues to be used by sound player
-sound_queue = mp.Queue()
+            columns = sound_ring.columns[slot]
+            for n_outport in range(self.n_outports):
+                np.copyto(self.outports[n_outport].get_array(), columns[n_outport])
+            
+            # The frame is played starting at the frame time of this cycle
+            self.onset_log.clock(
+                sound_ring.read_index(), self.client.last_frame_time)
+            
+            # Release the slot so it can be refilled
+            sound_ring.advance()
+            self.stats.record(start_ns, depth, False)
+
+# The audio process is always forked, even where the default start method
+# is 'spawn' or 'forkserver' (the default on Linux from Python 3.14). Those
+# would re-run this script in the child, and it would not inherit
+# `sound_ring`.
+fork_context = mp.get_context('fork')
+
+class AudioProcess(fork_context.Process):
+    """Process that generates and plays sound.
+    
+    SoundQueue and SoundPlayer are created in this process, as the globals
+    `sound_chooser` and `sound_player`, so that the jack callback and the
+    loop that refills `sound_ring` never wait on the GIL for poke callbacks
+    or zmq. It is pinned to its own core, and the refill loop can run under
+    SCHED_FIFO.
+    
+    The main loop controls it through the methods below. Those that return
+    something wait for the reply, the rest return right away. Messages for
+    the GUI (audio stats, sound onsets) come back through `messages`.
+    
+    It is started with the 'fork' start method, from `fork_context`, so
+    that the child inherits `sound_ring` and `params`.
+    """
+    def __init__(self, name='audio_process', cpus=None, 
+        realtime_priority=None, warmup=2.0, poll_interval=0.01,
+        stats_interval=5.0, onsets_interval=0.25):
+        """Describe the process. It is not started until `start`.
+        
+        name : str
+            Name of the process, and of the jack client
+        cpus : set or None
+            CPUs to pin the process to. If None, it is not pinned.
+        realtime_priority : int or None
+            SCHED_FIFO priority of the refill loop. If None, it runs at
+            normal priority.
+        warmup : float
+            Seconds to run before freezing the garbage collector
+        poll_interval : float
+            Longest the refill loop waits for a command, in seconds
+        stats_interval : float
+            How often to send the audio callback stats, in seconds
+        onsets_interval : float
+            How often to send the times that sounds were played, in seconds
+        """
+        super(AudioProcess, self).__init__()
+        
+        self.name = name
+        self.cpus = cpus
+        self.realtime_priority = realtime_priority
+        self.warmup = warmup
+        self.poll_interval = poll_interval
+        self.stats_interval = stats_interval
+        self.onsets_interval = onsets_interval
+        
+        # (command, args, wants_reply) from the main loop
+        self.commands = fork_context.Queue()
+        
+        # Return values of commands that want a reply
+        self.replies = fork_context.Queue()
+        
+        # Strings to send on to the GUI
+        self.messages = fork_context.Queue()
+        
+        # Set once the jack client is active
+        self.ready_evt = fork_context.Event()
+        self.quit_evt = fork_context.Event()
+    
+    ## Methods called from the main loop
+    def wait_until_ready(self, timeout=30.0):
+        """Block until the jack client has been set up"""
+        deadline = time.perf_counter() + timeout
+        while not self.ready_evt.wait(0.1):
+            if not self.is_alive():
+                raise RuntimeError(
+                    "{} exited with code {} while starting".format(
+                    self.name, self.exitcode))
+            if time.perf_counter() > deadline:
+                raise RuntimeError(
+                    "{} was not ready within {} s".format(self.name, timeout))
+    
+    def send(self, command, *args):
+        """Run `command` in the audio process, without waiting"""
+        self.commands.put((command, args, False))
+    
+    def call(self, command, *args):
+        """Run `command` in the audio process and return its result"""
+        self.commands.put((command, args, True))
+        while True:
+            try:
+                reply = self.replies.get(timeout=1.0)
+            except queue.Empty:
+                if not self.is_alive():
+                    raise RuntimeError("{} exited".format(self.name))
+                continue
+            if isinstance(reply, Exception):
+                raise reply
+            return reply
+    
+    def configure(self, config_data, parameter_ranges):
+        """Apply a task config. Returns the parameter message."""
+        return self.call('configure', config_data, parameter_ranges)
+    
+    def start_trial(self, mode, parameter_ranges):
+        """Start playing sounds from `mode` ('left' or 'right')"""
+        self.send('start_trial', mode, parameter_ranges)
+    
+    def stop_sound(self):
+        """Stop playing and empty the queue"""
+        self.send('stop_sound')
+    
+    def advance_trial(self, parameter_ranges):
+        """Switch to the next trial. Returns the parameter message."""
+        return self.call('advance_trial', parameter_ranges)
+    
+    def cancel_prerender(self):
+        self.send('cancel_prerender')
+    
+    def pending_messages(self):
+        """Return the messages for the GUI sent since the last call"""
+        messages = []
+        while True:
+            try:
+                messages.append(self.messages.get_nowait())
+            except queue.Empty:
+                return messages
+    
+    def quit(self, timeout=5.0):
+        """Stop the jack client and wait for the process to exit"""
+        self.quit_evt.set()
+        self.join(timeout)
+        if self.is_alive():
+            self.terminate()
+            self.join()
+    
+    ## Methods that run in the audio process
+    def run(self):
+        global sound_chooser, sound_player
+        
+        # Before creating the client, so that its thread inherits this
+        if self.cpus is not None:
+            pin_to_cpus(self.cpus)
+        
+        sound_chooser = SoundQueue()
+        sound_player = SoundPlayer(name=self.name)
+        
+        # Handlers of each command from the main loop
+        self.handlers = {
+            'configure': self.handle_configure,
+            'start_trial': self.handle_start_trial,
+            'stop_sound': self.handle_stop_sound,
+            'advance_trial': self.handle_advance_trial,
+            'cancel_prerender': self.handle_cancel_prerender,
+            }
+        
+        # Only the refill loop in this thread, not jack's callback thread
+        # or the threads started later
+        if self.realtime_priority is not None:
+            set_fifo_priority(self.realtime_priority)
+        
+        self.ready_evt.set()
+        
+        try:
+            self.refill_loop()
+        except KeyboardInterrupt:
+            # The main process handles it
+            pass
+        finally:
+            sound_player.client.deactivate()
+            sound_player.client.close()
+    
+    def refill_loop(self):
+        """Keep `sound_ring` full and run commands until `quit`"""
+        start_time = time.perf_counter()
+        frozen = False
+        last_stats_time = time.time()
+        last_onsets_time = time.time()
+        
+        while not self.quit_evt.is_set():
+            ## Run commands, or wait up to `poll_interval` for one
+            timeout = self.poll_interval
+            while True:
+                try:
+                    command, args, wants_reply = self.commands.get(
+                        timeout=timeout)
+                except queue.Empty:
+                    break
+                self.run_command(command, args, wants_reply)
+                timeout = 0
+            
+            sound_chooser.append_sound_to_queue_as_needed()
+            
+            ## Once everything is set up, stop the GC from scanning it
+            if not frozen and time.perf_counter() - start_time > self.warmup:
+                print("Froze {} objects after warmup".format(self.freeze_gc()))
+                frozen = True
+            
+            ## Periodically report on the audio callback
+            if sound_chooser.running and (
+                    time.time() - last_stats_time > self.stats_interval):
+                self.messages.put(
+                    sound_player.stats.format_snapshot() + ", " + 
+                    sound_chooser.depth_controller.format_status())
+                last_stats_time = time.time()
+            
+            ## Send the times that sounds were played, in batches
+            if time.time() - last_onsets_time > self.onsets_interval:
+                onsets = sound_player.onset_log.collect(
+                    sound_player.client.frame_time, time.time())
+                if len(onsets) > 0:
+                    self.messages.put(format_onsets(onsets, SIDE_NAMES))
+                last_onsets_time = time.time()
+    
+    def freeze_gc(self):
+        """Run `freeze_gc` from the refill loop, at normal priority
+        
+        Its full collection can take many milliseconds, so this thread
+        drops out of SCHED_FIFO for it, and only then goes back.
+        
+        Returns: the number of frozen objects
+        """
+        if self.realtime_priority is not None:
+            drop_realtime()
+        n_frozen = freeze_gc()
+        if self.realtime_priority is not None:
+            set_fifo_priority(self.realtime_priority)
+        return n_frozen
+    
+    def run_command(self, command, args, wants_reply):
+        """Run one command, and reply with its result if asked to"""
+        try:
+            result = self.handlers[command](*args)
+        except Exception as e:
+            if not wants_reply:
+                raise
+            result = e
+        if wants_reply:
+            self.replies.put(result)
+    
+    def handle_configure(self, config_data, parameter_ranges):
+        # How to generate the sequence of sounds, and its random seed
+        # Older configs don't have these
+        sound_chooser.sound_mode = config_data.get('sound_mode', 'cycle')
+        sound_chooser.set_seed(config_data.get('seed'))
+        sound_chooser.sound_mixing = config_data.get('sound_mixing', False)
+        sound_chooser.noise_backend = config_data.get('noise_backend', 'butter')
+        sound_chooser.noise_bank = config_data.get('noise_bank', False)
+        
+        # Anything prerendered was built with the old parameters
+        sound_chooser.cancel_prerender()
+        
+        # Draw the parameters of the first trial and build its sounds
+        new_params = sound_chooser.update_parameters(*parameter_ranges)
+        sound_chooser.initialize_sounds(sound_player.blocksize, sound_player.fs, 
+            sound_chooser.amplitude, sound_chooser.target_highpass, sound_chooser.target_lowpass)
+        sound_chooser.set_sound_cycle()
+        
+        # Debug print
+        print("Parameters updated")
+        print("Noise cache:", sound_chooser.noise_cache.stats())
+        print("Stimulus store:", sound_chooser.stimulus_store.stats())
+        
+        # The new stimuli and caches last for the whole session
+        self.freeze_gc()
+        
+        return new_params
+    
+    def handle_start_trial(self, mode, parameter_ranges):
+        # Flush and refill before setting `running`, so that `process`
+        # never finds the ring empty at a trial start and counts it as an
+        # underrun. There is room to refill right away, because the ring
+        # has twice the slots of the deepest queue.
+        # `running` is also cleared while the previous trial is flushed.
+        # This is a pointer swap if this trial was prerendered
+        sound_chooser.running = False
+        sound_chooser.empty_queue()
+        sound_chooser.start_trial(mode)
+        sound_chooser.fill_queue()
+        
+        # Starting sound
+        sound_chooser.running = True
+        
+        # Start building the next trial in the background
+        if parameter_ranges is not None:
+            sound_chooser.prerender_next_trial(*parameter_ranges)
+    
+    def handle_stop_sound(self):
+        sound_chooser.running = False
+        sound_chooser.set_channel('none')
+        sound_chooser.empty_queue()
+    
+    def handle_advance_trial(self, parameter_ranges):
+        # The next trial was usually prerendered while this one was
+        # running, in which case this only swaps it in
+        return sound_chooser.advance_trial(*parameter_ranges)
+    
+    def handle_cancel_prerender(self):
+        sound_chooser.cancel_prerender()
+
+# Defining a common ring buffer to be used by both classes 
+# SoundQueue writes frames into it and SoundPlayer reads them out
+# It has room for twice the deepest queue, so that a flushed ring can
+# be refilled before `process` has skipped past the flushed frames
+# It is created before the audio process, which inherits it
+max_queue_depth = 400
+sound_ring = FrameRing(
+    n_slots=2 * max_queue_depth, blocksize=1024, n_channels=2)
 nonzero_blocks = mp.Queue()
 
-# Lock for thread-safe set_channel() updates
-qlock = mp.Lock()
+# Lock for the nonzero_blocks queue
 nb_lock = mp.Lock()
 
-# Define a client to play sounds
-sound_chooser = SoundQueue()
-sound_player = SoundPlayer(name='sound_player')
+## Start the process that generates and plays sounds
+# It gets a core to itself (by default the last one) and everything else
+# in this process, including the pigpio callbacks, runs on the others
+# For a core that nothing else runs on either, also add isolcpus=<core>
+# to /boot/cmdline.txt
+audio_cpus, main_cpus = split_cpus(params.get('audio_cpu'))
+sound_process = AudioProcess(name='sound_player', cpus=audio_cpus,
+    realtime_priority=params.get('audio_realtime_priority'))
+sound_process.start()
+sound_process.wait_until_ready()
+if main_cpus != audio_cpus:
+    pin_to_cpus(main_cpus)
+startup_profiler.mark('sound')
 
 # Raspberry Pi's identity (Change this to the identity of the Raspberry Pi you are using)
 # TODO: what is the difference between pi_identity and pi_name? # They are functionally the same, this line is from before I imported 
@@ -641,6 +1069,17 @@ poke_socket = poke_context.socket(zmq.DEALER)
 # Setting the identity of the socket in bytes
 poke_socket.identity = bytes(f"{pi_identity}", "utf-8") 
 
+## Sockets for events from the poke callbacks
+# zmq sockets are not thread-safe, so the pigpio callbacks never send on
+# poke_socket. They push their events to `callback_inbox` instead, which
+# wakes the main loop right away to forward them (see `queue_event`).
+# pigpio runs every callback on the same thread, so `callback_socket` is
+# only ever used by that one thread.
+callback_inbox = poke_context.socket(zmq.PULL)
+callback_inbox.bind("inproc://callback_events")
+callback_socket = poke_context.socket(zmq.PUSH)
+callback_socket.connect("inproc://callback_events")
+
 
 ## Creating a ZeroMQ context and socket for receiving JSON files
 # TODO: what information travels over this socket? Clarify: do messages on
@@ -653,6 +1092,14 @@ json_socket = json_context.socket(zmq.SUB)
 ## Connect to the server
 # Connecting to IP address (192.168.0.99 for laptop, 192.168.0.207 for seaturtle)
 router_ip = "tcp://" + f"{params['gui_ip']}" + f"{params['poke_port']}" 
+
+# Watch whether the GUI is there, so that agent mode only announces this
+# Pi to a GUI that can receive it (see `update_gui_connected`)
+# This has to start before connecting, to see the first connection
+poke_monitor = poke_socket.get_monitor_socket(
+    zmq.EVENT_CONNECTED | zmq.EVENT_DISCONNECTED)
+gui_connected = False
+
 poke_socket.connect(router_ip) 
 
 # Send the identity of the Raspberry Pi to the server
@@ -670,6 +1117,7 @@ json_socket.subscribe(b"")
 
 # Print acknowledgment
 print(f"Connected to router at {router_ip2}")  
+startup_profiler.mark('sockets')
 
 ## Pigpio configuration
 # TODO: move these methods into a Nosepoke object. That object should be
@@ -687,6 +1135,34 @@ right_poke_detected = False
 current_port_poked = None
 poke_time = None
 
+## State of the current trial, for rewarding on this Pi
+# The GUI chooses the reward port and sends it with "Reward Port:". If it
+# is one of this Pi's ports, the trial is 'armed' and the poke callback
+# opens the valve itself, instead of waiting for "Reward Poke Completed"
+# to come back from the GUI. The trial is then 'rewarded' until the ITI
+# is over, and 'idle' when there is nothing to reward here.
+# `trial_lock` guards this and `prev_port`, which the callbacks read.
+trial_state = 'idle'
+trial_lock = threading.Lock()
+
+# pigpio tick of the last poke at each port, to time the valve against
+last_poke_ticks = {}
+
+# (port, poke tick, valve tick) of each reward given by a poke callback,
+# for the main loop to finish the trial
+reward_events = queue.Queue()
+
+## Journal of every event sent to the GUI
+# Each event is numbered and appended to a file on this Pi before it is
+# sent, and a background thread fsyncs the file in batches. If the GUI
+# misses events (it crashed, or the WiFi dropped), it asks for them again
+# by sequence number (see `replay_events`). A new file is started every
+# time this script starts.
+journal_path = os.path.join(
+    params.get('journal_dir', 'journals'), 
+    f"{pi_name}_{datetime.now().strftime('%Y-%m-%d_%H-%M-%S')}.events")
+event_journal = EventJournal(journal_path)
+
 # Callback function for nosepoke pin (When the nosepoke is completed)
 def poke_inL(pin, level, tick):
     global a_state, left_poke_detected
@@ -722,6 +1198,9 @@ def poke_inR(pin, level, tick):
 def poke_detectedL(pin, level, tick): 
     global a_state, count, left_poke_detected, current_port_poked, poke_time
     
+    # Before anything else, so the valve opens as soon as possible
+    reward_if_correct(int(params['nosepokeL_id']), tick)
+    
     a_state = 1
     count += 1
     left_poke_detected = True
@@ -739,17 +1218,20 @@ def poke_detectedL(pin, level, tick):
     # Get current datetime
     poke_time = datetime.now()
         
-    # Sending nosepoke_id wirelessly with datetime
+    # Sending nosepoke_id wirelessly with the time of the beam break
     try:
         print(f"Sending nosepoke_id = {nosepoke_idL} at {poke_time}") 
-        poke_socket.send_string(f"{nosepoke_idL}")
-        poke_socket.send_string(f"Poke Time: {poke_time}")
+        queue_event(event_protocol.POKE, (time_on_gui(tick),), 
+            port=int(nosepoke_idL), tick=tick)
     except Exception as e:
         print("Error sending nosepoke_id:", e)
 
 def poke_detectedR(pin, level, tick): 
     global a_state, count, right_poke_detected, current_port_poked, poke_time 
     
+    # Before anything else, so the valve opens as soon as possible
+    reward_if_correct(int(params['nosepokeR_id']), tick)
+    
     a_state = 1
     count += 1
     right_poke_detected = True
@@ -767,57 +1249,334 @@ def poke_detectedR(pin, level, tick):
     # Get current datetime
     poke_time = datetime.now()
     
-    # Sending nosepoke_id wirelessly with datetime
+    # Sending nosepoke_id wirelessly with the time of the beam break
     try:
         print(f"Sending nosepoke_id = {nosepoke_idR} at {poke_time}") 
-        poke_socket.send_string(f"{nosepoke_idR}")
-        poke_socket.send_string(f"Poke Time: {poke_time}")
+        queue_event(event_protocol.POKE, (time_on_gui(tick),), 
+            port=int(nosepoke_idR), tick=tick)
     except Exception as e:
         print("Error sending nosepoke_id:", e)
 
 
-def open_valve(port):
+## Valve of each port on this Pi
+# TODO: these need to be stored as parameters, not hardcoded here
+valve_pins = {
+    int(params['nosepokeL_id']): 6,
+    int(params['nosepokeR_id']): 26,
+    }
+
+## Timing of the end of a trial
+# How long the LEDs flash for, in seconds
+flash_duration = 0.5
+
+# Inter-trial interval after the valve closes, in seconds
+iti_duration = 1.0
+
+def open_valve(port, delay=0.0, from_callback=False):
     """Open the valve for port
     
+    This returns right away, and `pin_scheduler` closes the valve. The
+    GUI is sent a VALVE event with the time it opens.
+    
     port : TODO document what this is
+    delay : how long to wait before opening it, in seconds
+    from_callback : True if called from the pigpio callback thread
     TODO: reward duration needs to be a parameter of the task or mouse # It is in the test branch
+    
+    Returns: how long the valve is open for, in seconds
     """
     reward_value = config_data['reward_value']
-    if port == int(params['nosepokeL_id']):
-        pi.set_mode(6, pigpio.OUTPUT)
-        pi.write(6, 1)
-        time.sleep(reward_value)
-        pi.write(6, 0)
-    
-    if port == int(params['nosepokeR_id']):
-        pi.set_mode(26, pigpio.OUTPUT)
-        pi.write(26, 1)
-        time.sleep(reward_value)
-        pi.write(26, 0)
-
-# TODO: document this function
+    if port in valve_pins:
+        pin_scheduler.pulse(valve_pins[port], reward_value, delay)
+        
+        tick = (pi.get_current_tick() + int(delay * 1e6)) & 0xFFFFFFFF
+        send = queue_event if from_callback else send_event
+        send(event_protocol.VALVE, (time_on_gui(tick), reward_value * 1e3), 
+            port=port, tick=tick)
+    
+    return reward_value
+
+def arm_trial(port):
+    """Reward the next poke on `port`, which is on this Pi"""
+    global prev_port, trial_state
+    with trial_lock:
+        prev_port = port
+        
+        # Poketrain rewards every poke from the main loop instead
+        trial_state = 'idle' if task == 'Poketrain' else 'armed'
+
 def flash():
-    pi.set_mode(22, pigpio.OUTPUT)
-    pi.write(22, 1)
-    pi.set_mode(11, pigpio.OUTPUT)
-    pi.write(11, 1)
-    time.sleep(0.5)
-    pi.write(22, 0)
-    pi.write(11, 0)  
+    """Flash the LEDs on pins 22 and 11 for `flash_duration`
+    
+    This returns right away, and `pin_scheduler` turns them off.
+    """
+    pin_scheduler.pulse(22, flash_duration)
+    pin_scheduler.pulse(11, flash_duration)
+    
+    tick = pi.get_current_tick()
+    send_event(event_protocol.LED_FLASH, 
+        (time_on_gui(tick), flash_duration * 1e3), tick=tick)
+
+def send_event(event_type, values, port=0, tick=0):
+    """Send an event to the GUI in the binary format of event_protocol.py
+    
+    It is numbered and journaled by `event_journal` first, which doesn't
+    wait for the disk. Main loop only: the poke callbacks use `queue_event`.
+    
+    Returns: the sequence number of the event
+    """
+    seq, frames = event_journal.append(event_type, values, port, tick)
+    poke_socket.send_multipart(frames)
+    return seq
+
+def queue_event(event_type, values, port=0, tick=0):
+    """Like `send_event`, but for the pigpio callback thread
+    
+    The event is numbered and journaled here, and the main loop sends it
+    on to the GUI as soon as it arrives on `callback_inbox`.
+    
+    Returns: the sequence number of the event
+    """
+    seq, frames = event_journal.append(event_type, values, port, tick)
+    callback_socket.send_multipart(frames)
+    return seq
+
+def forward_callback_events():
+    """Send the events queued by the poke callbacks to the GUI"""
+    while True:
+        try:
+            frames = callback_inbox.recv_multipart(zmq.NOBLOCK)
+        except zmq.Again:
+            return
+        poke_socket.send_multipart(frames)
+
+def replay_events(msg):
+    """Send events that the GUI missed again, from the journal
+    
+    `msg` is "Replay Events: <first seq> <last seq>". The events are sent
+    as they were, but flagged as REPLAYED.
+    """
+    try:
+        first, last = [int(value) for value in msg.split(":", 1)[1].split()]
+    except ValueError:
+        print("Invalid message format.")
+        return
+    
+    events = event_journal.read(first, last)
+    for event in events:
+        poke_socket.send_multipart(event_protocol.encode(
+            event.type, event.values, event.port, event.tick, event.seq, 
+            flags=event_protocol.REPLAYED))
+    print(f"Replayed {len(events)} events from {first} to {last}")
+
+def time_on_gui(tick):
+    """Return the time of the pigpio tick `tick` on the GUI's clock
+    
+    This is NaN until `clock_sync` has enough samples, and the GUI then
+    uses the time it received the event instead.
+    """
+    if not clock_sync.synchronized:
+        return float('nan')
+    return clock_sync.to_remote(tick_clock.seconds(tick))
+
+def send_onsets(message):
+    """Send a SOUND_ONSET event for each onset in a "Sound Onsets" message
+    
+    The audio process stamps onsets with this Pi's time.time(). They are
+    moved onto the tick clock that `clock_sync` is fit to, by the offset
+    between the two clocks now, and then onto the GUI's clock like the
+    pokes. Must only be called once `clock_sync` is synchronized.
+    """
+    wall_to_tick = tick_clock.seconds(pi.get_current_tick()) - time.time()
+    for wall_time, side, frame_time in parse_onsets(message):
+        send_event(event_protocol.SOUND_ONSET, (
+            clock_sync.to_remote(wall_time + wall_to_tick), 
+            event_protocol.SIDES.index(side), frame_time))
+
+def send_clock_ping():
+    """Send the GUI a ping to sample the offset between the clocks
+    
+    The GUI replies with a CLOCK_REPLY event, which is passed to
+    `receive_clock_reply` as soon as it is received. Pings are not
+    journaled, since a stale one is of no use. Instead each one carries
+    the number of events journaled so far, so the GUI can ask for any it
+    missed even when no other events are being sent.
+    """
+    # This also keeps `tick_clock` from losing track of wraps
+    tick = pi.get_current_tick()
+    tick_clock.update(tick)
+    
+    # Events the callbacks numbered before the ping go out before it, so
+    # the GUI doesn't ask for them again
+    forward_callback_events()
+    poke_socket.send_multipart(event_protocol.encode(
+        event_protocol.CLOCK_PING, (tick_clock.seconds(tick),), tick=tick, 
+        seq=event_journal.next_seq()))
+
+def receive_clock_reply(event):
+    """Add the reply to a clock ping to `clock_sync`"""
+    global n_clock_replies
+    t3 = tick_clock.seconds(pi.get_current_tick())
+    t0, t1, t2 = event.values
+    was_synchronized = clock_sync.synchronized
+    clock_sync.add_sample(t0, t1, t2, t3)
+    n_clock_replies += 1
+    
+    # Log when it first has an estimate, and then every so often
+    if clock_sync.synchronized and (
+            not was_synchronized or n_clock_replies % 60 == 0):
+        print(clock_sync.format_status())
+
+def reward_if_correct(port, tick):
+    """Open the valve if `port` is the armed reward port
+    
+    This is called from the pigpio poke callbacks, so the valve opens
+    without a round trip to the GUI. The rest of the trial is finished by
+    the main loop, from `reward_events`.
+    
+    port : the port that was poked
+    tick : pigpio tick of the poke, in microseconds
+    
+    Returns: True if the poke was rewarded
+    """
+    global trial_state
+    last_poke_ticks[port] = tick
+    
+    with trial_lock:
+        if trial_state != 'armed' or port != prev_port:
+            return False
+        trial_state = 'rewarded'
+    
+    open_valve(port, from_callback=True)
+    reward_events.put((port, tick, pi.get_current_tick()))
+    return True
+
+def start_reward(port, decided_by, poke_tick, valve_tick):
+    """Finish a trial whose valve was just opened
+    
+    This stops the sound, flashes the LEDs and starts the inter-trial
+    interval, and tells the GUI how long after the poke the valve opened.
+    
+    port : the port that was rewarded
+    decided_by : 'pi' if rewarded by the poke callback, 'gui' if by
+        "Reward Poke Completed"
+    poke_tick, valve_tick : pigpio ticks of the poke and of the valve
+        opening, or None if not known
+    """
+    global iti_pending
+    
+    # Emptying the queue completely
+    sound_process.stop_sound()
+    flash()
+    
+    # Adding an inter trial interval
+    # The trial is finished by `end_iti` once it is over, and until then
+    # the next "Reward Port" message is held
+    iti_pending = True
+    pin_scheduler.call_later(config_data['reward_value'] + iti_duration, end_iti)
+    
+    # Poke-to-water latency of this trial, logged by the GUI
+    if poke_tick is not None and valve_tick is not None:
+        latency_ms = pigpio.tickDiff(poke_tick, valve_tick) / 1000
+        print(f"Reward at port {port} decided by {decided_by}, "
+            f"{latency_ms:.2f} ms after the poke")
+        send_event(event_protocol.REWARD, 
+            (event_protocol.DECIDED_BY.index(decided_by), latency_ms), 
+            port=port, tick=poke_tick)
+
+def end_iti():
+    """Finish a rewarded trial once the inter-trial interval is over
+    
+    This is run by `pin_scheduler.run_due` in the main loop, and then the
+    held messages that start the next trial are handled.
+    """
+    global current_pin, iti_pending, trial_state
+    iti_pending = False
+    with trial_lock:
+        trial_state = 'idle'
+    
+    # Updating Parameters
+    # TODO: fix this; rate_min etc are not necessarily defined
+    # yet, or haven't changed recently
+    # Reset play mode to 'none'
+    # The next trial was usually prerendered while this one was
+    # running, in which case this only swaps it in
+    new_params = sound_process.advance_trial((
+        rate_min, rate_max, irregularity_min, irregularity_max, 
+        amplitude_min, amplitude_max, center_freq_min, center_freq_max, bandwidth))
+    poke_socket.send_string(new_params)
+    
+    # Turn off the currently active LED
+    if current_pin is not None:
+        pi.write(current_pin, 0)
+        print("Turning off currently active LED.")
+        current_pin = None  # Reset the current LED
+    else:
+        print("No LED is currently active.")
+
+def next_message():
+    """Return the next message from the GUI to handle now, or None
+    
+    Messages that start a trial ("Reward Port") wait in `held_messages`
+    until the inter-trial interval is over, or until it starts if this Pi
+    has already opened the valve. Anything else is handled right away.
+    
+    The GUI resends the reward port after every message, so only the
+    last of the held "Reward Port" messages is kept.
+    """
+    waiting = iti_pending or trial_state == 'rewarded'
+    for n, msg in enumerate(held_messages):
+        if not msg.startswith("Reward Port:"):
+            return held_messages.pop(n)
+        if waiting:
+            continue
+        if any(later.startswith("Reward Port:") for later in held_messages[n + 1:]):
+            # Superseded by a later one
+            held_messages.pop(n)
+            return next_message()
+        return held_messages.pop(n)
+    return None
 
 # Function with logic to stop session
 def stop_session():
-    global reward_pin, current_pin, prev_port
+    global reward_pin, current_pin, prev_port, iti_pending, trial_state
+    
+    # Close any open valve, and drop the rest of the inter-trial interval
+    # along with the trial it was holding back
+    pin_scheduler.cancel()
+    iti_pending = False
+    held_messages.clear()
+    
     flash()
     current_pin = None
-    prev_port = None
+    with trial_lock:
+        prev_port = None
+        trial_state = 'idle'
     pi.write(17, 0)
     pi.write(10, 0)
     pi.write(27, 0)
     pi.write(9, 0)
-    sound_chooser.set_channel('none')
-    sound_chooser.empty_queue()
-    sound_chooser.running = False
+    sound_process.stop_sound()
+
+# Function to get ready for the next session in agent mode
+def end_session():
+    """Forget the task of the session that ended
+    
+    Everything that is slow to set up (the jack client, pigpio, the
+    sockets, and the stimulus caches) is kept for the next session.
+    """
+    global task, parameter_ranges, count, session_active, clock_sync
+    sound_process.cancel_prerender()
+    
+    # The next session may be run by a GUI on another computer
+    # Onsets that were never put on this GUI's clock can't go to the next
+    clock_sync = ClockSync()
+    held_onsets.clear()
+    
+    task = None
+    parameter_ranges = None
+    count = 0
+    session_active = False
 
 ## Set up pigpio and callbacks
 # TODO: rename this variable to pig or something; "pi" is ambiguous
@@ -827,11 +1586,32 @@ pi.callback(nosepoke_pinL, pigpio.RISING_EDGE, poke_detectedL)
 pi.callback(nosepoke_pinR, pigpio.FALLING_EDGE, poke_inR)
 pi.callback(nosepoke_pinR, pigpio.RISING_EDGE, poke_detectedR)
 
+# Closes valves and turns off LEDs in the background
+pin_scheduler = PinScheduler(pi)
+
+## Clock synchronization with the GUI
+# Pokes are timestamped with pigpio's tick, which is converted to seconds
+# by `tick_clock` and then to the GUI's clock by `clock_sync`
+# While a session is running, the GUI is pinged every
+# `clock_ping_interval` seconds, or faster until there are enough samples
+tick_clock = TickClock(pi.get_current_tick())
+clock_sync = ClockSync()
+n_clock_replies = 0
+
+# Messages of sound onsets waiting for `clock_sync` to be synchronized
+held_onsets = collections.deque(maxlen=1000)
+clock_ping_interval = 1.0
+fast_clock_ping_interval = 0.1
+last_clock_ping_time = time.time()
+startup_profiler.mark('pigpio')
+
 ## Create a Poller object
 # TODO: document .. What is this?
 poller = zmq.Poller()
 poller.register(poke_socket, zmq.POLLIN)
 poller.register(json_socket, zmq.POLLIN)
+poller.register(callback_inbox, zmq.POLLIN)
+poller.register(poke_monitor, zmq.POLLIN)
 
 ## Initialize variables for sound parameters
 # These are not sound parameters .. TODO document
@@ -854,6 +1634,49 @@ amplitude_max = 0.0
 # Storing the type of task (mainly for poketrain)
 task = None
 
+# Ranges of the sound parameters, received with the task config
+parameter_ranges = None
+
+## Inter-trial interval
+# Whether the interval after a reward is still running, and the messages
+# from the GUI that are waiting for it to end
+iti_pending = False
+held_messages = []
+
+## Agent mode
+# The process outlives sessions, and announces this Pi to the GUI every
+# `announce_interval` seconds until the next session starts
+# Announcements are only sent while a GUI is connected. Otherwise they
+# would queue up on poke_socket, block the main loop once the queue is
+# full, and then all reach the next GUI at once.
+agent_mode = args.agent or params.get('agent_mode', False)
+session_active = False
+announce_interval = 5.0
+last_announce_time = time.time()
+
+def update_gui_connected():
+    """Keep track of whether poke_socket is connected to the GUI
+    
+    A GUI that has just connected is announced to right away.
+    """
+    global gui_connected, last_announce_time
+    while True:
+        try:
+            event = recv_monitor_message(poke_monitor, zmq.NOBLOCK)
+        except zmq.Again:
+            return
+        if event['event'] == zmq.EVENT_CONNECTED:
+            gui_connected = True
+            last_announce_time = 0
+        elif event['event'] == zmq.EVENT_DISCONNECTED:
+            gui_connected = False
+
+## Report how long it took to get here
+startup_profiler.mark('globals')
+print(f"Ready {startup_profiler.total():.2f} s after launch")
+if args.profile_startup:
+    print(startup_profiler.report())
+
 ## Main loop to keep the program running and exit when it receives an exit command
 try:
     ## TODO: document these variables and why they are tracked
@@ -870,9 +1693,61 @@ try:
     while True:
         ## Wait for events on registered sockets
         # TODO: how long does it wait? # Can be set, currently not sure
-        socks = dict(poller.poll(100))
+        # Wake up in time for the next deferred call, and don't wait at all
+        # if there are held messages that can be handled now
+        poll_timeout = pin_scheduler.poll_timeout(100)
+        if len(held_messages) > 0 and not iti_pending:
+            poll_timeout = 0
+        socks = dict(poller.poll(poll_timeout))
+
+        ## Send the pokes from the callbacks first, they are the most urgent
+        if callback_inbox in socks:
+            forward_callback_events()
+
+        ## Run deferred calls that are due, eg the end of the ITI
+        pin_scheduler.run_due()
+        
+        ## Finish trials that were rewarded by the poke callbacks
+        while not reward_events.empty():
+            port, poke_tick, valve_tick = reward_events.get()
+            start_reward(port, 'pi', poke_tick, valve_tick)
+        
+        ## Pass on the audio stats and sound onsets from the audio process
+        # It refills the ring by itself, so it doesn't depend on this loop
+        if not sound_process.is_alive():
+            raise RuntimeError("The audio process exited unexpectedly")
+        # Sound onsets wait until they can be put on the GUI's clock
+        for message in sound_process.pending_messages():
+            if message.startswith("Sound Onsets"):
+                held_onsets.append(message)
+            else:
+                poke_socket.send_string(message)
+        if clock_sync.synchronized:
+            while held_onsets:
+                send_onsets(held_onsets.popleft())
+        
+        ## Sample the offset between this Pi's clock and the GUI's
+        # Only during sessions, because the GUI doesn't read messages
+        # between them, and stale pings would pile up
+        if clock_sync.synchronized:
+            ping_interval = clock_ping_interval
+        else:
+            ping_interval = fast_clock_ping_interval
+        if session_active and time.time() - last_clock_ping_time > ping_interval:
+            send_clock_ping()
+            last_clock_ping_time = time.time()
         
-        sound_chooser.append_sound_to_queue_as_needed()
+        ## Between sessions, make sure the next GUI knows about this Pi
+        if poke_monitor in socks:
+            update_gui_connected()
+        if agent_mode and not session_active and gui_connected and (
+                time.time() - last_announce_time > announce_interval):
+            # Never wait for the GUI, in case it just went away
+            try:
+                poke_socket.send_string(f"{pi_identity}", zmq.NOBLOCK)
+            except zmq.Again:
+                pass
+            last_announce_time = time.time()
         
         ## Check for incoming messages on json_socket
         # If so, use it to update the acoustic parameters
@@ -881,6 +1756,7 @@ try:
             # Receive the data (this is blocking) # Forgot to remove comment after implementing poller
             # TODO: what does blocking mean here? How long does it block?
             json_data = json_socket.recv_json()
+            session_active = True
             
             # Deserialize JSON data
             config_data = json.loads(json_data)
@@ -900,22 +1776,19 @@ try:
             center_freq_max = config_data['center_freq_max']
             bandwidth = config_data['bandwidth']
             
-            
-            # Update the jack client with the new acoustic parameters
-            new_params = sound_chooser.update_parameters(
+            # Store the ranges that each trial's parameters are drawn from
+            parameter_ranges = (
                 rate_min, rate_max, irregularity_min, irregularity_max, 
                 amplitude_min, amplitude_max, center_freq_min, center_freq_max, bandwidth)
-            poke_socket.send_string(new_params)
-            sound_chooser.initialize_sounds(sound_player.blocksize, sound_player.fs, 
-                sound_chooser.amplitude, sound_chooser.target_highpass, sound_chooser.target_lowpass)
-            sound_chooser.set_sound_cycle()
             
-            # Debug print
-            print("Parameters updated")
+            # Update the audio process with the new acoustic parameters
+            # The sound mode, seed, mixing and noise options are read from
+            # `config_data` there
+            new_params = sound_process.configure(config_data, parameter_ranges)
+            poke_socket.send_string(new_params)
             
         if task == 'Poketrain':
-            sound_chooser.empty_queue()
-            sound_chooser.set_channel('none')
+            sound_process.stop_sound()
             if left_poke_detected == True :
                 open_valve(int(params['nosepokeL_id']))
                 print('Left port open')
@@ -930,10 +1803,39 @@ try:
         if poke_socket in socks and socks[poke_socket] == zmq.POLLIN:
             # Blocking receive: #flags=zmq.NOBLOCK)  
             # Non-blocking receive
-            msg = poke_socket.recv_string()  
+            frames = poke_socket.recv_multipart()
+            
+            # Events have two frames, and commands are one string
+            # Clock replies are timed as soon as they arrive
+            if len(frames) == 2:
+                event = event_protocol.decode(frames)
+                if event.type == event_protocol.CLOCK_REPLY:
+                    receive_clock_reply(event)
+                else:
+                    print("Unexpected event received:", event)
+            else:
+                msg = frames[0].decode('utf-8')
+                
+                # Replays don't have to wait for the ITI
+                if msg.startswith("Replay Events:"):
+                    replay_events(msg)
+                else:
+                    held_messages.append(msg)
+        
+        # Take the next message that doesn't have to wait for the ITI
+        msg = next_message()
+        if msg is not None:
+            session_active = True
     
             # Different messages have different effects
-            if msg == 'exit': 
+            if msg == 'exit' and agent_mode:
+                # End the session, but keep running for the next one
+                stop_session()
+                end_session()
+                print("Received exit command. Waiting for the next session.")
+                continue
+            
+            if msg == 'exit' or msg == 'shutdown': 
                 # Condition to terminate the main loop
                 # TODO: why are these pi.write here? # To turn the LEDs on the Pi off when the GUI is closed
                 stop_session()
@@ -943,10 +1845,9 @@ try:
                 # TODO: why is this here? It's already deactivated 
                 ##time.sleep(sound_player.noise.target_rate + sound_player.noise.target_temporal_log_std)
                 
-                # Stop the Jack client
-                # TODO: Probably want to leave this running for the next
-                # session
-                sound_player.client.deactivate()
+                # Stop the Jack client and the audio process
+                # Use --agent to leave this running for the next session
+                sound_process.quit()
                 
                 # Exit the loop
                 break  
@@ -991,9 +1892,6 @@ try:
                 
                 # Manipulate pin values based on the integer value
                 if value == int(params['nosepokeL_id']):
-                    # Starting sound
-                    sound_chooser.running = True
-                    
                     # Reward pin for left
                     # TODO: these reward pins need to be stored as a parameter,
                     # not hardcoded here
@@ -1006,23 +1904,20 @@ try:
                     pi.set_PWM_dutycycle(reward_pin, pwm_duty_cycle)
                     
                     # Playing sound from the left speaker
-                    sound_chooser.empty_queue()
-                    sound_chooser.set_channel('left')
-                    sound_chooser.set_sound_cycle()
-                    sound_chooser.play()
+                    # This is a pointer swap if this trial was prerendered,
+                    # and then the next trial is built in the background
+                    sound_process.start_trial('left', parameter_ranges)
                     
                     # Debug message
                     print(f"Turning port {value} green")
 
                     # Keep track of which port is rewarded and which pin
                     # is rewarded
-                    prev_port = value
+                    # Pokes on it are now rewarded by `reward_if_correct`
+                    arm_trial(value)
                     current_pin = reward_pin # for LED only 
 
                 elif value == int(params['nosepokeR_id']):
-                    # Starting sound
-                    sound_chooser.running = True
-                    
                     # Reward pin for right
                     # TODO: these reward pins need to be stored as a parameter,
                     # not hardcoded here                    
@@ -1035,74 +1930,83 @@ try:
                     pi.set_PWM_dutycycle(reward_pin, pwm_duty_cycle)
                     
                     # Playing sound from the right speaker
-                    sound_chooser.empty_queue()
-                    sound_chooser.set_channel('right')
-                    sound_chooser.set_sound_cycle()
-                    sound_chooser.play()
+                    # This is a pointer swap if this trial was prerendered,
+                    # and then the next trial is built in the background
+                    sound_process.start_trial('right', parameter_ranges)
 
                     # Debug message
                     print(f"Turning port {value} green")
                     
                     # Keep track of which port is rewarded and which pin
                     # is rewarded
-                    prev_port = value
+                    # Pokes on it are now rewarded by `reward_if_correct`
+                    arm_trial(value)
                     current_pin = reward_pin
                 
                 else:
                     # TODO: document why this happens
                     # Current Reward Port
-                    prev_port = value
+                    # It is on another Pi, so the GUI decides the reward
+                    with trial_lock:
+                        prev_port = value
+                        trial_state = 'idle'
                     print(f"Current Reward Port: {value}")
                 
             elif msg.startswith("Reward Poke Completed"):
-                # This seems to occur when the GUI detects that the poked
-                # port was rewarded. This will be too slow. The reward port
-                # should be opened if it knows it is the rewarded pin. 
+                # This occurs when the GUI detects that the poked port was
+                # rewarded. If the port is on this Pi, the poke callback
+                # has usually opened the valve already.
+                with trial_lock:
+                    already_rewarded = trial_state == 'rewarded'
+                    trial_state = 'rewarded'
+                if already_rewarded:
+                    print("Reward already given by this Pi")
+                    continue
                 
-                # Emptying the queue completely
-                sound_chooser.running = False
-                sound_chooser.set_channel('none')
-                sound_chooser.empty_queue()
-
+                # Otherwise the port is on another Pi (and this does
+                # nothing but the flash and ITI), or the poke came before
+                # this Pi was armed
                 # Opening Solenoid Valve
-                flash()
+                # Neither of these blocks, so pokes, configs and audio
+                # stats are still handled while the valve is open
                 open_valve(prev_port)
-                
-                # Adding an inter trial interval
-                time.sleep(1)
-                
-                # Updating Parameters
-                # TODO: fix this; rate_min etc are not necessarily defined
-                # yet, or haven't changed recently
-                # Reset play mode to 'none'
-                new_params = sound_chooser.update_parameters(
-                    rate_min, rate_max, irregularity_min, irregularity_max, 
-                    amplitude_min, amplitude_max, center_freq_min, center_freq_max, bandwidth)
-                poke_socket.send_string(new_params)
-                
-                
-                # Turn off the currently active LED
-                if current_pin is not None:
-                    pi.write(current_pin, 0)
-                    print("Turning off currently active LED.")
-                    current_pin = None  # Reset the current LED
-                else:
-                    print("No LED is currently active.")
+                valve_tick = pi.get_current_tick()
+                start_reward(prev_port, 'gui', 
+                    last_poke_ticks.get(prev_port), 
+                    valve_tick if prev_port in valve_pins else None)
            
             else:
                 print("Unknown message received:", msg)
 
 
 except KeyboardInterrupt:
-    # Stops the pigpio connection
+    # Close the valves and stops the pigpio connection
+    pin_scheduler.stop()
     pi.stop()
 
 finally:
     # Close all sockets and contexts
+    callback_socket.close(linger=0)
+    callback_inbox.close(linger=0)
+    poke_socket.disable_monitor()
+    poke_monitor.close(linger=0)
     poke_socket.close()
     poke_context.term()
     json_socket.close()
     json_context.term()
+    
+    # Close any valve that is still open
+    pin_scheduler.stop()
+    
+    # Write the rest of the journal
+    event_journal.close()
+    
+    # Stop the audio process if it is still running, eg after Ctrl+C
+    sound_process.quit()
+    
+    # Remove the shared memory block used by the ring buffer
+    # The mapping itself stays valid in case `process` is still running
+    sound_ring.unlink()
         
     
 
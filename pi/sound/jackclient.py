@@ -6,7 +6,6 @@ try:
 except ModuleNotFoundError:
     PIGPIO_AVAILABLE = False
 
-import datetime
 import time
 import typing
 import multiprocessing as mp
@@ -26,13 +25,63 @@ import jack
 if typing.TYPE_CHECKING:
     pass
 
+def tag_frame(data, frame_id):
+    """Attach an id and a nonzero flag to a frame of audio
+    
+    Call this where frames are generated, and put the result on QUEUE
+    instead of the bare array, so that `JackClient.process` doesn't have to
+    inspect the data to know whether it is sound and which frame it is.
+    
+    data : np.ndarray
+        The frame of audio
+    frame_id : int
+        Any integer that identifies this frame, eg a running count
+    
+    Returns: tuple (frame_id, nonzero, data)
+    """
+    return (int(frame_id), bool(np.any(data)), data)
+
+# Running count of the frames queued by `queue_frames`, used as their ids
+_frame_ids = itertools.count()
+
+def queue_frames(frames, q=None, lock=None):
+    """Tag each frame with the next id and put it on QUEUE
+    
+    This is the producer side of `tag_frame`. Nothing in this repository
+    fills QUEUE itself, so code that plays sound through JackClient should
+    buffer it with this function. Bare arrays put straight on QUEUE still
+    play, but `process` then has to inspect them and logs them with id -1.
+    
+    frames : iterable of np.ndarray
+        Frames of audio, each `BLOCKSIZE` samples long
+    q : mp.Queue or None
+        Queue to put them on. If None, QUEUE
+    lock : mp.Lock or None
+        Lock to hold around each put. If None, Q_LOCK
+    
+    Returns: list of the ids given to the frames, in order
+    """
+    if q is None:
+        q = globals()['QUEUE']
+    if lock is None:
+        lock = globals()['Q_LOCK']
+    
+    frame_ids = []
+    for data in frames:
+        frame_id = next(_frame_ids)
+        with lock:
+            q.put_nowait(tag_frame(data, frame_id))
+        frame_ids.append(frame_id)
+    return frame_ids
+
 class JackClient(mp.Process):
     def __init__(self,
                  name='jack_client',
                  outchannels: typing.Optional[list] = None,
                  debug_timing:bool=False,
                  play_q_size:int=2048,
-                 disable_gc=False):
+                 disable_gc=False,
+                 nonzero_log_size:int=4096):
   
         super(JackClient, self).__init__()
 
@@ -53,8 +102,19 @@ class JackClient(mp.Process):
         self.q2_lock = mp.Lock()
         
         # This is for transferring the frametimes that audio was played
+        # Each item is (frame_id, last_frame_time, frames_since_cycle_start)
         self.q_nonzero_blocks = mp.Queue()
         self.q_nonzero_blocks_lock = mp.Lock()
+        
+        # `process` writes the same rows into this preallocated array, and
+        # `_drain_nonzero_log` moves them onto q_nonzero_blocks from a 
+        # thread that isn't realtime
+        self.nonzero_log_size = nonzero_log_size
+        self.nonzero_log = np.zeros((self.nonzero_log_size, 3), dtype=np.int64)
+        self.n_nonzero_logged = 0
+        self.n_nonzero_drained = 0
+        self.n_nonzero_dropped = 0
+        self.drainthread = None
 
         self._play_q = deque(maxlen=play_q_size)
 
@@ -147,6 +207,10 @@ class JackClient(mp.Process):
         
         # This is used for writing silence
         self.zero_arr = np.zeros((self.blocksize,1),dtype='float32')
+        
+        # Preallocated frames for `process`, so it doesn't allocate
+        self.silence = np.zeros((self.blocksize, 2), dtype='float32')
+        self.mix_buffer = np.zeros((self.blocksize, 2), dtype='float32')
 
         # Set the process callback to `self.process`
         # This gets called on every chunk of audio data
@@ -208,6 +272,9 @@ class JackClient(mp.Process):
             self.querythread = Thread(target=self._query_timebase)
             self.querythread.start()
 
+        self.drainthread = Thread(target=self._drain_nonzero_log, daemon=True)
+        self.drainthread.start()
+
         # we are just holding the process open, so wait to quit
         try:
             self.quit_evt.clear()
@@ -221,24 +288,28 @@ class JackClient(mp.Process):
 
     def process(self, frames):
         # Try to get data from the first queue
+        # Frames queued with `queue_frames` carry their id and nonzero flag
+        # Bare arrays are still accepted, with an id of -1
         try:
             with self.q_lock:
                 data = self.q.get_nowait()
         except queue.Empty:
-            data = np.transpose([
-                np.zeros(self.blocksize, dtype='float32'),
-                np.zeros(self.blocksize, dtype='float32'),
-                ])
+            frame_id, nonzero, data = -1, False, self.silence
+        else:
+            if isinstance(data, tuple):
+                frame_id, nonzero, data = data
+            else:
+                frame_id, nonzero = -1, bool(data.any())
 
         # Try to get data from the second queue
         try:
             with self.q2_lock:
                 data2 = self.q2.get_nowait()
         except queue.Empty:
-            data2 = np.transpose([
-                np.zeros(self.blocksize, dtype='float32'),
-                np.zeros(self.blocksize, dtype='float32'),
-                ])
+            data2 = self.silence
+        else:
+            if isinstance(data2, tuple):
+                data2 = data2[2]
         
         # Force to stereo
         if data.ndim == 1:
@@ -247,33 +318,29 @@ class JackClient(mp.Process):
             data2 = np.transpose([data2, data2])
         
         # Store the frame times where sound is played
-        # A loud sound has data_std .03
-        data_std = data.std()
-        if data_std > 1e-12:
+        if nonzero:
             # Pulse the pin
             # Use BCM 23 (board 16) = LED - C - Blue because we're not using it
             self.pig.write(23, True)
             
-            # This is only an approximate hash because it excludes the
-            # middle of the data
-            data_hash = hash(str(data))
-            
-            # Get the current time
+            # Log the time
             # lft is the only precise one, and it's at the start of the process
             # block
             # fscs is approx number of frames since then until now
-            # dt is about now
-            lft = self.client.last_frame_time
-            fscs = self.client.frames_since_cycle_start
-            dt = datetime.datetime.now().isoformat()
-            with self.q_nonzero_blocks_lock:
-                self.q_nonzero_blocks.put_nowait((data_hash, lft, fscs, dt))
+            # The row is only published by incrementing n_nonzero_logged
+            # after it has been written
+            n_row = self.n_nonzero_logged % self.nonzero_log_size
+            self.nonzero_log[n_row, 0] = frame_id
+            self.nonzero_log[n_row, 1] = self.client.last_frame_time
+            self.nonzero_log[n_row, 2] = self.client.frames_since_cycle_start
+            self.n_nonzero_logged += 1
         else:
             # Unpulse the pin
             self.pig.write(23, False)
         
         # Add
-        data = data + data2
+        np.add(data, data2, out=self.mix_buffer)
+        data = self.mix_buffer
 
         # Write
         self.write_to_outports(data)
@@ -351,6 +418,35 @@ class JackClient(mp.Process):
             self.querythread = None
             self.wait_until = None
 
+    def _drain_nonzero_log(self, interval=0.05):
+        """Move rows from `nonzero_log` onto `q_nonzero_blocks`
+        
+        Runs in its own thread so that `process` never touches the mp.Queue.
+        If this falls more than `nonzero_log_size` rows behind, the oldest
+        rows are overwritten and counted in `n_nonzero_dropped`.
+        """
+        while not self.quit_evt.is_set():
+            n_logged = self.n_nonzero_logged
+            
+            # Skip rows that were already overwritten
+            oldest = n_logged - self.nonzero_log_size
+            if self.n_nonzero_drained < oldest:
+                self.n_nonzero_dropped += oldest - self.n_nonzero_drained
+                self.n_nonzero_drained = oldest
+            
+            # Copy out the new rows before putting them, since `process`
+            # can overwrite them at any time
+            idx = np.arange(
+                self.n_nonzero_drained, n_logged) % self.nonzero_log_size
+            rows = self.nonzero_log[idx].tolist()
+            self.n_nonzero_drained = n_logged
+            
+            with self.q_nonzero_blocks_lock:
+                for row in rows:
+                    self.q_nonzero_blocks.put_nowait(tuple(row))
+            
+            time.sleep(interval)
+
     def _query_timebase(self):
         while not self.quit_evt.is_set():
             state, pos = self.client.transport_query()
@@ -0,0 +1,171 @@
+## Timed actuation of valves and LEDs without blocking the main loop
+# pi.py used to open a valve with pi.write, time.sleep, pi.write, and the
+# same for the LED flash and the inter-trial interval. Nothing was polled
+# while it slept. Here each change of a pin is put on a timer thread, and
+# the caller returns right away.
+#
+# pigpio waveforms could time the pulses in pigpiod instead, but only one
+# waveform can run at a time and they take over the pins from the PWM that
+# blinks the port LEDs. gpio_trigger only makes pulses up to 100 us. Pulses
+# here last 10s of ms or more, so a thread is accurate enough.
+
+import heapq
+import itertools
+import threading
+import time
+
+
+# Same as pigpio.OUTPUT, so this module doesn't need pigpio to import
+OUTPUT = 1
+
+
+class PinScheduler:
+    """Turns pins on and off at set times, from a background thread.
+
+    `pulse` returns right away and the pin is turned off later by the
+    thread. The pigpio.pi object is safe to share with the thread, because
+    it holds a lock around each command it sends to pigpiod.
+
+    Anything else that has to happen later but uses zmq sockets, which are
+    not thread-safe, is scheduled with `call_later` instead. Those calls
+    are run by the main loop, which calls `run_due` on every iteration.
+    """
+    def __init__(self, pig):
+        """Start the timer thread
+
+        Args:
+            pig (pigpio.pi): connection to pigpiod
+        """
+        self.pig = pig
+
+        # Guards everything below, and wakes the thread when it changes
+        self.cv = threading.Condition()
+
+        # Heap of (time, order, pin, level, pulse id) of each pin change
+        self.pin_events = []
+
+        # Heap of (time, order, function) to run in the main loop
+        self.calls = []
+
+        # Breaks ties between events at the same time, in order of scheduling
+        self.order = itertools.count()
+
+        # Id of the latest pulse on each pin, so that an older pulse ending
+        # doesn't cut a newer one short
+        self.pulse_ids = {}
+
+        self.stopped = False
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    ## Pin changes, run by the timer thread
+    def pulse(self, pin, duration, delay=0.0):
+        """Set `pin` high after `delay` s, and low `duration` s later"""
+        self.pig.set_mode(pin, OUTPUT)
+
+        now = time.monotonic()
+        with self.cv:
+            pulse_id = next(self.order)
+            self.pulse_ids[pin] = pulse_id
+            if delay > 0:
+                self.push_pin_event(now + delay, pin, 1, pulse_id)
+            self.push_pin_event(now + delay + duration, pin, 0, pulse_id)
+
+            # Turn on now, from this thread, rather than wait for the thread
+            # This is done while holding the lock, like the writes in `run`,
+            # so that neither `cancel` nor the end of a very short pulse can
+            # run before it and leave the pin on with nothing to turn it off
+            if delay <= 0:
+                self.pig.write(pin, 1)
+
+    def push_pin_event(self, when, pin, level, pulse_id):
+        heapq.heappush(
+            self.pin_events, (when, next(self.order), pin, level, pulse_id))
+        self.cv.notify()
+
+    def run(self):
+        """Make each pin change when it is due (timer thread)"""
+        while True:
+            # Write while holding the lock, so that `cancel` can't run
+            # between popping a change and making it
+            with self.cv:
+                event = self.wait_for_pin_event()
+                if event is None:
+                    return
+                when, order, pin, level, pulse_id = event
+                self.pig.write(pin, level)
+
+    def wait_for_pin_event(self):
+        """Wait until a pin change is due and pop it, or None once stopped
+
+        Changes from pulses that were superseded on the same pin are
+        dropped. Must be called with `cv` held.
+        """
+        while not self.stopped:
+            if len(self.pin_events) == 0:
+                self.cv.wait()
+                continue
+
+            wait = self.pin_events[0][0] - time.monotonic()
+            if wait > 0:
+                self.cv.wait(wait)
+                continue
+
+            event = heapq.heappop(self.pin_events)
+            pin, pulse_id = event[2], event[4]
+            if self.pulse_ids.get(pin) == pulse_id:
+                return event
+        return None
+
+    ## Deferred calls, run by the main loop
+    def call_later(self, delay, function):
+        """Run `function()` in the main loop `delay` s from now"""
+        with self.cv:
+            heapq.heappush(
+                self.calls, (time.monotonic() + delay, next(self.order), function))
+
+    def run_due(self):
+        """Run every deferred call that is due (main loop only)"""
+        while True:
+            with self.cv:
+                if len(self.calls) == 0 or self.calls[0][0] > time.monotonic():
+                    return
+                when, order, function = heapq.heappop(self.calls)
+            function()
+
+    def poll_timeout(self, longest):
+        """Milliseconds the main loop can wait before the next deferred call
+
+        Returns: at most `longest`
+        """
+        with self.cv:
+            if len(self.calls) == 0:
+                return longest
+            wait = self.calls[0][0] - time.monotonic()
+        return int(min(max(wait * 1000, 0), longest))
+
+    ## Cancelling
+    def cancel(self):
+        """Drop every scheduled event and deferred call
+
+        Any pin that is in the middle of a pulse is turned off now, so that
+        no valve is left open.
+        """
+        with self.cv:
+            active_pins = set([
+                pin for when, order, pin, level, pulse_id in self.pin_events
+                if level == 0 and self.pulse_ids.get(pin) == pulse_id])
+            self.pin_events = []
+            self.calls = []
+            self.pulse_ids = {}
+
+        for pin in sorted(active_pins):
+            self.pig.write(pin, 0)
+
+    def stop(self):
+        """Cancel everything and stop the timer thread"""
+        self.cancel()
+        with self.cv:
+            self.stopped = True
+            self.cv.notify()
+        self.thread.join()
@@ -0,0 +1,99 @@
+## Scheduling helpers for the process that generates and plays sound
+# pi.py runs sound in its own process (AudioProcess), so that poke
+# callbacks and zmq traffic never hold its GIL. These functions keep that
+# process on its own core, optionally under SCHED_FIFO, and keep the
+# garbage collector from walking the long-lived objects it set up.
+# Each one only prints a warning if the OS refuses, because the task can
+# still run without them, just with more jitter.
+
+import gc
+import os
+
+
+def available_cpus():
+    """Return the sorted list of CPUs this process is allowed to run on"""
+    return sorted(os.sched_getaffinity(0))
+
+
+def split_cpus(audio_cpu=None):
+    """Choose a core for audio and the cores for everything else
+
+    Args:
+        audio_cpu (int or None): the core to use for audio
+            If None, the last available core is used
+
+    Returns: (audio_cpus, other_cpus), each a set
+        With only one core, both are that core
+    """
+    cpus = available_cpus()
+    if audio_cpu is None:
+        audio_cpu = cpus[-1]
+    if audio_cpu not in cpus:
+        raise ValueError(
+            "audio_cpu {} is not one of the available CPUs {}".format(
+            audio_cpu, cpus))
+
+    other_cpus = set(cpus) - {audio_cpu}
+    if len(other_cpus) == 0:
+        other_cpus = {audio_cpu}
+    return {audio_cpu}, other_cpus
+
+
+def pin_to_cpus(cpus):
+    """Restrict the calling process to `cpus`
+
+    Threads started afterward inherit this, including the one that libjack
+    starts for the process callback, so call it before creating the client.
+
+    Returns: True if it worked
+    """
+    try:
+        os.sched_setaffinity(0, cpus)
+    except OSError as e:
+        print("Could not pin to CPUs {}: {}".format(sorted(cpus), e))
+        return False
+    return True
+
+
+def set_fifo_priority(priority):
+    """Run the calling thread under SCHED_FIFO at `priority` (1-99)
+
+    This needs root or CAP_SYS_NICE, or an rtprio limit in
+    /etc/security/limits.conf. Keep it below jackd's priority (-P75), so
+    that the jack process callback can still preempt this thread.
+
+    Returns: True if it worked
+    """
+    try:
+        os.sched_setscheduler(0, os.SCHED_FIFO, os.sched_param(priority))
+    except (OSError, AttributeError) as e:
+        print("Could not set SCHED_FIFO priority {}: {}".format(priority, e))
+        return False
+    return True
+
+
+def drop_realtime():
+    """Return the calling thread to normal scheduling
+
+    A thread that does heavy work (eg building stimuli) must call this if
+    it was started from a SCHED_FIFO thread. Otherwise it inherits the
+    realtime priority and can keep the thread that refills the ring from
+    running on the same core.
+    """
+    if os.sched_getscheduler(0) == os.SCHED_OTHER:
+        return
+    os.sched_setscheduler(0, os.SCHED_OTHER, os.sched_param(0))
+
+
+def freeze_gc():
+    """Collect garbage, then exempt every object left from future collections
+
+    Call this once setup is done. Objects that live for the whole session
+    (the ring, the caches, numpy arrays of stimuli) are then never scanned
+    again, which makes each later collection shorter.
+
+    Returns: the number of frozen objects
+    """
+    gc.collect()
+    gc.freeze()
+    return gc.get_freeze_count()
@@ -0,0 +1,450 @@
+## Compact description of the repeating sequence of sounds and gaps
+# SoundQueue used to build its cycle as a Python list containing every frame,
+# with a freshly allocated array of zeros for every silent frame. Here the
+# cycle is stored as a schedule of integer events (frame offset, stimulus id)
+# plus one shared silent frame, and frames are produced on demand.
+
+import collections
+import heapq
+import numpy as np
+
+
+## Stimulus ids of the target sounds on each side
+LEFT = 0
+RIGHT = 1
+SIDE_NAMES = {LEFT: 'left', RIGHT: 'right'}
+
+# Most onset events that are kept if nobody takes them, see `onset_events`
+MAX_ONSET_EVENTS = 1024
+
+
+def draw_intervals(rate, temporal_log_std, n_intervals=100, rng=None):
+    """Draw intervals between bursts from a gamma distribution.
+    
+    Args:
+        rate (float): mean rate of bursts in Hz
+            If this is below 1e-3, no intervals are drawn
+        temporal_log_std (float): log10 of the std of the intervals in s
+        n_intervals (int): how many intervals to draw
+        rng (np.random.Generator or None): where to draw from
+            If None, the global np.random state is used
+    
+    Returns: array of intervals in seconds
+    """
+    if rate <= 1e-3:
+        return np.array([])
+    
+    # Change of basis
+    mean_interval = 1 / rate
+    var_interval = (10 ** temporal_log_std) ** 2
+    
+    # Change of basis
+    gamma_shape = (mean_interval ** 2) / var_interval
+    gamma_scale = var_interval / mean_interval
+    
+    # Draw
+    if rng is None:
+        return np.random.gamma(gamma_shape, gamma_scale, n_intervals)
+    return rng.gamma(gamma_shape, gamma_scale, n_intervals)
+
+
+def schedule_intervals(left_intervals, right_intervals, fs, blocksize, 
+    cycle_duration=10):
+    """Merge left and right interval trains into one sorted burst schedule.
+    
+    The intervals on each side are summed into burst times, the two sides
+    are merged by time, and the gap from each burst to the next one is
+    computed. The last burst has no gap and is dropped, as are bursts at or
+    after `cycle_duration`. Gaps are rounded to a whole number of chunks,
+    with a minimum of 1 chunk to avoid distortion.
+    
+    Args:
+        left_intervals, right_intervals (array): intervals in seconds
+        fs (int): sampling rate
+        blocksize (int): samples per chunk
+        cycle_duration (float): length of the cycle in seconds
+    
+    Returns: dict of arrays, one entry per burst
+        'time': time of the burst in seconds from the start of the cycle
+        'side': LEFT or RIGHT
+        'gap': time to the next burst in seconds
+        'gap_chunks': gap rounded to chunks
+    """
+    # Burst times and sides, with left before right
+    times = np.concatenate([np.cumsum(left_intervals), np.cumsum(right_intervals)])
+    sides = np.concatenate([
+        np.full(len(left_intervals), LEFT), 
+        np.full(len(right_intervals), RIGHT)])
+    
+    # Merge the two sides by time
+    # A stable sort of two sorted runs is a merge
+    order = np.argsort(times, kind='stable')
+    times = times[order]
+    sides = sides[order]
+    
+    # Gap between each burst and the next, dropping the last burst
+    gaps = np.diff(times)
+    times = times[:-1]
+    sides = sides[:-1]
+    
+    # Keep only those below the sound cycle length
+    keep = times < cycle_duration
+    times = times[keep]
+    sides = sides[keep]
+    gaps = gaps[keep]
+    
+    # Calculate gap size in chunks, floored at 1 chunk
+    gap_chunks = np.rint(gaps * (fs / blocksize)).astype(int)
+    gap_chunks = np.maximum(gap_chunks, 1)
+    
+    return {
+        'time': times,
+        'side': sides,
+        'gap': gaps,
+        'gap_chunks': gap_chunks,
+        }
+
+
+class SoundCycle:
+    """A repeating schedule of stimuli separated by silence.
+
+    Rebuilding a SoundCycle costs O(number of bursts), not O(cycle length),
+    because silent frames are never materialized. Iterating over it yields
+    frames of shape (blocksize, n_channels) forever, like itertools.cycle.
+
+    The frames that are yielded are the stimulus chunks themselves and a
+    single read-only silent frame, so they must be copied (eg into the
+    ring buffer) and not modified in place.
+
+    Just before yielding a frame in which a burst starts, (sample offset
+    within the frame, stimulus id) is appended to `onset_events`. Whoever
+    takes the frame should also take these events.
+    """
+    def __init__(self, stimuli, onsets, stim_ids, n_frames, blocksize=1024,
+        n_channels=2, burst_times=None):
+        """Initialize a new cycle.
+
+        Args:
+            stimuli (list): for each stimulus id, a list of chunks
+                Each chunk has shape (blocksize, n_channels)
+            onsets (array of int): frame offset of each event in the cycle
+                Must be sorted.
+            stim_ids (array of int): stimulus id of each event
+            n_frames (int): total length of the cycle in frames
+            blocksize (int): number of samples per frame
+            n_channels (int): number of columns per frame
+            burst_times (dict or None): timing of each burst, in the format
+                returned by `schedule_intervals`
+        """
+        self.stimuli = stimuli
+        self.burst_times = burst_times
+        self.onsets = np.asarray(onsets, dtype=int)
+        self.stim_ids = np.asarray(stim_ids, dtype=int)
+        self.n_frames = int(n_frames)
+        self.blocksize = blocksize
+        self.n_channels = n_channels
+
+        # Error check
+        if len(self.onsets) != len(self.stim_ids):
+            raise ValueError(
+                "got {} onsets but {} stimulus ids".format(
+                len(self.onsets), len(self.stim_ids)))
+        if self.n_frames < 1:
+            raise ValueError(
+                "n_frames must be at least 1, not {}".format(self.n_frames))
+
+        # The one silent frame that is used for every gap
+        self.silence = np.zeros((blocksize, n_channels), dtype=np.float32)
+        self.silence.flags.writeable = False
+
+        # Onsets in the frame that was just yielded
+        self.onset_events = collections.deque(maxlen=MAX_ONSET_EVENTS)
+
+    def __len__(self):
+        return self.n_frames
+
+    def audio_times(self):
+        """Timing of each burst in the cycle, see `schedule_intervals`"""
+        return self.burst_times
+
+    def __iter__(self):
+        while True:
+            yield from self.one_pass()
+
+    def one_pass(self):
+        """Yield the frames of a single pass through the cycle
+
+        If a burst is still playing at the onset of the next one, the next
+        one starts as soon as the first one ends.
+        """
+        n_frame = 0
+        for onset, stim_id in zip(self.onsets, self.stim_ids):
+            # Silence until the onset
+            while n_frame < onset:
+                yield self.silence
+                n_frame += 1
+
+            # The stimulus
+            self.onset_events.append((0, int(stim_id)))
+            for chunk in self.stimuli[stim_id]:
+                yield chunk
+                n_frame += 1
+
+        # Silence until the end of the cycle
+        while n_frame < self.n_frames:
+            yield self.silence
+            n_frame += 1
+
+
+class SoundStream:
+    """An endless gamma-process sequence of stimuli separated by silence.
+
+    Unlike SoundCycle, nothing repeats: intervals are drawn a few at a time
+    from `rng` as frames are requested, so memory use does not grow with
+    the length of the session. Bursts on different stimulus ids are merged
+    by time and separated by gaps that are rounded and floored in the same
+    way as `schedule_intervals`.
+
+    As with SoundCycle, the frames that are yielded must not be modified,
+    and onsets are reported in `onset_events`.
+    """
+    def __init__(self, stimuli, rates, temporal_log_std, fs, blocksize=1024,
+        n_channels=2, rng=None, batch_size=16, log_size=1000, mixing=False):
+        """Initialize a new stream.
+
+        Args:
+            stimuli (list): for each stimulus id, a list of chunks
+                Each chunk has shape (blocksize, n_channels)
+            rates (list of float): for each stimulus id, its rate in Hz
+                Use 0 for stimuli that should not be played
+            temporal_log_std (float): log10 of the std of the intervals in s
+            fs (int): sampling rate
+            blocksize (int): number of samples per frame
+            n_channels (int): number of columns per frame
+            rng (np.random.Generator or None): where to draw intervals from
+                If None, a new unseeded Generator is used
+            batch_size (int): how many intervals to draw at a time
+            log_size (int): how many of the most recent bursts to keep in
+                the log returned by `audio_times`
+            mixing (bool): if True, play each burst at its exact time with a
+                SoundMixer, instead of one after another
+        """
+        self.stimuli = stimuli
+        self.rates = rates
+        self.temporal_log_std = temporal_log_std
+        self.fs = fs
+        self.blocksize = blocksize
+        self.n_channels = n_channels
+        self.batch_size = batch_size
+        self.mixing = mixing
+        
+        if rng is None:
+            self.rng = np.random.default_rng()
+        else:
+            self.rng = rng
+
+        # Error check
+        if len(self.rates) != len(self.stimuli):
+            raise ValueError(
+                "got {} rates but {} stimuli".format(
+                len(self.rates), len(self.stimuli)))
+
+        # Recent bursts, as (time, stim_id, gap, gap_chunks)
+        self.log = collections.deque(maxlen=log_size)
+
+        # Onsets in the frame that was just yielded
+        self.onset_events = collections.deque(maxlen=MAX_ONSET_EVENTS)
+
+        # The one silent frame that is used for every gap
+        self.silence = np.zeros((blocksize, n_channels), dtype=np.float32)
+        self.silence.flags.writeable = False
+
+    def audio_times(self):
+        """Timing of the most recently generated bursts
+        
+        Returns: dict of arrays in the format of `schedule_intervals`, 
+        with 'time' in seconds since the start of the stream
+        """
+        log = np.array(self.log, dtype=float).reshape(-1, 4)
+        return {
+            'time': log[:, 0],
+            'side': log[:, 1].astype(int),
+            'gap': log[:, 2],
+            'gap_chunks': log[:, 3].astype(int),
+            }
+
+    def draw_burst_times(self, stim_id):
+        """Yield (time, stim_id) of every burst of one stimulus forever"""
+        burst_time = 0.0
+        while True:
+            intervals = draw_intervals(
+                self.rates[stim_id], self.temporal_log_std,
+                n_intervals=self.batch_size, rng=self.rng)
+            for interval in intervals:
+                burst_time += interval
+                yield burst_time, stim_id
+
+    def scheduled_bursts(self):
+        """Yield (time, stim_id, gap_chunks) of every burst forever
+        
+        Each burst is added to the log as it is yielded.
+        """
+        # Stimuli with a negligible rate are never played
+        stim_ids = [
+            stim_id for stim_id, rate in enumerate(self.rates) if rate > 1e-3]
+        if len(stim_ids) == 0:
+            return
+
+        # Merge the bursts of all stimuli by time
+        # This is lazy, so only one pending burst per stimulus is in memory
+        bursts = heapq.merge(
+            *[self.draw_burst_times(stim_id) for stim_id in stim_ids])
+
+        # The gap of each burst is the time until the next one
+        burst_time, stim_id = next(bursts)
+        for next_time, next_stim_id in bursts:
+            # Calculate gap size in chunks, floored at 1 chunk
+            gap = next_time - burst_time
+            gap_chunks = max(1, int(np.rint(gap * (self.fs / self.blocksize))))
+            self.log.append((burst_time, stim_id, gap, gap_chunks))
+            yield burst_time, stim_id, gap_chunks
+            
+            burst_time, stim_id = next_time, next_stim_id
+
+    def __iter__(self):
+        bursts = self.scheduled_bursts()
+        
+        if self.mixing:
+            # Place each burst at its exact sample, relative to the first
+            first_time = None
+            def onsets():
+                nonlocal first_time
+                for burst_time, stim_id, gap_chunks in bursts:
+                    if first_time is None:
+                        first_time = burst_time
+                    yield int(np.rint((burst_time - first_time) * self.fs)), stim_id
+            
+            yield from SoundMixer(
+                self.stimuli, onsets(), blocksize=self.blocksize, 
+                n_channels=self.n_channels, onset_events=self.onset_events)
+            return
+        
+        # The first sound starts right away, and each one after that
+        # starts when the previous sound and gap are done
+        for burst_time, stim_id, gap_chunks in bursts:
+            # The stimulus
+            self.onset_events.append((0, int(stim_id)))
+            for chunk in self.stimuli[stim_id]:
+                yield chunk
+
+            # The gap
+            for n_frame in range(gap_chunks):
+                yield self.silence
+        
+        # If no sound, then just put gaps
+        while True:
+            yield self.silence
+
+
+def repeat_bursts(onsets, stim_ids, period):
+    """Yield (onset, stim_id) of a sorted set of bursts, repeated forever
+    
+    Args:
+        onsets (array of int): onset of each burst in samples
+        stim_ids (array of int): stimulus id of each burst
+        period (int): number of samples after which the bursts repeat
+    """
+    if len(onsets) == 0:
+        return
+    
+    offset = 0
+    while True:
+        for onset, stim_id in zip(onsets, stim_ids):
+            yield offset + int(onset), int(stim_id)
+        offset += period
+
+
+class SoundMixer:
+    """Sample-accurate mixer of possibly overlapping bursts.
+    
+    SoundCycle and SoundStream play bursts one after another, with gaps of 
+    whole chunks in between, so two bursts can never overlap and every gap
+    is lengthened by the duration of the burst. Here each burst is added 
+    into a rolling output buffer at its exact sample offset, so bursts
+    start exactly when scheduled and overlapping bursts are summed.
+    
+    Iterating yields frames of shape (blocksize, n_channels). Each frame is
+    a view into the rolling buffer and is only valid until the next frame
+    is requested, so it must be copied (eg into the ring buffer) right away.
+    As with SoundCycle, onsets are reported in `onset_events`.
+    """
+    def __init__(self, stimuli, bursts, blocksize=1024, n_channels=2, 
+        burst_times=None, onset_events=None):
+        """Initialize a new mixer.
+        
+        Args:
+            stimuli (list): for each stimulus id, a list of chunks
+                Each chunk has shape (blocksize, n_channels)
+            bursts (iterable): (onset, stim_id) of each burst, sorted by 
+                onset, where onset is in samples from the first frame
+                This can be infinite.
+            blocksize (int): number of samples per frame
+            n_channels (int): number of columns per frame
+            burst_times (dict or None): timing of each burst, in the format
+                returned by `schedule_intervals`
+            onset_events (deque or None): where to report onsets
+                If None, a new deque is used
+        """
+        self.blocksize = blocksize
+        self.n_channels = n_channels
+        self.bursts = bursts
+        self.burst_times = burst_times
+        
+        # Join the chunks of each stimulus back into one table
+        self.tables = [
+            np.concatenate(chunks) if len(chunks) > 0 
+            else np.zeros((0, n_channels), dtype=np.float32) 
+            for chunks in stimuli]
+        
+        # The buffer has to hold a burst that starts at the end of a frame
+        max_len = max([len(table) for table in self.tables] + [0])
+        n_blocks = int(np.ceil(max_len / blocksize)) + 1
+        self.buffer = np.zeros(
+            (n_blocks * blocksize, n_channels), dtype=np.float32)
+        
+        # Onsets in the frame that was just yielded
+        if onset_events is None:
+            onset_events = collections.deque(maxlen=MAX_ONSET_EVENTS)
+        self.onset_events = onset_events
+    
+    def audio_times(self):
+        """Timing of each burst, see `schedule_intervals`"""
+        return self.burst_times
+    
+    def __iter__(self):
+        bursts = iter(self.bursts)
+        pending = next(bursts, None)
+        self.buffer[:] = 0
+        
+        # Sample at the start of the frame currently in the buffer
+        frame_start = 0
+        while True:
+            # Add every burst that starts within this frame
+            frame_stop = frame_start + self.blocksize
+            while pending is not None and pending[0] < frame_stop:
+                onset, stim_id = pending
+                table = self.tables[stim_id]
+                
+                # A burst that is late is played right away
+                offset = max(0, onset - frame_start)
+                self.buffer[offset:offset + len(table)] += table
+                self.onset_events.append((offset, int(stim_id)))
+                
+                pending = next(bursts, None)
+            
+            yield self.buffer[:self.blocksize]
+            
+            # Roll the buffer forward by one frame
+            self.buffer[:-self.blocksize] = self.buffer[self.blocksize:]
+            self.buffer[-self.blocksize:] = 0
+            frame_start = frame_stop
@@ -0,0 +1,189 @@
+## Lock-free ring buffer of audio frames in shared memory
+# Replaces the mp.Queue that used to carry frames from SoundQueue to the
+# jack process callback. A mp.Queue pickles every frame and sends it down a
+# pipe, and then `process` has to unpickle it inside the realtime thread.
+# Here the frames live in one preallocated block of shared memory and the
+# callback copies a ready-made slice straight into the outports.
+
+import queue
+import numpy as np
+from multiprocessing import shared_memory
+
+
+## Layout of the header at the start of the shared memory block
+# Each entry is an int64 counter that only ever increases
+# The header is accessed through a memoryview, which is much cheaper than
+# indexing a numpy array in the realtime callback
+# WRITE_IDX is only written by the producer (the main loop)
+# READ_IDX is only written by the consumer (the jack process callback)
+# SKIP_TO is written by the producer to ask the consumer to drop frames
+WRITE_IDX = 0
+READ_IDX = 1
+SKIP_TO = 2
+N_HEADER = 8
+
+
+class FrameRing:
+    """Single-producer/single-consumer ring buffer of audio frames.
+
+    The ring holds `n_slots` frames, each of shape (blocksize, n_channels)
+    and dtype float32. The producer fills slots with `put_nowait` and the
+    consumer reads them with `peek` and `advance`. No locks are needed
+    because each counter in the header has exactly one writer, and a slot
+    is only published (by incrementing WRITE_IDX) after it has been copied.
+
+    `flush` sets SKIP_TO past every unread frame, and the consumer moves
+    its read index there on its next `peek`, so a flush takes effect
+    within one period no matter how deep the ring is.
+
+    Because the storage is a `multiprocessing.shared_memory` block, another
+    process can attach to the same ring by passing `name`.
+    """
+    def __init__(self, n_slots=256, blocksize=1024, n_channels=2, name=None):
+        """Create a new ring, or attach to an existing one.
+
+        Args:
+            n_slots (int): number of frames the ring can hold
+            blocksize (int): number of samples per frame
+            n_channels (int): number of columns per frame
+            name (str or None): name of an existing shared memory block
+                If None, a new block is created and owned by this object
+        """
+        self.n_slots = int(n_slots)
+        self.blocksize = int(blocksize)
+        self.n_channels = int(n_channels)
+
+        # Size of the header and of the frame storage in bytes
+        header_nbytes = N_HEADER * np.dtype(np.int64).itemsize
+        frames_nbytes = (
+            self.n_slots * self.blocksize * self.n_channels *
+            np.dtype(np.float32).itemsize)
+
+        # Create or attach to the shared memory block
+        if name is None:
+            self.shm = shared_memory.SharedMemory(
+                create=True, size=header_nbytes + frames_nbytes)
+            self.owner = True
+        else:
+            self.shm = shared_memory.SharedMemory(name=name)
+            self.owner = False
+        self.name = self.shm.name
+
+        # Views into the shared memory block
+        self.header = self.shm.buf[:header_nbytes].cast('q')
+        self.frames = np.ndarray(
+            (self.n_slots, self.blocksize, self.n_channels),
+            dtype=np.float32, buffer=self.shm.buf, offset=header_nbytes)
+
+        # Only the creator zeros the memory
+        if self.owner:
+            for n in range(N_HEADER):
+                self.header[n] = 0
+            self.frames[:] = 0
+        
+        # Views of each slot and of each column of each slot, made once here
+        # so that the consumer never has to create one
+        self.slots = [self.frames[n_slot] for n_slot in range(self.n_slots)]
+        self.columns = [
+            [self.frames[n_slot, :, n_channel] 
+            for n_channel in range(self.n_channels)]
+            for n_slot in range(self.n_slots)]
+
+    def qsize(self):
+        """Number of frames written but not yet read or flushed"""
+        read_idx = max(self.header[READ_IDX], self.header[SKIP_TO])
+        return self.header[WRITE_IDX] - read_idx
+
+    def empty(self):
+        return self.qsize() <= 0
+
+    def has_room(self):
+        """True if `put_nowait` would not raise queue.Full (producer only)
+
+        This compares against READ_IDX, not SKIP_TO, because the consumer
+        may still be reading a slot that was flushed. Right after a flush
+        there can be no room even though `qsize` is small, until the
+        consumer's next `peek` catches up.
+        """
+        return self.header[WRITE_IDX] - self.header[READ_IDX] < self.n_slots
+
+    def full(self):
+        return not self.has_room()
+
+    def put_nowait(self, frame):
+        """Copy `frame` into the next free slot (producer only)
+
+        Raises queue.Full if every slot is in use, like mp.Queue.
+
+        Returns: the index of the frame, which counts every frame ever put
+        """
+        if not self.has_room():
+            raise queue.Full
+        write_idx = self.header[WRITE_IDX]
+
+        # Copy the data first, and only then publish the slot
+        self.frames[write_idx % self.n_slots] = frame
+        self.header[WRITE_IDX] = write_idx + 1
+        return write_idx
+
+    def peek(self):
+        """Return a view of the next unread frame, or None (consumer only)
+
+        The view stays valid until `advance` is called. No data is copied.
+        """
+        slot = self.peek_slot()
+        if slot < 0:
+            return None
+        return self.slots[slot]
+
+    def peek_slot(self):
+        """Return the slot of the next unread frame, or -1 (consumer only)
+        
+        Use this with `columns` to read the frame without creating any
+        array views.
+        """
+        read_idx = self.header[READ_IDX]
+
+        # Honor any flush requested by the producer
+        skip_to = self.header[SKIP_TO]
+        if skip_to > read_idx:
+            read_idx = skip_to
+            self.header[READ_IDX] = read_idx
+
+        if read_idx >= self.header[WRITE_IDX]:
+            return -1
+        return read_idx % self.n_slots
+
+    def read_index(self):
+        """Index of the frame returned by `peek` (consumer only)
+        
+        This is the same index that `put_nowait` returned for it.
+        """
+        return self.header[READ_IDX]
+
+    def advance(self):
+        """Mark the frame returned by `peek` as read (consumer only)"""
+        self.header[READ_IDX] = self.header[READ_IDX] + 1
+
+    def flush(self, tosize=0):
+        """Drop all but the newest `tosize` unread frames (producer only)
+
+        This only sets SKIP_TO, so it takes the same time no matter how
+        full the ring is. The consumer applies it the next time it calls
+        `peek`.
+        """
+        self.header[SKIP_TO] = max(0, self.header[WRITE_IDX] - tosize)
+
+    def close(self):
+        """Release the views and detach from the shared memory block"""
+        self.header.release()
+        self.header = None
+        self.frames = None
+        self.slots = None
+        self.columns = None
+        self.shm.close()
+
+    def unlink(self):
+        """Destroy the shared memory block (creator only)"""
+        if self.owner:
+            self.shm.unlink()
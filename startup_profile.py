@@ -0,0 +1,112 @@
+## Where the time goes when pi.py or gui.py starts up
+# StartupProfiler times the phases of a script, from when the process was
+# started to when it is ready. Running this module reports how long each
+# import takes, like `python -X importtime`, sorted by cumulative time:
+#   python -m startup_profile numpy zmq jack pigpio
+#   python -m startup_profile --top 30 PyQt5.QtWidgets pyqtgraph
+
+import argparse
+import os
+import subprocess
+import sys
+import time
+
+
+def process_age():
+    """Seconds since this process was started, or None if unknown
+
+    This counts the time the interpreter took to start, before any of our
+    code ran. It only works on Linux.
+    """
+    try:
+        with open('/proc/self/stat') as fi:
+            fields = fi.read().rsplit(')', 1)[1].split()
+        with open('/proc/uptime') as fi:
+            uptime = float(fi.read().split()[0])
+    except OSError:
+        return None
+
+    # Field 22 of stat is the start time in clock ticks since boot,
+    # and it is the 20th after the ')' that ends the process name
+    start_ticks = int(fields[19])
+    return uptime - start_ticks / os.sysconf('SC_CLK_TCK')
+
+
+class StartupProfiler:
+    """Times the phases of starting up.
+
+    Create one as the first thing in a script, and call `mark` at the end
+    of each phase. `report` returns a table of the phases.
+    """
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.last = self.start
+
+        # How long the process ran before this object was made
+        self.before_start = process_age()
+
+        # (name, duration in seconds) of each phase so far
+        self.phases = []
+
+    def mark(self, name):
+        """End the current phase and name it `name`"""
+        now = time.perf_counter()
+        self.phases.append((name, now - self.last))
+        self.last = now
+
+    def total(self):
+        """Seconds from process start (if known) to the last mark"""
+        total = self.last - self.start
+        if self.before_start is not None:
+            total += self.before_start
+        return total
+
+    def report(self):
+        """Return the phases as a table"""
+        lines = [f"{'phase':<20} {'ms':>8} {'cumulative':>10}"]
+        cumulative = 0.
+        phases = list(self.phases)
+        if self.before_start is not None:
+            phases.insert(0, ('interpreter', self.before_start))
+        for name, duration in phases:
+            cumulative += duration
+            lines.append(
+                f"{name:<20} {duration * 1e3:>8.1f} {cumulative * 1e3:>10.1f}")
+        return "\n".join(lines)
+
+
+def import_times(modules, python=None):
+    """Time importing `modules` in a fresh interpreter with -X importtime
+
+    Returns: list of (cumulative us, self us, module name), one per module
+    that was imported, slowest first
+    """
+    if python is None:
+        python = sys.executable
+    proc = subprocess.run(
+        [python, '-X', 'importtime', '-c', 'import ' + ', '.join(modules)],
+        capture_output=True, text=True)
+    if proc.returncode != 0:
+        raise RuntimeError(proc.stderr.strip().splitlines()[-1])
+
+    # Lines look like "import time:       123 |        456 |   numpy.core"
+    results = []
+    for line in proc.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        results.append((int(cumulative_us), int(self_us), name.strip()))
+    results.sort(reverse=True)
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Report how long each module takes to import")
+    parser.add_argument('modules', nargs='+')
+    parser.add_argument('--top', type=int, default=20)
+    args = parser.parse_args()
+
+    print(f"{'cumulative ms':>13} {'self ms':>8}  module")
+    for cumulative_us, self_us, name in import_times(args.modules)[:args.top]:
+        print(f"{cumulative_us / 1e3:>13.1f} {self_us / 1e3:>8.1f}  {name}")
@@ -0,0 +1,137 @@
+## Persistent store of built stimuli, shared across restarts of pi.py
+# NoiseCache only lives as long as the process, so every launch used to
+# filter every stimulus again. Here each built stimulus is saved as a .npy
+# file named by a hash of its parameters, and loaded again with
+# np.load(mmap_mode='r'), which costs a file open instead of any DSP.
+
+import collections
+import hashlib
+import json
+import os
+import threading
+import numpy as np
+
+
+# Bump this to invalidate every stored stimulus, eg if Noise changes the
+# way that it generates its table
+STORE_VERSION = 1
+
+
+class StimulusStore:
+    """Content-addressed directory of chunked float32 stimuli.
+
+    Each stimulus is stored as an array of shape (n_chunks, blocksize,
+    n_channels) in `<directory>/<key>.npy`, where the key is a hash of the
+    parameters that built it. The directory is kept under `max_bytes` by
+    deleting the least recently used files. Use is tracked by modification
+    time, so the order survives restarts.
+    """
+    def __init__(self, directory, max_bytes=256 * 2 ** 20):
+        """Open the store in `directory`, creating it if needed.
+
+        Args:
+            directory (string): where to keep the files
+            max_bytes (int): total size of the files to keep
+        """
+        self.directory = directory
+        self.max_bytes = int(max_bytes)
+        os.makedirs(self.directory, exist_ok=True)
+
+        # Shared with the thread that prerenders the next trial
+        self.lock = threading.Lock()
+
+        # Size of each stored file, least recently used first
+        entries = []
+        for filename in os.listdir(self.directory):
+            if not filename.endswith('.npy'):
+                continue
+            path = os.path.join(self.directory, filename)
+            stat = os.stat(path)
+            entries.append((stat.st_mtime, filename[:-4], stat.st_size))
+        self.index = collections.OrderedDict(
+            (key, size) for mtime, key, size in sorted(entries))
+        self.nbytes = sum(self.index.values())
+
+        # Counters reported by `stats`
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def key(self, parameters):
+        """Return the key for a dict of parameters
+
+        The parameters must be JSON serializable, and should be normalized
+        (eg all floats) so that equal stimuli get equal keys.
+        """
+        blob = json.dumps(
+            {'version': STORE_VERSION, 'parameters': parameters},
+            sort_keys=True)
+        return hashlib.sha1(blob.encode('utf-8')).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, key + '.npy')
+
+    def load(self, key):
+        """Return the stored array memory-mapped read-only, or None"""
+        with self.lock:
+            if key not in self.index:
+                self.misses += 1
+                return None
+
+            path = self.path(key)
+            try:
+                data = np.load(path, mmap_mode='r')
+            except (OSError, ValueError):
+                # Deleted or truncated behind our back
+                self.nbytes -= self.index.pop(key)
+                self.misses += 1
+                return None
+
+            # Mark as recently used, on disk too
+            os.utime(path)
+            self.index.move_to_end(key)
+            self.hits += 1
+            return data
+
+    def save(self, key, data):
+        """Store `data` as float32 under `key`, then evict if over the cap"""
+        data = np.ascontiguousarray(data, dtype=np.float32)
+        path = self.path(key)
+
+        # Write to a temporary file and rename it, so that a crash never
+        # leaves a partial file under the real name
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as fi:
+            np.save(fi, data)
+        os.replace(tmp_path, path)
+        size = os.path.getsize(path)
+
+        with self.lock:
+            if key in self.index:
+                self.nbytes -= self.index.pop(key)
+            self.index[key] = size
+            self.nbytes += size
+
+            # Drop the least recently used files until under the cap
+            # The file that was just saved is always kept
+            while self.nbytes > self.max_bytes and len(self.index) > 1:
+                old_key, old_size = self.index.popitem(last=False)
+                try:
+                    os.remove(self.path(old_key))
+                except FileNotFoundError:
+                    pass
+                self.nbytes -= old_size
+                self.evictions += 1
+
+    def stats(self):
+        """Return a dict of hit/miss counts and disk use"""
+        n_requests = self.hits + self.misses
+        return {
+            'size': len(self.index),
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hit_rate': self.hits / n_requests if n_requests else 0.0,
+            'nbytes': self.nbytes,
+            'max_bytes': self.max_bytes,
+            }
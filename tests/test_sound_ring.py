@@ -0,0 +1,60 @@
+## Tests of FrameRing
+# Run from the root of the repository:
+#   python -m pytest tests
+
+import queue
+import numpy as np
+import pytest
+from sound_ring import FrameRing
+
+
+@pytest.fixture
+def ring():
+    ring = FrameRing(n_slots=512, blocksize=16, n_channels=2)
+    yield ring
+    ring.close()
+    ring.unlink()
+
+
+def fill(ring, n_frames, value=1.0):
+    """Put up to `n_frames`, the way SoundQueue does, and return how many"""
+    frame = np.full((ring.blocksize, ring.n_channels), value, dtype=np.float32)
+    n_put = 0
+    while n_put < n_frames and ring.has_room():
+        ring.put_nowait(frame)
+        n_put += 1
+    return n_put
+
+
+def test_has_room_matches_put_nowait_after_flush(ring):
+    # The consumer hasn't peeked since the flush, so it may still be
+    # reading a flushed slot, and those slots can't be reused yet
+    assert fill(ring, 400) == 400
+    ring.flush()
+    assert ring.qsize() == 0
+
+    assert fill(ring, 400) == 112
+    assert not ring.has_room()
+    assert ring.full()
+    with pytest.raises(queue.Full):
+        ring.put_nowait(np.zeros((16, 2), dtype=np.float32))
+
+
+def test_refill_after_flush(ring):
+    fill(ring, 400, value=1.0)
+    ring.flush()
+    assert fill(ring, 400, value=2.0) == 112
+
+    # Once the consumer catches up with the flush, the rest fits
+    ring.peek_slot()
+    assert ring.has_room()
+    assert fill(ring, 400 - 112, value=2.0) == 400 - 112
+    assert ring.qsize() == 400
+
+    # Only frames written after the flush are played
+    for n_frame in range(400):
+        frame = ring.peek()
+        assert frame is not None
+        assert (frame == 2.0).all()
+        ring.advance()
+    assert ring.peek() is None